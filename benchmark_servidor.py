@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Benchmark de carga para servidor_impresion_adaptado.py sin hardware.
+
+Levanta la app Flask en el mismo proceso con:
+* un ejecutable fiscal falso (script Python con el nombre de EXECUTABLE_FISCAL) en carpetas
+  temporales BASE_FISCAL_PATH/<uuid>, con demora, fallos y respuestas "Enviados 0 comandos"
+  configurables;
+* una tickera USB falsa que descarta los bytes tras una demora.
+
+Lanza una mezcla de facturas, reportes X, consultas de estado y comandas contra N terminales
+con la concurrencia indicada y reporta en JSON: latencias p50/p95/p99 por operación,
+throughput, tiempo de espera por el lock de cada impresora y reintentos del ejecutable.
+
+Uso (solo Linux/macOS, el ejecutable falso es un script con shebang):
+    python benchmark_servidor.py --terminales 8 --concurrencia 32 --solicitudes 2000 --salida bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from escpos.printer import Dummy
+
+import servidor_impresion_adaptado as servidor
+
+PLANTILLA_EJECUTABLE = '''#!{python}
+# Ejecutable fiscal falso generado por benchmark_servidor.py
+import json, os, random, sys, time
+config = json.load(open({config!r}))
+with open("invocaciones.log", "a") as log: log.write(sys.argv[1] + "\\n")
+time.sleep(config["demora_seg"])
+if random.random() < config["probabilidad_falla"]:
+    print("Error de comunicacion con la impresora"); sys.exit(1)
+comando, argumento = sys.argv[1], sys.argv[2]
+if comando == "SendFileCmd":
+    lineas = len(open(argumento, encoding="latin-1").read().splitlines())
+    print(f"Enviados {{0 if random.random() < config['probabilidad_cero'] else lineas}} comandos")
+elif comando == "ReadFpStatus":
+    open(argumento, "w").write("Status: 4 Error: 0\\n")
+    print("Lectura de estado exitosa")
+else:
+    print("Comando ejecutado correctamente")
+'''
+
+
+class UsbFalso(Dummy):
+    """Tickera falsa: acepta la conexión y descarta lo escrito tras 'demora_seg'."""
+    demora_seg = 0.0
+    bytes_escritos = 0
+    escrituras = 0
+    _contador_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _raw(self, msg):
+        time.sleep(self.demora_seg)
+        with UsbFalso._contador_lock:
+            UsbFalso.bytes_escritos += len(msg)
+            UsbFalso.escrituras += 1
+
+
+class LockMedido:
+    """Envuelve el lock de una impresora y registra cuánto espera cada adquisición."""
+
+    def __init__(self, lock, esperas):
+        self._lock = lock
+        self._esperas = esperas
+
+    def acquire(self, blocking=True, timeout=-1):
+        t_inicio = time.perf_counter()
+        adquirido = self._lock.acquire(blocking, timeout)
+        if adquirido and blocking:
+            self._esperas.append((time.perf_counter() - t_inicio) * 1000)
+        return adquirido
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def percentiles(valores):
+    if not valores:
+        return {"n": 0}
+    ordenados = sorted(valores)
+    def rango(p):
+        return round(ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))], 3)
+    return {"n": len(ordenados), "p50": rango(50), "p95": rango(95), "p99": rango(99),
+            "max": round(ordenados[-1], 3), "media": round(sum(ordenados) / len(ordenados), 3)}
+
+
+def payload_factura(terminal_uuid, items):
+    return {
+        "terminalUUID": terminal_uuid,
+        "cliente": {"razon_social": "Cliente Benchmark", "rif": "V123456789"},
+        "items": [{"descripcion": f"Producto {i}", "cantidad": 1 + i % 3, "precio_unitario_con_iva": 11.6, "tasa_iva": 16.0} for i in range(items)],
+        "pagos": [{"slot_fiscal": 1, "monto": 11.6 * items}],
+    }
+
+
+def payload_comanda(numero):
+    return {
+        "pedido": {"id": numero, "mesa": str(numero % 20 + 1), "mesero": "Benchmark"},
+        "items": [{"cantidad": 2, "descripcion": "Hamburguesa", "adicionales": [{"nombre": "Queso", "cantidad": 1}]},
+                  {"cantidad": 1, "descripcion": "Refresco", "observacion": "sin hielo"}],
+    }
+
+
+def parsear_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, peso = parte.split("=")
+        mezcla[nombre.strip()] = float(peso)
+    desconocidas = set(mezcla) - {"factura", "reporte", "estado", "comanda"}
+    if desconocidas:
+        raise ValueError(f"Operaciones desconocidas en --mezcla: {', '.join(sorted(desconocidas))}")
+    return mezcla
+
+
+def preparar_terminales(base, cantidad, config_ejecutable):
+    ruta_config = os.path.join(base, "bench_config.json")
+    with open(ruta_config, "w") as f:
+        json.dump(config_ejecutable, f)
+    script = PLANTILLA_EJECUTABLE.format(python=sys.executable, config=ruta_config)
+    terminales = []
+    for i in range(cantidad):
+        terminal_uuid = f"bench-{i:03d}"
+        carpeta = os.path.join(base, terminal_uuid)
+        os.makedirs(carpeta)
+        ruta_ejecutable = os.path.join(carpeta, servidor.EXECUTABLE_FISCAL)
+        with open(ruta_ejecutable, "w") as f:
+            f.write(script)
+        os.chmod(ruta_ejecutable, 0o755)
+        terminales.append(terminal_uuid)
+    return terminales
+
+
+def version_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def ejecutar_benchmark(args):
+    mezcla = parsear_mezcla(args.mezcla)
+    base = tempfile.mkdtemp(prefix="bench_fiscal_")
+    terminales = preparar_terminales(base, args.terminales, {
+        "demora_seg": args.demora_ms / 1000, "probabilidad_falla": args.probabilidad_falla,
+        "probabilidad_cero": args.probabilidad_cero,
+    })
+
+    # --- Instrumentación del servidor ---
+    servidor.BASE_FISCAL_PATH = base
+    servidor.Usb = UsbFalso
+    UsbFalso.demora_seg = args.demora_usb_ms / 1000
+    esperas_lock = []
+    obtener_lock_original = servidor.obtener_lock_impresora
+    servidor.obtener_lock_impresora = lambda terminal_uuid: LockMedido(obtener_lock_original(terminal_uuid), esperas_lock)
+    llamadas_ejecutable = [0]
+    ejecutar_original = servidor.ejecutar_con_ejecutable
+    def ejecutar_contado(*a, **k):
+        llamadas_ejecutable[0] += 1
+        return ejecutar_original(*a, **k)
+    servidor.ejecutar_con_ejecutable = ejecutar_contado
+    if args.sondeo:
+        servidor.iniciar_sondeo_estado()
+
+    operaciones = list(mezcla)
+    pesos = [mezcla[op] for op in operaciones]
+    resultados = {op: {"latencias": [], "errores": 0, "codigos": {}} for op in operaciones}
+    resultados_lock = threading.Lock()
+    clientes = threading.local()
+
+    def una_solicitud(numero):
+        cliente = getattr(clientes, "cliente", None)
+        if cliente is None:
+            cliente = clientes.cliente = servidor.app.test_client()
+        operacion = random.choices(operaciones, pesos)[0]
+        terminal_uuid = random.choice(terminales)
+        t_inicio = time.perf_counter()
+        if operacion == "factura":
+            respuesta = cliente.post("/imprimir-factura-fiscal", json=payload_factura(terminal_uuid, args.items))
+        elif operacion == "reporte":
+            respuesta = cliente.post("/imprimir-reporte-fiscal", json={"terminalUUID": terminal_uuid, "tipo": "X"})
+        elif operacion == "estado":
+            respuesta = cliente.get(f"/estado-impresora-fiscal/{terminal_uuid}")
+        else:
+            respuesta = cliente.post("/imprimir-comanda", json=payload_comanda(numero))
+        latencia_ms = (time.perf_counter() - t_inicio) * 1000
+        with resultados_lock:
+            r = resultados[operacion]
+            r["latencias"].append(latencia_ms)
+            r["codigos"][str(respuesta.status_code)] = r["codigos"].get(str(respuesta.status_code), 0) + 1
+            if respuesta.status_code >= 400: r["errores"] += 1
+
+    # Sin --verboso solo se registran advertencias y errores del servidor
+    if not args.verboso: logging.getLogger("servidor").setLevel(logging.WARNING)
+    t_inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        list(pool.map(una_solicitud, range(args.solicitudes)))
+    duracion = time.perf_counter() - t_inicio
+
+    invocaciones = 0
+    for terminal_uuid in terminales:
+        ruta_log = os.path.join(base, terminal_uuid, "invocaciones.log")
+        if os.path.exists(ruta_log):
+            with open(ruta_log) as f:
+                invocaciones += sum(1 for _ in f)
+    if not args.conservar:
+        shutil.rmtree(base, ignore_errors=True)
+
+    return {
+        "version": version_actual(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "duracion_seg": round(duracion, 3),
+        "solicitudes_por_seg": round(args.solicitudes / duracion, 2),
+        "operaciones": {
+            op: dict(percentiles(r["latencias"]), errores=r["errores"], codigos=r["codigos"],
+                     por_seg=round(len(r["latencias"]) / duracion, 2))
+            for op, r in resultados.items()
+        },
+        "espera_lock_ms": dict(percentiles(esperas_lock), total=round(sum(esperas_lock), 1)),
+        "ejecutable": {"llamadas": llamadas_ejecutable[0], "invocaciones": invocaciones,
+                       "reintentos": invocaciones - llamadas_ejecutable[0]},
+        "usb": {"escrituras": UsbFalso.escrituras, "bytes": UsbFalso.bytes_escritos},
+        "base_fiscal_path": base if args.conservar else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de carga del servidor de impresión (sin hardware).")
+    parser.add_argument("--terminales", type=int, default=4, help="Número de impresoras fiscales falsas.")
+    parser.add_argument("--concurrencia", type=int, default=16, help="Solicitudes simultáneas.")
+    parser.add_argument("--solicitudes", type=int, default=500, help="Total de solicitudes a lanzar.")
+    parser.add_argument("--mezcla", default="factura=60,reporte=5,estado=25,comanda=10",
+                        help="Pesos relativos de cada operación: factura, reporte, estado, comanda.")
+    parser.add_argument("--items", type=int, default=5, help="Ítems por factura.")
+    parser.add_argument("--demora-ms", type=float, default=50.0, help="Demora del ejecutable fiscal falso por invocación.")
+    parser.add_argument("--probabilidad-falla", type=float, default=0.0, help="Probabilidad de que el ejecutable falle (código != 0).")
+    parser.add_argument("--probabilidad-cero", type=float, default=0.0, help="Probabilidad de responder 'Enviados 0 comandos'.")
+    parser.add_argument("--demora-usb-ms", type=float, default=5.0, help="Demora de la tickera falsa por escritura.")
+    parser.add_argument("--sondeo", action="store_true", help="Activar el sondeo de estado en segundo plano.")
+    parser.add_argument("--verboso", action="store_true", help="Registrar también los mensajes informativos del servidor.")
+    parser.add_argument("--conservar", action="store_true", help="No borrar las carpetas temporales de los terminales.")
+    parser.add_argument("--salida", help="Archivo JSON de resultados (por defecto, la salida estándar).")
+    args = parser.parse_args()
+
+    if servidor.SISTEMA_OPERATIVO == "Windows":
+        sys.exit("El benchmark usa un ejecutable fiscal falso con shebang y solo funciona en Linux/macOS.")
+
+    resultado = json.dumps(ejecutar_benchmark(args), indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(resultado + "\n")
+    else:
+        print(resultado)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Codificador de facturas fiscales a comandos TFHKA (las líneas del archivo de SendFileCmd).
+
+Una factura en JSON se convierte en:
+
+* 'iS*<razón social>' e 'iR*<RIF>' del cliente.
+* Un comando por ítem: tasa (1 carácter) + precio sin IVA (10 dígitos, 2 decimales implícitos)
+  + cantidad (8 dígitos, 3 decimales implícitos) + descripción (hasta 40 caracteres).
+* '3' (subtotal), los pagos parciales '2' + slot + monto (12 dígitos, 2 decimales implícitos),
+  el pago final '1' + slot ('101' si no hay pagos) y '199' de cierre si el modo IGTF está activo.
+
+Los montos se leen como Decimal y se redondean mitad hacia arriba con aritmética entera exacta, sin
+pasar por float. Las tablas de tasas y slots se arman una sola vez por codificador. Todo se valida
+antes de devolver los comandos: un dato que no cabe en su campo falla aquí con ValueError y no a
+mitad de un documento abierto en la impresora.
+
+Microbenchmark (ítems por segundo):
+    python codificador_fiscal.py --items 500 --facturas 200
+"""
+import argparse
+import json
+import re
+import time
+from decimal import Decimal, InvalidOperation
+
+# Tasa de IVA (%) -> carácter de tasa del comando de ítem, según la programación de la impresora
+TASAS_IVA = {Decimal("16"): "!", Decimal("8"): '"', Decimal("31"): "#", Decimal("0"): " "}
+SLOTS_PAGO = range(1, 25)        # Medios de pago programables (01-24)
+LARGO_DESCRIPCION = 40
+DIGITOS_PRECIO = 10              # Precio unitario sin IVA, en céntimos
+DIGITOS_CANTIDAD = 8             # Cantidad, en milésimas
+DIGITOS_MONTO = 12               # Monto de un pago parcial, en céntimos
+PRECIO_MINIMO = Decimal("0.01")  # Un ítem con precio cero o negativo se envía a 0.01 y exento
+MEMO_MAXIMO = 4096               # Precios y cantidades ya codificados que recuerda cada codificador
+
+# Un salto de línea partiría el comando en dos; el archivo se escribe en latin-1
+_CARACTER_NO_IMPRIMIBLE = re.compile(r"[^\x20-\x7e\xa0-\xff]")
+_HASHEABLES = (int, float, str)  # Tipos de número que admite el JSON de la factura y sirven de clave
+
+
+def _redondear(numerador, denominador):
+    """Cociente entero redondeado mitad hacia arriba (para valores no negativos)."""
+    return (2 * numerador + denominador) // (2 * denominador)
+
+
+def _decimal(valor, campo):
+    if type(valor) not in (int, float, str):  # type() y no isinstance(): excluye bool
+        raise ValueError(f"{campo}: se esperaba un número, se recibió {valor!r}.")
+    try:
+        numero = Decimal(str(valor).strip())  # str() de un float da su representación decimal más corta
+    except InvalidOperation:
+        raise ValueError(f"{campo}: {valor!r} no es un número válido.") from None
+    if not numero.is_finite():
+        raise ValueError(f"{campo}: {valor!r} no es un número válido.")
+    return numero
+
+
+def _escalar(numero, escala, campo, digitos):
+    """Convierte un Decimal a unidades enteras (céntimos, milésimas) comprobando que quepa en 'digitos'."""
+    if numero < 0:
+        raise ValueError(f"{campo} no puede ser negativo ({numero}).")
+    numerador, denominador = numero.as_integer_ratio()
+    unidades = _redondear(numerador * escala, denominador)
+    if unidades >= 10 ** digitos:
+        raise ValueError(f"{campo} ({numero}) no cabe en los {digitos} dígitos del comando.")
+    return unidades
+
+
+def _memorizar(memo, clave, valor):
+    # Al llenarse se vacía entera: es más barato que llevar el orden de uso, y se repuebla en una factura
+    if len(memo) >= MEMO_MAXIMO: memo.clear()
+    memo[clave] = valor
+
+
+def _texto(valor, campo, defecto, largo=None):
+    # Un null vale lo mismo que el campo ausente y, como en la versión sin validación, un número (p. ej. un RIF) se usa como texto
+    if valor is None:
+        valor = defecto
+    elif type(valor) in (int, float):
+        valor = str(valor)
+    elif not isinstance(valor, str):
+        raise ValueError(f"{campo} debe ser texto, se recibió {valor!r}.")
+    if largo is not None:
+        valor = valor[:largo]
+    no_imprimible = _CARACTER_NO_IMPRIMIBLE.search(valor)
+    if no_imprimible:
+        raise ValueError(f"{campo} contiene un carácter que la impresora no admite: {no_imprimible.group()!r}.")
+    return valor
+
+
+class CodificadorFiscal:
+    """Tablas precalculadas para codificar facturas. Una instancia sirve para todas las solicitudes."""
+
+    def __init__(self, tasas=TASAS_IVA):
+        # precio sin IVA en céntimos = precio * 100 / (1 + n / (100 d)) = precio * 10000 d / (100 d + n), con tasa = n/d
+        self._tasas = {}
+        for tasa, caracter in tasas.items():
+            n, d = Decimal(tasa).as_integer_ratio()
+            self._tasas[Decimal(tasa)] = (caracter, 10000 * d, 100 * d + n)
+        self._slots = {slot: f"{slot:02d}" for slot in SLOTS_PAGO}
+        # En una factura grande se repiten los mismos productos: cada precio y cantidad se codifica una vez
+        self._memo_precios = {}
+        self._memo_cantidades = {}
+
+    def tasas(self):
+        return sorted(float(tasa) for tasa in self._tasas)
+
+    def codificar(self, factura, cierre_igtf=True):
+        """Devuelve la lista de comandos de la factura. Lanza ValueError si algún dato no es válido."""
+        if not isinstance(factura, dict):
+            raise ValueError("La factura debe ser un objeto JSON.")
+        cliente = factura.get("cliente") or {}
+        items = factura.get("items", [])
+        pagos = factura.get("pagos", [])
+        if not isinstance(cliente, dict): raise ValueError("'cliente' debe ser un objeto.")
+        if not isinstance(items, list): raise ValueError("'items' debe ser una lista.")
+        if not isinstance(pagos, list): raise ValueError("'pagos' debe ser una lista.")
+
+        comandos = [f"iS*{_texto(cliente.get('razon_social'), 'cliente.razon_social', 'Consumidor Final')}",
+                    f"iR*{_texto(cliente.get('rif'), 'cliente.rif', 'V000000000')}"]
+        agregar, memo_precios, memo_cantidades = comandos.append, self._memo_precios, self._memo_cantidades
+        for indice, item in enumerate(items):
+            campo = f"items[{indice}]"
+            if not isinstance(item, dict):
+                raise ValueError(f"{campo} debe ser un objeto.")
+            descripcion = _texto(item.get("descripcion"), f"{campo}.descripcion", "Producto", LARGO_DESCRIPCION)
+            precio, tasa, cantidad = item.get("precio_unitario_con_iva", 0), item.get("tasa_iva", 0), item.get("cantidad", 0)
+            # La clave lleva el tipo: 16 y "16" se validan por separado, y un bool nunca coincide con 1
+            precio_codificado = None
+            if type(precio) in _HASHEABLES and type(tasa) in _HASHEABLES:
+                precio_codificado = memo_precios.get((type(precio), precio, type(tasa), tasa))
+            if precio_codificado is None:
+                precio_codificado = self._codificar_precio(precio, tasa, campo)
+            cantidad_codificada = memo_cantidades.get((type(cantidad), cantidad)) if type(cantidad) in _HASHEABLES else None
+            if cantidad_codificada is None:
+                cantidad_codificada = self._codificar_cantidad(cantidad, campo)
+            agregar(f"{precio_codificado}{cantidad_codificada}{descripcion}")
+
+        agregar("3")
+        if not pagos:
+            agregar("101")
+        for indice, pago in enumerate(pagos):
+            campo = f"pagos[{indice}]"
+            if not isinstance(pago, dict):
+                raise ValueError(f"{campo} debe ser un objeto.")
+            slot = self._slot(pago.get("slot_fiscal", 1), f"{campo}.slot_fiscal")
+            if indice == len(pagos) - 1:
+                agregar(f"1{slot}")  # El último pago cierra la factura por el saldo restante
+            else:
+                monto = _escalar(_decimal(pago.get("monto", 0), f"{campo}.monto"), 100, f"{campo}.monto", DIGITOS_MONTO)
+                agregar(f"2{slot}{monto:0{DIGITOS_MONTO}d}")
+        if cierre_igtf:
+            agregar("199")
+        return comandos
+
+    def _codificar_precio(self, precio_recibido, tasa_recibida, campo):
+        """Carácter de tasa + precio sin IVA en céntimos (10 dígitos)."""
+        precio = _decimal(precio_recibido, f"{campo}.precio_unitario_con_iva")
+        tasa = _decimal(tasa_recibida, f"{campo}.tasa_iva")
+        if precio <= 0:
+            precio, tasa = PRECIO_MINIMO, Decimal(0)
+        try:
+            caracter, multiplicador, divisor = self._tasas[tasa]
+        except KeyError:
+            raise ValueError(f"{campo}.tasa_iva {tasa}% no está programada en la impresora (tasas: {self.tasas()}).") from None
+        numerador, denominador = precio.as_integer_ratio()
+        centimos = _redondear(numerador * multiplicador, denominador * divisor)
+        if centimos >= 10 ** DIGITOS_PRECIO:
+            raise ValueError(f"{campo}.precio_unitario_con_iva ({precio}) no cabe en los {DIGITOS_PRECIO} dígitos del comando.")
+        codificado = f"{caracter}{centimos:0{DIGITOS_PRECIO}d}"
+        _memorizar(self._memo_precios, (type(precio_recibido), precio_recibido, type(tasa_recibida), tasa_recibida), codificado)
+        return codificado
+
+    def _codificar_cantidad(self, cantidad_recibida, campo):
+        """Cantidad en milésimas (8 dígitos)."""
+        cantidad = _escalar(_decimal(cantidad_recibida, f"{campo}.cantidad"), 1000, f"{campo}.cantidad", DIGITOS_CANTIDAD)
+        if cantidad == 0:
+            raise ValueError(f"{campo}.cantidad debe ser mayor que 0.")
+        codificada = f"{cantidad:0{DIGITOS_CANTIDAD}d}"
+        _memorizar(self._memo_cantidades, (type(cantidad_recibida), cantidad_recibida), codificada)
+        return codificada
+
+    def _slot(self, valor, campo):
+        if isinstance(valor, float) and valor.is_integer(): valor = int(valor)
+        elif isinstance(valor, str) and valor.strip().isdigit(): valor = int(valor)
+        prefijo = self._slots.get(valor) if isinstance(valor, int) and not isinstance(valor, bool) else None
+        if prefijo is None:
+            raise ValueError(f"{campo} debe ser un medio de pago entre {SLOTS_PAGO.start} y {SLOTS_PAGO.stop - 1}, se recibió {valor!r}.")
+        return prefijo
+
+
+# --- MICROBENCHMARK ---
+
+def factura_de_prueba(items, catalogo):
+    """Factura de 'items' líneas tomadas de un catálogo de 'catalogo' productos distintos."""
+    tasas = (16.0, 8.0, 0.0)
+    return {
+        "cliente": {"razon_social": "Cliente de Prueba", "rif": "V123456789"},
+        "items": [{"descripcion": f"Producto de prueba número {i % catalogo}", "cantidad": 1 + i % 3,
+                   "precio_unitario_con_iva": round(1.16 * (i % catalogo + 1), 2), "tasa_iva": tasas[i % catalogo % len(tasas)]}
+                  for i in range(items)],
+        "pagos": [{"slot_fiscal": 1, "monto": 100.0}, {"slot_fiscal": 20}],
+    }
+
+
+def medir(codificador, factura, repeticiones):
+    codificador.codificar(factura)  # Calentamiento (y memo de precios y cantidades, como en un servidor en marcha)
+    t_inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        codificador.codificar(factura)
+    return time.perf_counter() - t_inicio
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmark del codificador de facturas fiscales.")
+    parser.add_argument("--items", type=int, default=500, help="Ítems por factura.")
+    parser.add_argument("--facturas", type=int, default=200, help="Facturas a codificar.")
+    parser.add_argument("--catalogo", type=int, default=50, help="Productos distintos (precio y tasa) entre los ítems.")
+    args = parser.parse_args()
+
+    factura = factura_de_prueba(args.items, args.catalogo)
+    segundos = medir(CodificadorFiscal(), factura, args.facturas)
+    print(json.dumps({
+        "items_por_factura": args.items,
+        "catalogo": args.catalogo,
+        "facturas": args.facturas,
+        "segundos": round(segundos, 4),
+        "facturas_por_segundo": round(args.facturas / segundos, 1),
+        "items_por_segundo": round(args.items * args.facturas / segundos),
+        "us_por_item": round(segundos / (args.items * args.facturas) * 1e6, 3),
+    }, indent=2, ensure_ascii=False))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Driver nativo para impresoras fiscales The Factory HKA (TFHKA) por puerto serial.
+
+Habla directamente el protocolo de la impresora en lugar de lanzar tfinulx / IntTFHKA
+por cada comando:
+
+* Cada comando viaja en una trama  STX + comando + ETX + LRC,  donde LRC es el XOR de
+  todos los bytes después de STX (incluido ETX).
+* La impresora contesta ACK si aceptó el comando o NAK si lo rechazó.
+* Para leer el estado se envía ENQ y la impresora responde  STX + STS1 + STS2 + ETX + LRC.
+  STS1 y STS2 son campos de bits (el bit 6 siempre en 1, para no confundirse con caracteres
+  de control); decodificar_trama_estado() los traduce a los códigos de estado y error que
+  devuelve ReadFpStatus en el ejecutable del fabricante (STATUS_CODES / ERROR_CODES).
+
+El puerto se mantiene abierto entre comandos y se reabre si falla. Requiere 'pyserial'.
+"""
+import threading
+
+try:
+    import serial
+except ImportError:  # pyserial es opcional: sin él solo está disponible el backend por ejecutable
+    serial = None
+
+STX = 0x02
+ETX = 0x03
+ENQ = 0x05
+ACK = 0x06
+NAK = 0x15
+
+# STS1: bits 0-1 = documento en curso (00 en espera, 01 fiscal, 10 no fiscal);
+#       bits 2-3 = modo (00 prueba, 01 fiscal, 10 memoria fiscal casi llena, 11 memoria fiscal llena).
+# STS2: bits 0-1 = papel (01 fin del papel, 10 error mecánico, 11 ambos);
+#       bits 2-5 = error del último comando; el código es el byte con los bits de papel en 0 (0x50 -> 80).
+BIT_FIJO_ESTADO = 0x40
+MASCARA_DOCUMENTO = 0x03
+MASCARA_MODO = 0x0C
+MASCARA_PAPEL = 0x03
+MASCARA_ERROR_COMANDO = 0x3C
+STATUS_DESCONOCIDO = 0
+
+# Códigos de error del lado del host, los mismos que reporta el ejecutable del fabricante (ERROR_CODES).
+# La impresora no puede enviarlos en STS2: solo describen fallos del enlace serial.
+ERROR_COMANDO_RECHAZADO = 80   # La impresora contestó NAK: comando o valor inválido, el enlace funciona
+ERROR_COMUNICACION = 128
+ERROR_SIN_RESPUESTA = 137
+ERROR_TRAMA_INVALIDA = 144     # Respuesta con formato o LRC incorrecto
+
+
+class ErrorDriverTfhka(Exception):
+    """Fallo hablando con la impresora. 'enviados' indica cuántos comandos se aceptaron antes del fallo."""
+
+    def __init__(self, mensaje, error_code, enviados=0, conectado=True):
+        super().__init__(mensaje)
+        self.error_code = error_code
+        self.enviados = enviados
+        self.conectado = conectado
+
+
+def calcular_lrc(datos):
+    lrc = 0
+    for byte in datos:
+        lrc ^= byte
+    return lrc
+
+
+def armar_trama(comando):
+    cuerpo = comando.encode("latin-1") + bytes([ETX])
+    return bytes([STX]) + cuerpo + bytes([calcular_lrc(cuerpo)])
+
+
+def decodificar_trama_estado(trama):
+    """Devuelve (status_code, error_code) a partir de la respuesta de 5 bytes a ENQ."""
+    if len(trama) != 5 or trama[0] != STX or trama[3] != ETX:
+        raise ErrorDriverTfhka(f"Trama de estado inválida: {trama.hex()}", ERROR_TRAMA_INVALIDA)
+    if calcular_lrc(trama[1:4]) != trama[4]:
+        raise ErrorDriverTfhka(f"LRC inválido en la trama de estado: {trama.hex()}", ERROR_TRAMA_INVALIDA)
+    sts1, sts2 = trama[1], trama[2]
+    if not sts1 & BIT_FIJO_ESTADO or not sts2 & BIT_FIJO_ESTADO:
+        raise ErrorDriverTfhka(f"Bytes de estado inválidos: {trama.hex()}", ERROR_TRAMA_INVALIDA)
+    documento = sts1 & MASCARA_DOCUMENTO
+    # 1-3 modo prueba, 4-6 modo fiscal, 7-9 memoria casi llena, 10-12 memoria llena; 0 si el documento no es válido
+    status_code = STATUS_DESCONOCIDO if documento == MASCARA_DOCUMENTO else 3 * ((sts1 & MASCARA_MODO) >> 2) + documento + 1
+    # Un problema de papel tiene prioridad: es el que impide imprimir (1, 2 o 3)
+    error_code = sts2 & MASCARA_PAPEL or (BIT_FIJO_ESTADO | sts2 & MASCARA_ERROR_COMANDO if sts2 & MASCARA_ERROR_COMANDO else 0)
+    return status_code, error_code
+
+
+class DriverTfhka:
+    """Conexión serial persistente con una impresora fiscal TFHKA."""
+
+    def __init__(self, puerto, baudios=9600, paridad="E", timeout=3.0, reintentos_nak=3):
+        self.puerto = puerto
+        self.baudios = baudios
+        self.paridad = paridad
+        self.timeout = timeout
+        self.reintentos_nak = reintentos_nak
+        self._serial = None
+        self._lock = threading.Lock()
+
+    def abrir(self):
+        if self._serial is not None:
+            return
+        if serial is None:
+            raise ErrorDriverTfhka("pyserial no está instalado (pip install pyserial).", ERROR_COMUNICACION, conectado=False)
+        try:
+            self._serial = serial.Serial(
+                self.puerto, self.baudios, bytesize=serial.EIGHTBITS, parity=self.paridad,
+                stopbits=serial.STOPBITS_ONE, timeout=self.timeout, write_timeout=self.timeout,
+            )
+        except (serial.SerialException, OSError) as e:
+            raise ErrorDriverTfhka(f"No se pudo abrir el puerto {self.puerto}: {e}", ERROR_COMUNICACION, conectado=False) from e
+
+    def cerrar(self):
+        puerto_serial, self._serial = self._serial, None
+        if puerto_serial is not None:
+            try:
+                puerto_serial.close()
+            except Exception:
+                pass
+
+    def enviar_comando(self, comando):
+        """Envía un comando y espera ACK. Reintenta ante NAK hasta 'reintentos_nak' veces."""
+        with self._lock:
+            self._enviar(comando, enviados=0)
+        return {"exito": True, "mensaje": f"Comando {comando!r} aceptado", "comandos_enviados": 1}
+
+    def enviar_comandos(self, comandos):
+        """Envía una lista de comandos en orden; se detiene en el primero que la impresora rechace."""
+        with self._lock:
+            for enviados, comando in enumerate(comandos):
+                self._enviar(comando, enviados=enviados)
+        return {"exito": True, "mensaje": f"Enviados {len(comandos)} comandos", "comandos_enviados": len(comandos)}
+
+    def leer_estado(self):
+        with self._lock:
+            trama = self._transaccion(bytes([ENQ]), 5, enviados=0)
+        status_code, error_code = decodificar_trama_estado(trama)
+        return {"exito": True, "mensaje": f"Status: {status_code} Error: {error_code}",
+                "status_code": status_code, "error_code": error_code}
+
+    def _enviar(self, comando, enviados):
+        trama = armar_trama(comando)
+        for _ in range(self.reintentos_nak):
+            respuesta = self._transaccion(trama, 1, enviados)
+            if respuesta[0] == ACK:
+                return
+            if respuesta[0] != NAK:
+                raise ErrorDriverTfhka(f"Respuesta inesperada 0x{respuesta[0]:02x} al comando {comando!r}.",
+                                       ERROR_TRAMA_INVALIDA, enviados=enviados)
+        raise ErrorDriverTfhka(f"La impresora rechazó (NAK) el comando {comando!r} {self.reintentos_nak} veces.",
+                               ERROR_COMANDO_RECHAZADO, enviados=enviados)
+
+    def _transaccion(self, datos, bytes_respuesta, enviados):
+        self.abrir()
+        try:
+            self._serial.reset_input_buffer()
+            self._serial.write(datos)
+            self._serial.flush()
+            respuesta = self._serial.read(bytes_respuesta)
+        except Exception as e:  # SerialException, OSError o termios.error según la plataforma
+            # El handle quedó inválido (cable desconectado, impresora reiniciada): se reabre en el próximo comando
+            self.cerrar()
+            raise ErrorDriverTfhka(f"Error de comunicación en {self.puerto}: {e}", ERROR_COMUNICACION, enviados=enviados) from e
+        if len(respuesta) < bytes_respuesta:
+            raise ErrorDriverTfhka(f"La impresora en {self.puerto} no respondió en {self.timeout}s.",
+                                   error_code=ERROR_SIN_RESPUESTA, enviados=enviados)
+        return respuesta
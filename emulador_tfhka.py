@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Emulador de impresora fiscal TFHKA sobre un pseudo-terminal (pty).
+
+Permite probar el backend serial (driver_tfhka.py) sin hardware. Crea un pty, publica la
+ruta del extremo esclavo (p. ej. /dev/pts/7) y responde como la impresora: ACK/NAK a cada
+trama STX..ETX+LRC y la trama de estado STX+STS1+STS2+ETX+LRC a cada ENQ.
+
+Uso (solo Linux/macOS):
+    python emulador_tfhka.py --status 4 --error 0 --probabilidad-nak 0.05
+
+Luego, en servidor_impresion_adaptado.py:
+    BACKENDS_FISCALES = {"<terminalUUID>": {"backend": "serial", "puerto": "/dev/pts/7"}}
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+from driver_tfhka import ACK, BIT_FIJO_ESTADO, ENQ, ETX, MASCARA_DOCUMENTO, NAK, STATUS_DESCONOCIDO, STX, calcular_lrc
+
+ERRORES_IMPRESORA = (0, 1, 2, 3, 80, 84, 88, 92, 96, 100, 108, 112)  # Los que caben en STS2 (ERROR_CODES)
+
+
+def codificar_estado(status, error):
+    """Bytes STS1/STS2 que hacen que decodificar_trama_estado() devuelva (status, error)."""
+    if not 0 <= status <= 12 or error not in ERRORES_IMPRESORA:
+        raise ValueError(f"La impresora no puede reportar status {status} / error {error}.")
+    if status == STATUS_DESCONOCIDO:
+        sts1 = BIT_FIJO_ESTADO | MASCARA_DOCUMENTO
+    else:
+        modo, documento = divmod(status - 1, 3)
+        sts1 = BIT_FIJO_ESTADO | modo << 2 | documento
+    return sts1, BIT_FIJO_ESTADO | error
+
+
+class EmuladorTfhka:
+
+    def __init__(self, status=4, error=0, probabilidad_nak=0.0, demora_seg=0.0):
+        codificar_estado(status, error)  # Falla aquí, no en el primer ENQ, si la combinación no es posible
+        self.status = status
+        self.error = error
+        self.probabilidad_nak = probabilidad_nak
+        self.demora_seg = demora_seg
+        self.comandos_recibidos = []
+        self._maestro = None
+        self._esclavo = None
+        self._activo = False
+
+    def iniciar(self):
+        """Abre el pty y atiende en un hilo. Devuelve la ruta del puerto que debe usar el driver."""
+        import pty, tty  # Solo existen en sistemas POSIX
+        self._maestro, self._esclavo = pty.openpty()
+        tty.setraw(self._esclavo)
+        self._activo = True
+        threading.Thread(target=self._atender, name="emulador-tfhka", daemon=True).start()
+        return os.ttyname(self._esclavo)
+
+    def detener(self):
+        self._activo = False
+        for fd in (self._maestro, self._esclavo):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _responder(self, datos):
+        if self.demora_seg: time.sleep(self.demora_seg)
+        try:
+            os.write(self._maestro, datos)
+        except OSError:
+            self._activo = False  # El pty se cerró (detener())
+
+    def _trama_estado(self):
+        cuerpo = bytes([*codificar_estado(self.status, self.error), ETX])
+        return bytes([STX]) + cuerpo + bytes([calcular_lrc(cuerpo)])
+
+    def _procesar_comando(self, comando):
+        self.comandos_recibidos.append(comando)
+        # Un documento fiscal queda abierto desde el cliente/primer ítem hasta el pago total
+        if comando.startswith(("iS", "iR", "!", '"', "#", " ")):
+            self.status = 5
+        elif len(comando) == 3 and comando[0] == "1":
+            self.status = 4
+
+    def _atender(self):
+        pendiente = bytearray()
+        while self._activo:
+            try:
+                pendiente += os.read(self._maestro, 1024)
+            except OSError:
+                return
+            while pendiente:
+                if pendiente[0] == ENQ:
+                    del pendiente[0]
+                    self._responder(self._trama_estado())
+                elif pendiente[0] == STX:
+                    fin = pendiente.find(bytes([ETX]))
+                    if fin < 0 or len(pendiente) < fin + 2:
+                        break  # Trama incompleta: esperar más bytes
+                    cuerpo, lrc = bytes(pendiente[1:fin + 1]), pendiente[fin + 1]
+                    del pendiente[:fin + 2]
+                    if lrc != calcular_lrc(cuerpo) or random.random() < self.probabilidad_nak:
+                        self._responder(bytes([NAK]))
+                        continue
+                    self._procesar_comando(cuerpo[:-1].decode("latin-1"))
+                    self._responder(bytes([ACK]))
+                else:
+                    del pendiente[0]  # Ruido fuera de trama
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulador de impresora fiscal TFHKA sobre un pty.")
+    parser.add_argument("--status", type=int, default=4, help="Código de estado a reportar (STATUS_CODES).")
+    parser.add_argument("--error", type=int, default=0, help="Código de error a reportar (ERROR_CODES que envía la impresora: 0-3 o 80-112).")
+    parser.add_argument("--probabilidad-nak", type=float, default=0.0, help="Probabilidad de rechazar una trama válida.")
+    parser.add_argument("--demora-ms", type=float, default=0.0, help="Demora antes de cada respuesta.")
+    args = parser.parse_args()
+
+    emulador = EmuladorTfhka(args.status, args.error, args.probabilidad_nak, args.demora_ms / 1000)
+    print(f"Emulador TFHKA escuchando en: {emulador.iniciar()}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulador.detener()
+        print(f"Comandos recibidos: {len(emulador.comandos_recibidos)}")
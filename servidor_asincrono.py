@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""Modo de servicio asíncrono (asyncio) para hosts con muchos terminales fiscales.
+
+Con app.run(threaded=True) cada solicitud ocupa un hilo del sistema, y casi todos esos hilos
+pasan el tiempo bloqueados en subprocess.run o en las pausas entre reintentos. Este servidor
+atiende HTTP con uvicorn (ASGI) en un bucle de eventos:
+
+* Las rutas fiscales (factura, reporte, estado y prueba) son corrutinas. El ejecutable fiscal se
+  lanza con asyncio.create_subprocess_exec y los reintentos esperan con asyncio.sleep, así que mil
+  facturas en curso cuestan mil corrutinas, no mil hilos.
+* El resto de las rutas (tickera, /trabajos, /metrics, /diagnostico...) las atiende la misma
+  aplicación Flask, con un adaptador WSGI mínimo, en un pool pequeño de hilos, igual que las
+  llamadas bloqueantes que quedan (pyusb, el driver serial, la escritura con fsync del archivo
+  de comandos).
+
+Las URLs y los JSON de respuesta son los mismos que en servidor_impresion_adaptado.py: las rutas se
+resuelven con el url_map de Flask y la validación de la salida del ejecutable es compartida.
+
+Requiere: pip install uvicorn
+
+Uso:
+    python servidor_asincrono.py --puerto 5000
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import io
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl, urlsplit
+
+import uvicorn
+from werkzeug.exceptions import HTTPException
+
+import servidor_impresion_adaptado as servidor
+from servidor_impresion_adaptado import log, log_fiscal, log_estado
+
+HILOS_WSGI = 8                  # Hilos para las rutas que atiende Flask (tickera, consultas, /metrics)
+HILOS_BLOQUEANTES = 4           # Hilos para E/S bloqueante de las rutas fiscales (fsync, driver serial)
+MAX_CUERPO_BYTES = 1024 * 1024  # Solicitudes más grandes se rechazan con 413
+MAX_CABECERAS_BYTES = 16 * 1024 # Línea de solicitud y cabeceras; más grandes se rechazan con 400
+MAX_CABECERAS = 100             # Más cabeceras se rechazan con 431
+MAX_CONEXIONES = 1000           # Conexiones y solicitudes simultáneas; por encima uvicorn responde 503
+TIMEOUT_LECTURA_SEG = 10        # Plazo para recibir cada parte del cuerpo (vencido responde 408)
+TIMEOUT_INACTIVIDAD_SEG = 5     # Conexión keep-alive sin una nueva solicitud: se cierra
+HILOS_LOCKS = 64                # Hilos que esperan el lock de una impresora tomado por la cola fiscal o el sondeo
+
+ejecutor_wsgi = None
+ejecutor_bloqueante = None
+ejecutor_locks = None
+locks_asincronos = {}
+
+
+class SolicitudAsincrona:
+
+    def __init__(self, metodo, destino, cabeceras, cuerpo, cliente):
+        partes = urlsplit(destino)
+        self.metodo = metodo
+        self.ruta = partes.path
+        self.query = partes.query
+        self.args = dict(parse_qsl(partes.query, keep_blank_values=True))
+        self.cabeceras = cabeceras  # Lista de (nombre, valor) tal como llegaron
+        self.cuerpo = cuerpo
+        self.cliente = cliente
+
+    def cabecera(self, nombre, por_defecto=None):
+        nombre = nombre.lower()
+        for clave, valor in self.cabeceras:
+            if clave.lower() == nombre: return valor
+        return por_defecto
+
+    def leer_json(self):
+        """Devuelve el JSON del cuerpo o lanza ValueError si Flask no lo aceptaría como JSON."""
+        tipo = self.cabecera("Content-Type", "").split(";")[0].strip().lower()
+        if tipo != "application/json" and not tipo.endswith("+json"):
+            raise ValueError("El cuerpo no es JSON.")
+        return servidor.app.json.loads(self.cuerpo)
+
+
+async def en_hilo(ejecutor, funcion, *args):
+    # Conserva el contexto de logging (terminal, trabajo) en el hilo
+    contexto = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(ejecutor, functools.partial(contexto.run, funcion, *args))
+
+
+# --- EJECUCIÓN FISCAL ASÍNCRONA ---
+
+async def adquirir_lock_en_hilo(impresora_lock, limite):
+    """Toma el Lock de la impresora (que también usan la cola fiscal y el sondeo) esperando en un hilo de
+    ejecutor_locks, sin ocupar el bucle de eventos. Devuelve False si se llegó a 'limite'."""
+    if impresora_lock.acquire(blocking=False): return True
+    espera = -1 if limite is None else max(0, limite - time.perf_counter())
+    futuro = asyncio.get_running_loop().run_in_executor(ejecutor_locks, impresora_lock.acquire, True, espera)
+    try:
+        return await asyncio.shield(futuro)
+    except asyncio.CancelledError:
+        # La corrutina se canceló pero el hilo sigue esperando: si llega a tomar el lock, se libera
+        def liberar_si_tomado(f):
+            if not f.cancelled() and f.exception() is None and f.result(): impresora_lock.release()
+        futuro.add_done_callback(liberar_si_tomado)
+        raise
+
+@asynccontextmanager
+async def bloqueo_impresora_async(terminal_uuid):
+    """Equivalente de bloqueo_impresora para corrutinas. Las solicitudes del mismo terminal esperan en un
+    asyncio.Lock (sin ocupar hilos); la que pasa toma además el Lock compartido con la cola fiscal y el sondeo.
+    Aplica los mismos límites de admisión (LOCK_MAXIMO_EN_ESPERA, LOCK_ESPERA_MAXIMA_SEG) y la misma fila."""
+    servidor.admitir_en_circuito(terminal_uuid)
+    lock_asincrono = locks_asincronos.setdefault(terminal_uuid, asyncio.Lock())
+    impresora_lock = servidor.obtener_lock_impresora(terminal_uuid)
+    t_inicio = time.perf_counter()
+    limite = t_inicio + servidor.LOCK_ESPERA_MAXIMA_SEG if servidor.LOCK_ESPERA_MAXIMA_SEG else None
+    servidor.admitir_espera_lock(terminal_uuid)
+    try:
+        await asyncio.wait_for(lock_asincrono.acquire(), None if limite is None else limite - time.perf_counter())
+        try:
+            if not await adquirir_lock_en_hilo(impresora_lock, limite): raise asyncio.TimeoutError
+        except BaseException:
+            lock_asincrono.release()
+            raise
+    except asyncio.TimeoutError:
+        servidor.liberar_espera_lock(terminal_uuid)
+        raise servidor.rechazo_por_espera(terminal_uuid, time.perf_counter() - t_inicio) from None
+    except BaseException:
+        servidor.liberar_espera_lock(terminal_uuid)
+        raise
+    servidor.liberar_espera_lock(terminal_uuid)
+    espera = time.perf_counter() - t_inicio
+    t_tomado = time.perf_counter()
+    try:
+        servidor.METRICA_ESPERA_LOCK.observar(espera, terminal_uuid)
+        servidor.METRICA_EN_CURSO.incrementar(terminal_uuid)
+        try:
+            yield {"espera_lock_ms": round(espera * 1000, 1)}
+        finally:
+            servidor.METRICA_EN_CURSO.incrementar(terminal_uuid, cantidad=-1)
+            servidor.registrar_retencion_lock(terminal_uuid, time.perf_counter() - t_tomado)
+    finally:
+        impresora_lock.release()
+        lock_asincrono.release()
+
+async def ejecutar_con_ejecutable_async(comando_base, argumento, fiscal_dir, lineas_esperadas=None, retry_delay=0.3):
+    tfin_path, comando_completo = servidor.armar_comando_ejecutable(comando_base, argumento, fiscal_dir)
+    log_fiscal.info(f"Ejecutando en [{fiscal_dir}]: {' '.join(comando_completo)}", extra={"etapa": "ejecucion"})
+    terminal_uuid = os.path.basename(fiscal_dir)
+
+    intentos_maximos = servidor.INTENTOS_MAXIMOS_COMANDO_FISCAL
+    limite = time.monotonic() + servidor.PLAZO_COMANDO_FISCAL_SEG
+
+    for intento in range(1, intentos_maximos + 1):
+        try:
+            t_intento = time.perf_counter()
+            try:
+                proceso = await asyncio.create_subprocess_exec(
+                    *comando_completo, cwd=fiscal_dir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                try:
+                    salida_stdout, salida_stderr = await asyncio.wait_for(
+                        proceso.communicate(), min(servidor.TIMEOUT_EJECUTABLE_FISCAL_SEG, max(1, limite - time.monotonic())))
+                except asyncio.TimeoutError:
+                    proceso.kill()
+                    await proceso.wait()
+                    raise
+            finally:
+                servidor.METRICA_INTENTO.observar(time.perf_counter() - t_intento, terminal_uuid, comando_base, "ejecutable")
+            return servidor.interpretar_salida_ejecutable(comando_base, fiscal_dir, lineas_esperadas, intento, proceso.returncode,
+                                                          salida_stdout.decode("latin-1"), salida_stderr.decode("latin-1"))
+
+        except asyncio.TimeoutError as e:
+            servidor.METRICA_TIMEOUTS.incrementar(terminal_uuid)
+            raise servidor.TimeoutComandoFiscal(f"Timeout: La impresora en {fiscal_dir} no respondió.") from e
+        except FileNotFoundError as e:
+            raise servidor.SinConexionFiscalError(f"EJECUTABLE NO ENCONTRADO en {tfin_path}. Verifica la configuración.") from e
+        except OSError as e:
+            raise servidor.SinConexionFiscalError(f"No se pudo lanzar el ejecutable {tfin_path}: {e}") from e
+        except Exception as e:
+            if isinstance(e, servidor.EnvioParcialError) and e.comandos_enviados > 0:
+                log_fiscal.error(f"Envío parcial en el intento {intento}; no se reintenta.", extra={"etapa": "ejecucion", "intento": intento})
+                raise
+            espera = servidor.espera_reintento(intento, retry_delay)
+            if intento < intentos_maximos and time.monotonic() + espera < limite:
+                log_fiscal.warning(f"Error en intento {intento}: {e}. Reintentando en {espera:.2f}s...", extra={"etapa": "ejecucion", "intento": intento})
+                servidor.METRICA_REINTENTOS.incrementar(terminal_uuid)
+                await asyncio.sleep(espera)
+            else:
+                log_fiscal.error(f"Error final tras {intento} intentos.", extra={"etapa": "ejecucion", "intento": intento})
+                raise
+
+    raise Exception(f"Se alcanzó el final de la función ejecutar_comando_fiscal inesperadamente para {fiscal_dir}.")
+
+async def ejecutar_comando_fiscal_async(comando_base, argumento, fiscal_dir, lineas_esperadas=None, retry_delay=0.3):
+    terminal_uuid = os.path.basename(fiscal_dir)
+    if servidor.comprobar_circuito(terminal_uuid):
+        await en_hilo(ejecutor_bloqueante, servidor.sondear_circuito, terminal_uuid, fiscal_dir)
+    try:
+        if servidor.obtener_driver_fiscal(terminal_uuid) is not None:
+            # El driver serial es E/S bloqueante: se usa (con su respaldo por ejecutable) desde un hilo
+            resultado = await en_hilo(ejecutor_bloqueante, servidor.ejecutar_comando_fiscal_sin_circuito,
+                                      comando_base, argumento, fiscal_dir, lineas_esperadas, retry_delay)
+        else:
+            resultado = await ejecutar_con_ejecutable_async(comando_base, argumento, fiscal_dir, lineas_esperadas, retry_delay)
+    except Exception as e:
+        servidor.registrar_fallo_circuito(terminal_uuid, e)
+        raise
+    servidor.registrar_resultado_circuito(terminal_uuid)
+    return resultado
+
+async def enviando_async(diario):
+    # Se espera a que 'enviando' esté en disco sin bloquear el bucle de eventos
+    await asyncio.wrap_future(diario.anotar_enviando())
+    diario.enviado = True
+
+async def procesar_factura_fiscal_async(terminal_uuid, fiscal_dir, comandos, trabajo_id):
+    with servidor.TrabajoEnDiario(trabajo_id, terminal_uuid, "factura", comandos=len(comandos)) as diario:
+        ruta_archivo_completa = await en_hilo(ejecutor_bloqueante, servidor.escribir_archivo_comandos, fiscal_dir, trabajo_id, "\n".join(comandos))
+        diario.archivo(ruta_archivo_completa)
+        try:
+            await enviando_async(diario)
+            return await ejecutar_comando_fiscal_async("SendFileCmd", ruta_archivo_completa, fiscal_dir, lineas_esperadas=len(comandos))
+        finally:
+            await en_hilo(ejecutor_bloqueante, servidor.retirar_archivo_comandos, fiscal_dir, ruta_archivo_completa)
+
+def _borrar_si_existe(ruta):
+    if os.path.exists(ruta): os.remove(ruta)
+
+async def leer_estado_fiscal_async(fiscal_dir):
+    ruta_completa_estado = os.path.join(fiscal_dir, f"estado_{uuid.uuid4().hex}.txt")
+    try:
+        resultado = await ejecutar_comando_fiscal_async("ReadFpStatus", ruta_completa_estado, fiscal_dir)
+        estado = await en_hilo(ejecutor_bloqueante, servidor.interpretar_estado_fiscal, resultado, ruta_completa_estado)
+        error = servidor.error_de_estado(estado)
+        if error: servidor.registrar_resultado_circuito(os.path.basename(fiscal_dir), error, inmediato=True)
+        return estado
+    finally:
+        await en_hilo(ejecutor_bloqueante, _borrar_si_existe, ruta_completa_estado)
+
+
+# --- RUTAS FISCALES ASÍNCRONAS (MISMO CONTRATO QUE LAS RUTAS FLASK) ---
+# Cada ruta devuelve (cuerpo, código HTTP, cabeceras).
+
+async def procesar_solicitud_factura_fiscal_async(data, en_cola):
+    if en_cola: return servidor.procesar_solicitud_factura_fiscal(data, True)  # Encolar no bloquea
+    try:
+        terminal_uuid = data.get("terminalUUID")
+        fiscal_dir = servidor.get_and_validate_fiscal_dir(terminal_uuid)
+        comandos = servidor.generar_comandos_factura(data)
+        trabajo_id = uuid.uuid4().hex
+        with servidor.contexto_log(terminal=terminal_uuid, trabajo=trabajo_id):
+            async with bloqueo_impresora_async(terminal_uuid) as bloqueo:
+                log_fiscal.info("[LOCK ADQUIRIDO] Iniciando factura", extra={"etapa": "lock"})
+                respuesta = await procesar_factura_fiscal_async(terminal_uuid, fiscal_dir, comandos, trabajo_id)
+                log_fiscal.info("[LOCK LIBERADO] Factura procesada", extra={"etapa": "lock"})
+        return {"message": f"Factura para UUID [{terminal_uuid}] enviada.", "respuesta_impresora": respuesta.get('mensaje'), **bloqueo}, 200, {}
+    except servidor.ImpresoraNoDisponibleError as e:
+        return servidor.respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e:
+        return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_fiscal.exception(f"Error procesando factura: {e}", extra={"terminal": data.get('terminalUUID')})
+        return {"error": f"Error crítico procesando para UUID [{data.get('terminalUUID')}]: {str(e)}", **servidor.detalle_incierto(e)}, 500, {}
+
+async def imprimir_factura_fiscal(solicitud, data):
+    if not data: return {"error": "No se recibieron datos"}, 400, {}
+    en_cola = servidor.COLA_FISCAL_ACTIVA or solicitud.args.get('modo') == 'cola'
+
+    clave = solicitud.cabecera('Idempotency-Key')
+    if not clave:
+        return await procesar_solicitud_factura_fiscal_async(data, en_cola)
+
+    huella = servidor.huella_factura(data)
+    entrada, propia = await en_hilo(ejecutor_bloqueante, servidor.reservar_idempotencia, clave, huella, data.get("terminalUUID"))
+    if not propia:
+        log_fiscal.info(f"Idempotency-Key '{clave}' repetida; no se vuelve a imprimir.", extra={"terminal": data.get("terminalUUID")})
+        if entrada["huella"] == huella:
+            # La original puede estar en curso en un hilo (modo Flask o cola): se la espera sin ocupar el bucle
+            await asyncio.get_running_loop().run_in_executor(ejecutor_locks, entrada["_evento"].wait, servidor.IDEMPOTENCIA_ESPERA_SEG)
+        return servidor.responder_duplicado(entrada, huella, espera=0)
+
+    respuesta, codigo, cabeceras = {"error": "La solicitud se interrumpió."}, 500, {}
+    try:
+        respuesta, codigo, cabeceras = await procesar_solicitud_factura_fiscal_async(data, en_cola)
+    finally:
+        await en_hilo(ejecutor_bloqueante, servidor.completar_idempotencia, clave, entrada, respuesta, codigo)
+    return respuesta, codigo, cabeceras
+
+async def imprimir_reporte_fiscal(solicitud, data):
+    if not data: return {"error": "No se recibieron datos"}, 400, {}
+    try:
+        terminal_uuid = data.get("terminalUUID"); tipo_reporte = data.get('tipo', '').upper()
+        fiscal_dir = servidor.get_and_validate_fiscal_dir(terminal_uuid)
+        if tipo_reporte not in ['X', 'Z']: return {"error": "Tipo de reporte no válido. Use 'X' o 'Z'."}, 400, {}
+        trabajo_id = uuid.uuid4().hex
+        with servidor.contexto_log(terminal=terminal_uuid, trabajo=trabajo_id):
+            async with bloqueo_impresora_async(terminal_uuid) as bloqueo:
+                log_fiscal.info(f"[LOCK ADQUIRIDO] Reporte {tipo_reporte}", extra={"etapa": "lock"})
+                comando_impresora = 'I0X' if tipo_reporte == 'X' else 'I0Z'
+                with servidor.TrabajoEnDiario(trabajo_id, terminal_uuid, "reporte", reporte=tipo_reporte) as diario:
+                    await enviando_async(diario)
+                    respuesta = await ejecutar_comando_fiscal_async("SendCmd", comando_impresora, fiscal_dir)
+                log_fiscal.info(f"[LOCK LIBERADO] Reporte {tipo_reporte} procesado", extra={"etapa": "lock"})
+        return {"message": f"Reporte '{tipo_reporte}' enviado a UUID [{terminal_uuid}].", "respuesta_impresora": respuesta.get('mensaje'), **bloqueo}, 200, {}
+    except servidor.ImpresoraNoDisponibleError as e: return servidor.respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e: return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_fiscal.exception(f"Error imprimiendo reporte: {e}", extra={"terminal": data.get('terminalUUID')})
+        return {"error": f"Error crítico imprimiendo reporte para UUID [{data.get('terminalUUID')}]: {str(e)}"}, 500, {}
+
+async def estado_impresora_fiscal(solicitud, terminal_uuid):
+    try:
+        fiscal_dir = servidor.get_and_validate_fiscal_dir(terminal_uuid)
+
+        if solicitud.args.get('fresh') not in ('1', 'true'):
+            estado = servidor.estado_en_cache_vigente(terminal_uuid)
+            if estado is not None: return estado, 200, {}
+
+        async with bloqueo_impresora_async(terminal_uuid) as bloqueo:
+            try:
+                estado = await leer_estado_fiscal_async(fiscal_dir)
+            except Exception as e:
+                servidor.guardar_estado_en_cache(terminal_uuid, error=str(e))
+                raise
+            servidor.guardar_estado_en_cache(terminal_uuid, estado=estado)
+        return dict(estado, age_ms=0, **bloqueo), 200, {}
+
+    except servidor.ImpresoraNoDisponibleError as e:
+        return servidor.respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e:
+        return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_estado.exception(f"Error obteniendo estado: {e}", extra={"terminal": terminal_uuid})
+        return {"error": f"Error obteniendo estado de UUID [{terminal_uuid}]: {str(e)}"}, 500, {}
+
+async def test_fiscal(solicitud, terminal_uuid):
+    try:
+        fiscal_dir = servidor.get_and_validate_fiscal_dir(terminal_uuid)
+        # El comando 'D' es un comando de diagnóstico simple.
+        respuesta = await ejecutar_comando_fiscal_async("SendCmd", "D", fiscal_dir)
+        return {
+            "message": f"Comando de prueba enviado exitosamente a UUID [{terminal_uuid}].",
+            "respuesta_impresora": respuesta.get('mensaje')
+        }, 200, {}
+    except servidor.ImpresoraNoDisponibleError as e:
+        return servidor.respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e:
+        return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_fiscal.exception(f"Error en la prueba fiscal: {e}", extra={"terminal": terminal_uuid})
+        return {"error": f"Error en la prueba fiscal para UUID [{terminal_uuid}]: {str(e)}"}, 500, {}
+
+# Endpoint de Flask -> (corrutina, ¿recibe el JSON del cuerpo?)
+RUTAS_ASINCRONAS = {
+    "imprimir_factura_fiscal": (imprimir_factura_fiscal, True),
+    "imprimir_reporte_fiscal": (imprimir_reporte_fiscal, True),
+    "estado_impresora_fiscal": (estado_impresora_fiscal, False),
+    "test_fiscal": (test_fiscal, False),
+}
+
+
+# --- SERVIDOR ASGI (UVICORN) ---
+# uvicorn se encarga de HTTP/1.1 (keep-alive, límites de cabeceras y de conexiones) y llama a 'aplicacion'.
+# Las rutas de RUTAS_ASINCRONAS se atienden aquí; el resto pasa a Flask con un adaptador WSGI propio. uvicorn no
+# pone plazo a las cabeceras de un cliente lento: expuesto a redes no confiables, conviene un proxy inverso delante.
+
+def armar_environ(scope, cuerpo):
+    """environ WSGI (PEP 3333) de una solicitud ASGI cuyo cuerpo ya se leyó completo."""
+    servidor_http = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": servidor_http[0], "SERVER_PORT": str(servidor_http[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": (scope.get("client") or ("",))[0],
+        "CONTENT_LENGTH": str(len(cuerpo)),  # También si llegó por partes (chunked)
+        "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"), "wsgi.input": io.BytesIO(cuerpo),
+        "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    for nombre, valor in scope["headers"]:
+        nombre, valor = nombre.decode("latin-1").upper().replace("-", "_"), valor.decode("latin-1")
+        if nombre == "CONTENT_LENGTH": continue
+        clave = nombre if nombre == "CONTENT_TYPE" else f"HTTP_{nombre}"
+        environ[clave] = f"{environ[clave]},{valor}" if clave in environ else valor
+    return environ
+
+async def atender_con_flask(scope, cuerpo, receive, send):
+    """Corre la app de Flask en el pool ejecutor_wsgi y envía su respuesta parte por parte, así las respuestas
+    NDJSON salen a medida que se generan. Si el cliente se desconecta se deja de pedir partes y se cierra el
+    iterador de la respuesta (lo que detiene, por ejemplo, los reportes que aún no empezaron)."""
+    loop = asyncio.get_running_loop()
+    inicio = {}
+    def start_response(estado, cabeceras, exc_info=None):
+        inicio.update(codigo=int(estado.split(" ", 1)[0]), cabeceras=cabeceras)
+    # Flask llama a start_response antes de devolver el cuerpo
+    respuesta = await loop.run_in_executor(ejecutor_wsgi, servidor.app.wsgi_app, armar_environ(scope, cuerpo), start_response)
+    desconexion = asyncio.ensure_future(receive())  # Con el cuerpo ya leído, solo vuelve si el cliente se va
+    try:
+        await send({"type": "http.response.start", "status": inicio["codigo"],
+                    "headers": [(nombre.encode("latin-1"), valor.encode("latin-1")) for nombre, valor in inicio["cabeceras"]]})
+        partes = iter(respuesta)
+        while not desconexion.done():
+            parte = await loop.run_in_executor(ejecutor_wsgi, next, partes, None)
+            if parte is None: break
+            if parte: await send({"type": "http.response.body", "body": parte, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        desconexion.cancel()
+        if hasattr(respuesta, "close"): await loop.run_in_executor(ejecutor_wsgi, respuesta.close)
+
+async def leer_cuerpo(receive):
+    """Cuerpo completo de la solicitud (None si el cliente se desconectó). OverflowError si pasa de MAX_CUERPO_BYTES;
+    asyncio.TimeoutError si una parte tarda más de TIMEOUT_LECTURA_SEG."""
+    partes, largo = [], 0
+    while True:
+        mensaje = await asyncio.wait_for(receive(), TIMEOUT_LECTURA_SEG)
+        if mensaje["type"] == "http.disconnect": return None
+        parte = mensaje.get("body", b"")
+        largo += len(parte)
+        if largo > MAX_CUERPO_BYTES: raise OverflowError(largo)
+        partes.append(parte)
+        if not mensaje.get("more_body"): return b"".join(partes)
+
+async def responder(send, codigo, cabeceras, datos=b""):
+    await send({"type": "http.response.start", "status": codigo,
+                "headers": [(nombre.encode("latin-1"), str(valor).encode("latin-1")) for nombre, valor in cabeceras]})
+    await send({"type": "http.response.body", "body": datos})
+
+async def responder_nativo(solicitud, scope, receive, send, endpoint, argumentos):
+    corrutina, recibe_json = RUTAS_ASINCRONAS[endpoint]
+    t_inicio = time.perf_counter()
+    if recibe_json:
+        try:
+            data = solicitud.leer_json()
+        except ValueError:
+            # Cuerpo que no es JSON válido: Flask genera la misma respuesta de error de siempre
+            return await atender_con_flask(scope, solicitud.cuerpo, receive, send)
+        cuerpo, codigo, extra = await corrutina(solicitud, data)
+        terminal = (data or {}).get("terminalUUID") if isinstance(data, dict) else None
+    else:
+        cuerpo, codigo, extra = await corrutina(solicitud, **argumentos)
+        terminal = argumentos.get("terminal_uuid")
+    datos = servidor.app.json.response(cuerpo).get_data()  # Mismo formato que jsonify
+    cabeceras = [("Content-Type", "application/json"), ("Content-Length", len(datos))] + list(extra.items())
+    origen = solicitud.cabecera("Origin")
+    if origen: cabeceras += [("Access-Control-Allow-Origin", origen), ("Vary", "Origin")]  # Como flask_cors
+    await responder(send, codigo, cabeceras, datos if solicitud.metodo != "HEAD" else b"")
+    # Solo terminales conocidos, igual que en las rutas Flask
+    terminal = terminal if terminal in servidor.printer_locks else ""
+    servidor.METRICA_SOLICITUD.observar(time.perf_counter() - t_inicio, endpoint, terminal, codigo)
+
+async def aplicacion(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await atender_ciclo_de_vida(receive, send)
+    if scope["type"] != "http": return
+    if len(scope["headers"]) > MAX_CABECERAS:
+        return await responder(send, 431, [("Content-Length", 0), ("Connection", "close")])
+    try:
+        cuerpo = await leer_cuerpo(receive)
+    except OverflowError:
+        return await responder(send, 413, [("Content-Length", 0), ("Connection", "close")])
+    except asyncio.TimeoutError:
+        return await responder(send, 408, [("Content-Length", 0), ("Connection", "close")])
+    if cuerpo is None: return
+    destino = scope["path"] + (f"?{scope['query_string'].decode('latin-1')}" if scope["query_string"] else "")
+    solicitud = SolicitudAsincrona(scope["method"], destino, [(n.decode("latin-1"), v.decode("latin-1")) for n, v in scope["headers"]],
+                                   cuerpo, (scope.get("client") or ("",))[0])
+    try:
+        endpoint, argumentos = servidor.app.url_map.bind("localhost").match(solicitud.ruta, method=solicitud.metodo)
+    except HTTPException:
+        endpoint, argumentos = None, {}  # 404, 405 y OPTIONS de CORS los responde Flask
+    if endpoint in RUTAS_ASINCRONAS and solicitud.metodo != "OPTIONS":
+        await responder_nativo(solicitud, scope, receive, send, endpoint, argumentos)
+    else:
+        await atender_con_flask(scope, cuerpo, receive, send)
+
+def iniciar_ejecutores():
+    global ejecutor_wsgi, ejecutor_bloqueante, ejecutor_locks
+    if ejecutor_wsgi is not None: return
+    ejecutor_wsgi = ThreadPoolExecutor(max_workers=HILOS_WSGI, thread_name_prefix="async-wsgi")
+    ejecutor_bloqueante = ThreadPoolExecutor(max_workers=HILOS_BLOQUEANTES, thread_name_prefix="async-bloqueante")
+    ejecutor_locks = ThreadPoolExecutor(max_workers=HILOS_LOCKS, thread_name_prefix="async-lock")
+    servidor.iniciar_servicios_segundo_plano()
+
+async def atender_ciclo_de_vida(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "lifespan.startup":
+            iniciar_ejecutores()
+            await send({"type": "lifespan.startup.complete"})
+        elif mensaje["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def servir(host, puerto):
+    configuracion = uvicorn.Config(aplicacion, host=host, port=puerto, http="h11", lifespan="on", log_config=None,
+                                   access_log=False, timeout_keep_alive=TIMEOUT_INACTIVIDAD_SEG,
+                                   h11_max_incomplete_event_size=MAX_CABECERAS_BYTES, limit_concurrency=MAX_CONEXIONES)
+    log.info(f"Iniciando servidor de impresión ASÍNCRONO en http://{host}:{puerto} "
+             f"(hilos WSGI: {HILOS_WSGI}, hilos para E/S bloqueante: {HILOS_BLOQUEANTES})")
+    await uvicorn.Server(configuracion).serve()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidor de impresión en modo asíncrono (asyncio).")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=5000)
+    parser.add_argument("--hilos-wsgi", type=int, default=HILOS_WSGI, help="Hilos para las rutas no fiscales.")
+    parser.add_argument("--hilos-bloqueantes", type=int, default=HILOS_BLOQUEANTES, help="Hilos para fsync y el driver serial.")
+    args = parser.parse_args()
+    HILOS_WSGI, HILOS_BLOQUEANTES = args.hilos_wsgi, args.hilos_bloqueantes
+    try:
+        asyncio.run(servir(args.host, args.puerto))
+    except KeyboardInterrupt:
+        pass
@@ -1,40 +1,145 @@
 # -*- coding: latin-1 -*-
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-from escpos.printer import Usb
+from escpos.printer import Usb, Dummy
+from escpos.capabilities import Profile, get_profile
+from PIL import Image
+import qrcode
 import usb.core
 import usb.util
 import subprocess
 import os
-import traceback
+import logging
+import logging.handlers
+import contextvars
+import copy
+import json
+import random
+import sys
+import atexit
 import re
+import hashlib
+import bisect
+import math
 from datetime import datetime
 import uuid
-from threading import Lock
+from threading import Lock, Thread, Event, Timer, Condition
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturoTimeoutError
+from collections import deque, OrderedDict
+import queue
 import time
 import platform # <-- Importado para detectar el sistema operativo
+import signal
+import threading
+from driver_tfhka import DriverTfhka, ErrorDriverTfhka
+from codificador_fiscal import CodificadorFiscal
 
 # --- Configuración General ---
 app = Flask(__name__)
 CORS(app)
 
+# --- REGISTRO DE EVENTOS (LOGGING ESTRUCTURADO) ---
+# Cada hilo solo deja el registro en una cola en memoria; un hilo aparte lo escribe en stderr como
+# una línea JSON. Así, quien tiene tomado el lock de una impresora nunca espera por la consola o journald.
+NIVEL_LOG = "INFO"
+# Nivel por módulo: "servidor.fiscal", "servidor.usb", "servidor.estado" o "servidor" (el resto)
+NIVELES_LOG_POR_MODULO = {}
+LOG_COLA_MAXIMA = 10000            # Registros pendientes de escribir; si se llena, los nuevos se descartan
+LOG_MAX_CARACTERES = 2000          # Mensajes y salidas más largos se truncan
+LOG_MUESTREO_SALIDAS_LARGAS = 0.1  # Fracción de salidas largas (STDOUT del ejecutable) que se registran
+
+contexto_log_actual = contextvars.ContextVar("contexto_log", default={})
+
+@contextmanager
+def contexto_log(**campos):
+    """Agrega campos (terminal, trabajo, etapa...) a todos los registros emitidos dentro del bloque."""
+    token = contexto_log_actual.set({**contexto_log_actual.get(), **campos})
+    try:
+        yield
+    finally:
+        contexto_log_actual.reset(token)
+
+def _truncar(texto):
+    texto = str(texto)
+    if len(texto) <= LOG_MAX_CARACTERES: return texto
+    return f"{texto[:LOG_MAX_CARACTERES]}... [{len(texto) - LOG_MAX_CARACTERES} caracteres omitidos]"
+
+class ManejadorColaLog(logging.handlers.QueueHandler):
+    """Encola el registro sin bloquear nunca. Corre en el hilo que registra, así que hace lo mínimo."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        for campo, valor in contexto_log_actual.get().items():
+            if not hasattr(record, campo): setattr(record, campo, valor)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICA_LOG_DESCARTADOS.incrementar()
+
+class FormateadorJson(logging.Formatter):
+    CAMPOS = ("terminal", "trabajo", "etapa", "dispositivo", "intento", "duracion_ms")
+
+    def format(self, record):
+        entrada = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "nivel": record.levelname, "modulo": record.name, "hilo": record.threadName,
+            "mensaje": _truncar(record.msg),
+        }
+        for campo in self.CAMPOS:
+            valor = getattr(record, campo, None)
+            if valor is not None: entrada[campo] = valor
+        salida = getattr(record, "salida", None)
+        if salida:
+            if len(salida) <= LOG_MAX_CARACTERES or random.random() < LOG_MUESTREO_SALIDAS_LARGAS:
+                entrada["salida"] = _truncar(salida)
+            else:
+                entrada["salida_omitida_caracteres"] = len(salida)
+        if record.exc_info:
+            entrada["traza"] = self.formatException(record.exc_info)
+        return json.dumps(entrada, ensure_ascii=False)
+
+def configurar_logging():
+    cola = queue.Queue(maxsize=LOG_COLA_MAXIMA)
+    escritor = logging.StreamHandler(sys.stderr)
+    escritor.setFormatter(FormateadorJson())
+    raiz = logging.getLogger("servidor")
+    raiz.setLevel(NIVEL_LOG)
+    raiz.addHandler(ManejadorColaLog(cola))
+    raiz.propagate = False
+    for modulo, nivel in NIVELES_LOG_POR_MODULO.items():
+        logging.getLogger(modulo).setLevel(nivel)
+    oyente = logging.handlers.QueueListener(cola, escritor)
+    oyente.start()
+    atexit.register(oyente.stop)  # Vacía la cola al salir
+
+configurar_logging()
+log = logging.getLogger("servidor")
+log_fiscal = logging.getLogger("servidor.fiscal")
+log_usb = logging.getLogger("servidor.usb")
+log_estado = logging.getLogger("servidor.estado")
+
 # --- CONFIGURACIÓN DE PLATAFORMA (SE AJUSTA AUTOMÁTICAMENTE) ---
 SISTEMA_OPERATIVO = platform.system()
 
 if SISTEMA_OPERATIVO == "Windows":
-    print("-> Detectado sistema operativo Windows.")
+    log.info("-> Detectado sistema operativo Windows.")
     # IMPORTANTE: Cambia "Tfhka.exe" si tu ejecutable tiene otro nombre (ej. tfin.exe)
     EXECUTABLE_FISCAL = "IntTFHKA" 
     # IMPORTANTE: Cambia esta ruta a la carpeta base donde están las subcarpetas de las impresoras.
     BASE_FISCAL_PATH = "C:\\ServidorFiscal" 
 else:
-    print("-> Detectado sistema operativo Linux.")
+    log.info("-> Detectado sistema operativo Linux.")
     EXECUTABLE_FISCAL = "tfinulx"
     USER = "zante" # Mantenemos tu configuración original para Linux
     BASE_FISCAL_PATH = f"/home/{USER}"
 
-print(f"Ruta base para impresoras fiscales: {BASE_FISCAL_PATH}")
-print(f"Ejecutable fiscal a utilizar: {EXECUTABLE_FISCAL}")
+log.info(f"Ruta base para impresoras fiscales: {BASE_FISCAL_PATH}")
+log.info(f"Ejecutable fiscal a utilizar: {EXECUTABLE_FISCAL}")
 
 
 # --- CONFIGURACIÓN PARA IMPRESORA NO FISCAL (USB DIRECTO) ---
@@ -44,6 +149,49 @@ print(f"Ejecutable fiscal a utilizar: {EXECUTABLE_FISCAL}")
 VENDOR_ID = 0x0483
 PRODUCT_ID = 0x5743
 ANCHO_TICKET = 42
+# La tickera se mantiene abierta entre trabajos y un único hilo escribe en ella.
+USB_INTENTOS_RECONEXION = 2      # Intentos por trabajo si el handle USB resulta inválido (USBError)
+USB_INTERVALO_SONDEO_SEG = 30    # Si no hay trabajos, se verifica el handle cada tantos segundos
+USB_TIMEOUT_TRABAJO_SEG = 30     # Tiempo máximo que una solicitud espera a que su ticket se imprima
+
+# --- VARIAS TICKERAS (OPCIONAL) ---
+# Registro de tickeras por nombre; cada una tiene su propia conexión, cola e hilo escritor, así que
+# la cocina, la barra y la caja imprimen en paralelo. Si hay varias del mismo modelo se distinguen
+# por número de serie o por bus/dirección USB:
+#   DISPOSITIVOS_TICKET = {
+#       "caja":   {"vendor_id": 0x0483, "product_id": 0x5743},
+#       "cocina": {"vendor_id": 0x0416, "product_id": 0x5011, "serial": "CK0001"},
+#       "barra":  {"vendor_id": 0x0416, "product_id": 0x5011, "bus": 1, "direccion": 7},
+#   }
+# Si está vacío se usa una sola tickera llamada "tickera" con VENDOR_ID / PRODUCT_ID.
+DISPOSITIVOS_TICKET = {}
+# Ruteo de comandas: la 'estacion' o la 'categoria' de cada ítem elige la tickera, p. ej.
+#   RUTAS_COMANDA = {"bebidas": "barra", "postres": "barra", "cocina": "cocina"}
+# Los ítems sin ruta van a TICKERA_COMANDAS (o a la primera tickera registrada).
+RUTAS_COMANDA = {}
+TICKERA_COMANDAS = None
+TICKERA_RECIBOS = None             # Tickera de /imprimir-factura (por defecto la primera registrada)
+# Agrupación de comandas: las que llegan a una tickera dentro de la ventana se imprimen en un solo trabajo.
+# Con "pedido" se corta el papel entre comandas; con "mesa" las de una misma mesa salen seguidas con un solo corte.
+# 0 desactiva la ventana. Se puede ajustar por tickera en DISPOSITIVOS_TICKET con
+# "ventana_comandas_ms" y "agrupar_comandas", p. ej. {"cocina": {..., "ventana_comandas_ms": 400, "agrupar_comandas": "mesa"}}
+VENTANA_COMANDAS_MS = 0
+AGRUPAR_COMANDAS = "pedido"
+USB_TTL_ENUMERACION_SEG = 60       # Vigencia de la lista de dispositivos USB (se refresca antes si una tickera falla)
+enumeracion_usb = {"t": None, "dispositivos": []}
+enumeracion_usb_lock = Lock()
+
+# --- CACHÉ DE BLOQUES ESC/POS ---
+# Las partes fijas de los tickets (logo, encabezado del comercio, códigos QR, pie) se guardan ya codificadas
+# en ESC/POS, indexadas por un hash de los datos que las generan; cada ticket solo compone lo que cambia y
+# pega los bloques. Al pasar de CACHE_BLOQUES_MAXIMO_BYTES se descartan los menos usados.
+CACHE_BLOQUES_ACTIVA = True
+CACHE_BLOQUES_MAXIMO_BYTES = 8 * 1024 * 1024
+LOGO_TICKET = None                 # Imagen (png/jpg/bmp) que encabeza los recibos de /imprimir-factura; None = sin logo
+LOGO_ANCHO_PUNTOS = 384            # Ancho máximo del logo en puntos: 384 para papel de 58 mm, 512 para 80 mm
+QR_TAMANO_MODULO = 4               # Puntos por módulo de los códigos QR ('qr' del ticket o del comercio)
+# Comercios cuyo encabezado y pie se codifican al arrancar, p. ej. [{"nombre": "Mi Negocio", "rif": "J-12345678-9"}]
+COMERCIOS_PRECALENTAR = []
 
 # --- CONFIGURACIÓN DE IMPUESTOS (IGTF) ---
 IGTF_SLOTS = [20, 21, 22, 23, 24] 
@@ -52,175 +200,1204 @@ IGTF_MODE_ACTIVE = True
 # --- MECANISMO DE BLOQUEO PARA IMPRESORAS FISCALES ---
 printer_locks = {}
 locks_dict_lock = Lock()
+# Admisión al lock de cada impresora: si ya hay LOCK_MAXIMO_EN_ESPERA solicitudes esperando se responde 429;
+# si el lock no se libera en LOCK_ESPERA_MAXIMA_SEG se responde 503. Ambas con 'Retry-After' y la fila actual.
+# 0 desactiva cada límite. La cola fiscal (modo cola) no tiene límite: sus trabajos ya fueron aceptados.
+LOCK_MAXIMO_EN_ESPERA = 10
+LOCK_ESPERA_MAXIMA_SEG = 60
+esperas_lock = {}                     # {terminalUUID: solicitudes esperando el lock}
+duracion_media_lock = {}              # {terminalUUID: segundos que se retiene el lock (media móvil)}
+esperas_lock_lock = Lock()
+
+# --- COLA FISCAL ASÍNCRONA (OPCIONAL) ---
+# Si COLA_FISCAL_ACTIVA es True, /imprimir-factura-fiscal responde 202 con un id de trabajo
+# y la factura la procesa un hilo dedicado por terminalUUID. También se puede pedir por
+# solicitud con '?modo=cola'. El estado se consulta en /trabajos/<id>.
+COLA_FISCAL_ACTIVA = False
+COLA_FISCAL_TAMANO_MAXIMO = 50     # Facturas en espera por terminal antes de rechazar con 503
+TRABAJOS_FISCALES_RETENIDOS = 500  # Trabajos terminados que se conservan en memoria para consulta
+colas_fiscales = {}
+trabajos_fiscales = {}
+trabajos_fiscales_terminados = deque()
+trabajos_lock = Lock()
+
+# --- IDEMPOTENCIA DE FACTURAS FISCALES ---
+# Si la solicitud trae la cabecera 'Idempotency-Key', un reintento con la misma clave no vuelve a
+# imprimir: recibe la respuesta original o espera a que termine la solicitud que sigue en curso.
+# Las claves se guardan en BASE_FISCAL_PATH/ARCHIVO_IDEMPOTENCIA para sobrevivir a un reinicio.
+IDEMPOTENCIA_TTL_SEG = 24 * 3600       # Tiempo que se recuerda cada clave
+IDEMPOTENCIA_MAXIMO_CLAVES = 1000      # Al superarlo se olvidan las claves más antiguas
+IDEMPOTENCIA_ESPERA_SEG = 150          # Cuánto espera un duplicado a que termine la solicitud original
+ARCHIVO_IDEMPOTENCIA = "idempotencia_fiscal.json"
+almacen_idempotencia = OrderedDict()
+idempotencia_cargada = False
+idempotencia_lock = Lock()
+idempotencia_archivo_lock = Lock()
+
+# --- DIARIO DE TRABAJOS FISCALES ---
+# Cada factura, lote y reporte anota su ciclo de vida en BASE_FISCAL_PATH/ARCHIVO_DIARIO_FISCAL (una línea JSON
+# por evento): recibido, archivo, enviando y resultado. 'enviando' queda en disco antes de lanzar el comando, así
+# que tras una caída se sabe qué trabajos pudieron llegar a la impresora. Un solo hilo escribe el diario: lo que se
+# anota mientras hace fsync se escribe junto en el siguiente, con un fsync por grupo y no por trabajo.
+# Al arrancar se relee: lo que no se llegó a enviar se descarta y lo que quedó enviándose se decide con ReadFpStatus
+# (en espera y sin error: cerrado; documento abierto, error o sin respuesta: queda en /trabajos-sin-resolver).
+DIARIO_FISCAL_ACTIVO = True
+ARCHIVO_DIARIO_FISCAL = "diario_fiscal.jsonl"
+DIARIO_COMPACTAR_CERRADOS = 1000      # Se reescribe sin los trabajos cerrados al acumular tantos (0 = solo al arrancar)
+RESOLUCIONES_MANUALES = ("impreso", "no_impreso")
+trabajos_sin_resolver = {}            # {trabajo_id: detalle}
+diario_lock = Lock()
+
+# --- ARCHIVOS DE COMANDOS FISCALES ---
+# Cada factura se escribe en su propio 'factura_<id>.txt' (escritura atómica con rename).
+# Si es True, tras enviarlo se mueve a '<terminalUUID>/auditoria/'; si es False se borra.
+CONSERVAR_ARCHIVOS_FISCALES = False
+# /imprimir-facturas-fiscales/lote junta varias facturas en un solo archivo y un solo SendFileCmd
+LOTE_FISCAL_MAXIMO_FACTURAS = 50
+# /reportes-fiscales imprime el X/Z de varios terminales a la vez con este máximo de hilos
+REPORTES_HILOS_MAXIMOS = 8
+
+# --- BACKEND FISCAL POR TERMINAL ---
+# Por defecto cada comando lanza el ejecutable del fabricante (tfinulx / IntTFHKA).
+# Un terminal puede usar en su lugar el driver nativo por puerto serial (driver_tfhka.py, requiere pyserial):
+#   BACKENDS_FISCALES = {"<terminalUUID>": {"backend": "serial", "puerto": "/dev/ttyUSB0", "baudios": 9600}}
+# Si el puerto no se puede abrir se usa el ejecutable, salvo que se indique "respaldo_ejecutable": False.
+BACKENDS_FISCALES = {}
+drivers_fiscales = {}
+TIMEOUT_EJECUTABLE_FISCAL_SEG = 45  # Tiempo máximo de cada intento del ejecutable
+
+# --- REGISTRO DE TERMINALES ---
+# Al arrancar se revisan las carpetas de BASE_FISCAL_PATH (ejecutable presente y con permiso de ejecución),
+# se crean sus locks, drivers y colas, y se guarda un índice en memoria: las solicitudes validan su
+# terminalUUID sin tocar el disco. El índice se recarga si aparece o desaparece una carpeta o cambia un
+# ejecutable (revisión cada INTERVALO_REVISION_REGISTRO_SEG), con la señal SIGHUP o con GET /terminales?recargar=1.
+REGISTRO_TERMINALES_ACTIVO = True
+INTERVALO_REVISION_REGISTRO_SEG = 10
+registro_terminales = {}              # {terminalUUID: carpeta validada}
+terminales_con_problemas = {}         # {terminalUUID: motivo}
+registro_info = {"actualizado": None, "firma": None}
+registro_lock = Lock()
+evento_recarga_registro = Event()
+
+# --- REINTENTOS Y CORTOCIRCUITO POR IMPRESORA FISCAL ---
+# Los reintentos esperan con backoff exponencial y jitter (retry_delay, 2x, 4x... hasta REINTENTO_ESPERA_MAXIMA_SEG)
+# y nunca pasan de PLAZO_COMANDO_FISCAL_SEG en total, ni de INTENTOS_MAXIMOS_COMANDO_FISCAL intentos.
+INTENTOS_MAXIMOS_COMANDO_FISCAL = 3
+REINTENTO_ESPERA_MAXIMA_SEG = 5
+PLAZO_COMANDO_FISCAL_SEG = 60
+# Tras CIRCUITO_FALLOS_PARA_ABRIR fallos seguidos, un timeout, o un estado con error de papel/comunicación,
+# el circuito del terminal se abre: durante CIRCUITO_ESPERA_SEG las solicitudes fallan al instante con 503
+# y 'Retry-After' en vez de ocupar el lock. Luego la siguiente consulta sondea la impresora con ReadFpStatus
+# (medio abierto) y el circuito se cierra si responde sin error, o vuelve a abrirse.
+CIRCUITO_ACTIVO = True
+CIRCUITO_FALLOS_PARA_ABRIR = 3
+CIRCUITO_ESPERA_SEG = 30
+CIRCUITO_ERRORES_IMPRESORA = (1, 128, 137)  # ERROR_CODES que abren el circuito de inmediato
+circuitos_fiscales = {}
+circuitos_lock = Lock()
+
+# --- SONDEO DE ESTADO FISCAL ---
+# Un hilo consulta ReadFpStatus de cada terminal conocido cada INTERVALO_SONDEO_ESTADO_SEG,
+# solo si la impresora está libre. /estado-impresora-fiscal responde desde esta caché mientras
+# la lectura tenga menos de TTL_CACHE_ESTADO_SEG (o consulta a la impresora con '?fresh=1').
+SONDEO_ESTADO_ACTIVO = True
+INTERVALO_SONDEO_ESTADO_SEG = 10
+TTL_CACHE_ESTADO_SEG = 15
+cache_estado_fiscal = {}
+cache_estado_lock = Lock()
 
 # --- Diccionarios de Códigos (Según el manual TFHKA) ---
-STATUS_CODES = { 4: "En modo fiscal y en espera.", 5: "En modo fiscal y emisión de documentos fiscales.", 6: "En modo fiscal y emisión de documentos no fiscales." }
-ERROR_CODES = { 0: "No hay error.", 1: "Fin en la entrega de papel.", 2: "Error de índole mecánico en la entrega de papel.", 100: "Error de la memoria fiscal.", 108: "Memoria fiscal llena.", 128: "Error en la comunicación.", 137: "No hay respuesta." }
+STATUS_CODES = {
+    0: "Estado desconocido.",
+    1: "En modo prueba y en espera.", 2: "En modo prueba y emisión de documentos fiscales.", 3: "En modo prueba y emisión de documentos no fiscales.",
+    4: "En modo fiscal y en espera.", 5: "En modo fiscal y emisión de documentos fiscales.", 6: "En modo fiscal y emisión de documentos no fiscales.",
+    7: "Memoria fiscal casi llena y en espera.", 8: "Memoria fiscal casi llena y emisión de documentos fiscales.", 9: "Memoria fiscal casi llena y emisión de documentos no fiscales.",
+    10: "Memoria fiscal llena y en espera.", 11: "Memoria fiscal llena y emisión de documentos fiscales.", 12: "Memoria fiscal llena y emisión de documentos no fiscales.",
+}
+# 0-112 los reporta la impresora (byte STS2); 128 en adelante son fallos del enlace detectados en el equipo
+ERROR_CODES = {
+    0: "No hay error.", 1: "Fin en la entrega de papel.", 2: "Error de índole mecánico en la entrega de papel.", 3: "Fin en la entrega de papel y error mecánico.",
+    80: "Comando inválido o valor inválido.", 84: "Tasa inválida.", 88: "No hay asignadas directivas.", 92: "Comando inválido.", 96: "Error fiscal.",
+    100: "Error de la memoria fiscal.", 108: "Memoria fiscal llena.", 112: "Buffer completo.",
+    128: "Error en la comunicación.", 137: "No hay respuesta.", 144: "Error de LRC o trama inválida.",
+}
+
+# --------------------------------------------------------------------------
+# --- MÉTRICAS (FORMATO DE TEXTO DE PROMETHEUS EN /metrics) ---
+# --------------------------------------------------------------------------
+# Registrar una observación es un incremento bajo un lock, así que pueden quedar
+# activas en producción. Las profundidades de cola se calculan al consultar /metrics.
+
+BUCKETS_LATENCIA_SEG = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+metricas_registradas = []
+
+def _formatear_etiquetas(nombres, valores, extra=None):
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pares.append('%s="%s"' % (nombre, valor))
+    if extra: pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class Contador:
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, etiquetas
+        self._valores = {}
+        self._lock = Lock()
+        metricas_registradas.append(self)
+
+    def incrementar(self, *valores_etiquetas, cantidad=1):
+        with self._lock:
+            self._valores[valores_etiquetas] = self._valores.get(valores_etiquetas, 0) + cantidad
+
+    def exportar(self):
+        with self._lock:
+            valores = dict(self._valores)
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, k)} {v}" for k, v in sorted(valores.items())]
+
+class Indicador(Contador):
+    """Gauge. Si recibe 'calcular', sus valores se obtienen al exportar: función que devuelve {etiquetas: valor}."""
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), calcular=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._calcular = calcular
+
+    def exportar(self):
+        if self._calcular is not None:
+            with self._lock:
+                self._valores = self._calcular()
+        return super().exportar()
+
+class Histograma:
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA_SEG):
+        self.nombre, self.ayuda, self.etiquetas, self.buckets = nombre, ayuda, etiquetas, buckets
+        self._series = {}
+        self._lock = Lock()
+        metricas_registradas.append(self)
+
+    def observar(self, segundos, *valores_etiquetas):
+        indice = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            serie = self._series.get(valores_etiquetas)
+            if serie is None:
+                serie = self._series[valores_etiquetas] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += segundos
+            serie[2] += 1
+
+    def exportar(self):
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        lineas = []
+        for valores, (conteos, suma, total) in sorted(series.items()):
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, conteos):
+                acumulado += conteo
+                etiquetas = _formatear_etiquetas(self.etiquetas, valores, 'le="%s"' % limite)
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            etiquetas = _formatear_etiquetas(self.etiquetas, valores, 'le="+Inf"')
+            lineas.append(f"{self.nombre}_bucket{etiquetas} {total}")
+            etiquetas = _formatear_etiquetas(self.etiquetas, valores)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {suma}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {total}")
+        return lineas
+
+def exportar_metricas():
+    lineas = []
+    for metrica in metricas_registradas:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        lineas.extend(metrica.exportar())
+    return "\n".join(lineas) + "\n"
+
+METRICA_ESPERA_LOCK = Histograma("impresion_fiscal_espera_lock_segundos", "Tiempo esperando el lock de la impresora fiscal.", ("terminal",))
+METRICA_ESCRITURA = Histograma("impresion_fiscal_escritura_archivo_segundos", "Escritura, fsync y rename del archivo de comandos.", ("terminal",))
+METRICA_VALIDACION = Histograma("impresion_fiscal_validacion_archivo_segundos", "Verificación por hash del archivo de comandos en disco.", ("terminal",))
+METRICA_INTENTO = Histograma("impresion_fiscal_intento_segundos", "Duración de cada intento de comando fiscal (subprocess.run o driver serial).", ("terminal", "comando", "backend"))
+METRICA_SOLICITUD = Histograma("impresion_solicitud_segundos", "Tiempo total de cada solicitud HTTP.", ("endpoint", "terminal", "codigo"))
+METRICA_REINTENTOS = Contador("impresion_fiscal_reintentos_total", "Reintentos del ejecutable fiscal.", ("terminal",))
+METRICA_CERO_COMANDOS = Contador("impresion_fiscal_cero_comandos_total", "Respuestas 'Enviados 0 comandos' del ejecutable.", ("terminal",))
+METRICA_TIMEOUTS = Contador("impresion_fiscal_timeouts_total", "Comandos fiscales que agotaron su timeout.", ("terminal",))
+METRICA_EN_CURSO = Indicador("impresion_fiscal_en_curso", "Trabajos fiscales con el lock de la impresora tomado.", ("terminal",))
+METRICA_COLA_FISCAL = Indicador("impresion_fiscal_cola_profundidad", "Facturas en espera en la cola fiscal del terminal.", ("terminal",),
+                                calcular=lambda: {(t,): c.qsize() for t, c in list(colas_fiscales.items())})
+METRICA_USB_ERRORES = Contador("impresion_usb_errores_total", "USBError en la tickera (escritura o sondeo).", ("dispositivo",))
+METRICA_USB_RENDER = Histograma("impresion_usb_render_segundos", "Composición del ticket en memoria.", ("dispositivo",))
+METRICA_USB_ENVIO = Histograma("impresion_usb_envio_segundos", "Envío del ticket a la tickera, incluida la espera en su cola.", ("dispositivo",))
+METRICA_USB_LOTES = Contador("impresion_usb_lotes_comandas_total", "Trabajos USB que agrupan comandas de una ventana.", ("dispositivo",))
+METRICA_USB_COMANDAS_AGRUPADAS = Contador("impresion_usb_comandas_agrupadas_total", "Comandas impresas dentro de un lote.", ("dispositivo",))
+METRICA_CACHE_BLOQUES = Contador("impresion_usb_cache_bloques_total", "Consultas a la caché de bloques ESC/POS, por bloque y resultado (acierto, fallo, descarte).", ("bloque", "resultado"))
+METRICA_CACHE_BLOQUES_BYTES = Indicador("impresion_usb_cache_bloques_bytes", "Bytes ESC/POS guardados en la caché de bloques.",
+                                        calcular=lambda: {(): cache_bloques.bytes})
+METRICA_LOCK_EN_ESPERA = Indicador("impresion_fiscal_lock_en_espera", "Solicitudes esperando el lock de la impresora.", ("terminal",),
+                                    calcular=lambda: {(t, ): n for t, n in list(esperas_lock.items())})
+METRICA_LOCK_RECHAZOS = Contador("impresion_fiscal_lock_rechazos_total", "Solicitudes rechazadas por la admisión al lock.", ("terminal", "motivo"))
+METRICA_CIRCUITO = Indicador("impresion_fiscal_circuito_abierto", "1 si el circuito del terminal está abierto o medio abierto.", ("terminal",),
+                              calcular=lambda: {(t, ): int(c["estado"] != "cerrado") for t, c in list(circuitos_fiscales.items())})
+METRICA_CIRCUITO_RECHAZOS = Contador("impresion_fiscal_circuito_rechazos_total", "Solicitudes rechazadas al instante por circuito abierto.", ("terminal",))
+METRICA_DIARIO_FSYNC = Histograma("impresion_fiscal_diario_fsync_segundos", "Escritura y fsync de cada grupo de anotaciones del diario fiscal.")
+METRICA_DIARIO_ANOTACIONES = Contador("impresion_fiscal_diario_anotaciones_total", "Eventos escritos en el diario fiscal.")
+METRICA_DIARIO_GRUPOS = Contador("impresion_fiscal_diario_grupos_total", "Grupos de eventos del diario fiscal escritos con un solo fsync.")
+METRICA_DIARIO_COMPACTACIONES = Contador("impresion_fiscal_diario_compactaciones_total", "Veces que el diario fiscal se reescribió sin los trabajos cerrados.")
+METRICA_SIN_RESOLVER = Indicador("impresion_fiscal_trabajos_sin_resolver", "Trabajos fiscales cuyo resultado en la impresora se desconoce.",
+                                 calcular=lambda: {(): len(trabajos_sin_resolver)})
+METRICA_IDEMPOTENCIA = Contador("impresion_fiscal_idempotencia_total", "Facturas con Idempotency-Key repetida, por resultado.", ("resultado",))
+METRICA_LOG_DESCARTADOS = Contador("impresion_log_descartados_total", "Registros de log descartados porque la cola de escritura estaba llena.")
 
 # --------------------------------------------------------------------------
 # --- LÓGICA PARA IMPRESORA NO FISCAL (TICKETS Y COMANDAS) ---
 # --------------------------------------------------------------------------
 # (Esta sección no requiere cambios, es compatible con ambos sistemas operativos)
 
-@app.route('/diagnostico')
-def diagnostico_usb():
-    log = []
-    log.append("--- INICIANDO DIAGNÓSTICO USB (TICKERA NO FISCAL) ---")
+# --- ACOPLAMIENTO CON PYTHON-ESCPOS ---
+# escpos no tiene API pública para escribir bytes ya codificados ni para leer o fijar la página de códigos
+# activa, y la caché de bloques y el envío de tickets renderizados necesitan ambas cosas. Todo acceso a esos
+# detalles privados (Escpos._raw, Escpos.magic.encoding) pasa por estas tres funciones: si una versión
+# nueva de la librería los cambia, solo hay que tocar aquí.
+
+def escribir_bytes(p, contenido):
+    """Manda a 'p' bytes ESC/POS tal cual, sin volver a codificarlos."""
+    p._raw(contenido)
+
+def pagina_de_codigos(p):
+    """Página de códigos en que quedó 'p' (None si todavía no eligió ninguna)."""
+    return p.magic.encoding
+
+def fijar_pagina_de_codigos(p, pagina):
+    """Le informa a 'p' la página de códigos en que quedó la tickera tras bytes escritos con escribir_bytes."""
+    p.magic.encoding = pagina
+
+def perfil_tickera():
+    """Perfil 'default' de escpos con el ancho del papel, que no trae y sin el cual p.image() lo avisa por stdout
+    en cada imagen. Los datos del perfil 'default' los comparte todo el proceso: se modifica una copia."""
+    datos = copy.deepcopy(get_profile().profile_data)
+    datos["media"]["width"]["pixels"] = LOGO_ANCHO_PUNTOS
+    perfil = Profile(features=datos["features"])  # La clase que escpos ofrece para perfiles propios
+    perfil.profile_data = datos
+    return perfil
+
+PERFIL_TICKERA = perfil_tickera()  # Se pasa a cada Usb y Dummy que crea el servidor
+
+def verificar_dispositivo_usb(dev, log, configurar=True):
+    try:
+        if dev.is_kernel_driver_active(0):
+            log.append("Kernel driver activo. Intentando desvincular...")
+            dev.detach_kernel_driver(0)
+            log.append("Kernel driver desvinculado con éxito.")
+    except usb.core.USBError as e:
+        log.append(f"No se pudo desvincular el kernel driver (esto es normal en Windows): {e}")
+
+    if configurar:
+        dev.set_configuration()
+        log.append("Configuración establecida con éxito.")
+    else:
+        # Con la interfaz ya reclamada no se puede reconfigurar; leer la configuración activa
+        # basta para comprobar que el handle sigue vivo.
+        dev.get_active_configuration()
+        log.append("Configuración activa verificada sobre la conexión abierta.")
+
+def enumerar_dispositivos_usb(refrescar=False):
+    """Tickeras conectadas de los modelos registrados. El bus solo se recorre si la lista venció o se pide refrescar."""
+    with enumeracion_usb_lock:
+        vigente = enumeracion_usb["t"] is not None and time.monotonic() - enumeracion_usb["t"] < USB_TTL_ENUMERACION_SEG
+        if refrescar or not vigente:
+            configs = DISPOSITIVOS_TICKET.values() or [{"vendor_id": VENDOR_ID, "product_id": PRODUCT_ID}]
+            modelos = {(c["vendor_id"], c["product_id"]) for c in configs}
+            leer_serial = any(c.get("serial") for c in configs)
+            dispositivos = []
+            for dev in usb.core.find(find_all=True, custom_match=lambda d: (d.idVendor, d.idProduct) in modelos):
+                serial = None
+                if leer_serial and dev.iSerialNumber:
+                    try:
+                        serial = usb.util.get_string(dev, dev.iSerialNumber)
+                    except (usb.core.USBError, ValueError, NotImplementedError):
+                        pass  # Sin permisos o sin descriptor: solo se podrá elegir por bus/dirección
+                dispositivos.append({"vendor_id": dev.idVendor, "product_id": dev.idProduct, "bus": dev.bus, "direccion": dev.address, "serial": serial})
+                usb.util.dispose_resources(dev)
+            enumeracion_usb.update(t=time.monotonic(), dispositivos=dispositivos)
+            log_usb.info(f"Enumeración USB: {len(dispositivos)} tickera(s) conectada(s).")
+        return list(enumeracion_usb["dispositivos"])
+
+def invalidar_enumeracion_usb():
+    with enumeracion_usb_lock:
+        enumeracion_usb["t"] = None
+
+def diagnosticar_usb(vendor_id, product_id, log, filtros=None):
     dev = None
+    filtros = filtros or {}
     try:
-        log.append(f"Buscando dispositivo: VENDOR_ID=0x{VENDOR_ID:04x}, PRODUCT_ID=0x{PRODUCT_ID:04x}")
-        dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+        log.append(f"Buscando dispositivo: VENDOR_ID=0x{vendor_id:04x}, PRODUCT_ID=0x{product_id:04x}" + "".join(f", {k}={v}" for k, v in filtros.items()))
+        dev = usb.core.find(idVendor=vendor_id, idProduct=product_id, **filtros)
         if dev is None:
             log.append("[ERROR CRÍTICO]: ¡Tickera USB no encontrada!")
             log.append("-> CONSEJO WINDOWS: Asegúrese de haber instalado el driver correcto (ej. con Zadig).")
-            return jsonify({"status": "error", "log": log}), 500
+            return False
 
         log.append("¡Dispositivo encontrado!")
+        verificar_dispositivo_usb(dev, log)
+        return True
+    finally:
+        if dev is not None:
+            usb.util.dispose_resources(dev)
+
+class ConexionUsbGestionada:
+    """Conexión persistente a una tickera USB con un único hilo escritor.
+
+    Los trabajos son funciones que reciben la impresora abierta; se ejecutan de uno en uno
+    en el hilo escritor. Si el handle quedó inválido (USBError) se reabre y se reintenta.
+    """
+
+    def __init__(self, nombre, vendor_id, product_id, serial=None, bus=None, direccion=None):
+        self.nombre = nombre
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.serial = serial
+        self.bus = bus
+        self.direccion = direccion
+        self._impresora = None
+        self._cola = queue.Queue()
+        self._hilo = None
+        self._hilo_lock = Lock()
+
+    @property
+    def conectada(self):
+        """Si el hilo escritor tiene la tickera abierta (se abre con el primer trabajo y tras cada reconexión)."""
+        return self._impresora is not None
 
+    @property
+    def pendientes(self):
+        """Trabajos en cola que el hilo escritor todavía no tomó."""
+        return self._cola.qsize()
+
+    def encolar(self, operacion, abrir=True):
+        """Pone el trabajo en la cola de esta tickera y devuelve su Future sin esperar."""
+        futuro = Future()
+        self._asegurar_hilo()
+        self._cola.put((operacion, futuro, abrir))
+        return futuro
+
+    def ejecutar(self, operacion, timeout=USB_TIMEOUT_TRABAJO_SEG, abrir=True):
+        futuro = self.encolar(operacion, abrir)
         try:
-            if dev.is_kernel_driver_active(0):
-                log.append("Kernel driver activo. Intentando desvincular...")
-                dev.detach_kernel_driver(0)
-                log.append("Kernel driver desvinculado con éxito.")
+            return futuro.result(timeout=timeout)
+        except FuturoTimeoutError:
+            futuro.cancel()
+            raise TimeoutError(f"La tickera '{self.nombre}' no completó el trabajo en {timeout}s.")
+
+    def diagnosticar(self, log):
+        # Pasa por el hilo escritor para no competir con un ticket en curso
+        return self.ejecutar(lambda p: self._diagnosticar(log), abrir=False)
+
+    def _asegurar_hilo(self):
+        with self._hilo_lock:
+            if self._hilo is None:
+                self._hilo = Thread(target=self._bucle_escritor, name=f"usb-{self.nombre}", daemon=True)
+                self._hilo.start()
+
+    def filtros_usb(self, refrescar=False):
+        """Argumentos extra de usb.core.find para distinguir esta tickera de otras del mismo modelo."""
+        if self.bus is not None:
+            return {"bus": self.bus, "address": self.direccion}
+        if self.serial is None:
+            return {}
+        for d in enumerar_dispositivos_usb(refrescar):
+            if (d["vendor_id"], d["product_id"], d["serial"]) == (self.vendor_id, self.product_id, self.serial):
+                return {"bus": d["bus"], "address": d["direccion"]}
+        raise usb.core.USBError(f"No hay ninguna tickera conectada con serial '{self.serial}'.")
+
+    def _abrir(self):
+        if self._impresora is None:
+            try:
+                impresora = Usb(self.vendor_id, self.product_id, usb_args=self.filtros_usb(), timeout=0, in_ep=0x81, out_ep=0x01,
+                                profile=PERFIL_TICKERA)
+                impresora.open()
+            except Exception:
+                invalidar_enumeracion_usb()  # Pudo desconectarse o cambiar de dirección: el próximo intento vuelve a buscarla
+                raise
+            self._impresora = impresora
+            log_usb.info(f"Conexión USB con la tickera '{self.nombre}' abierta.", extra={"dispositivo": self.nombre})
+        return self._impresora
+
+    def _descartar(self):
+        impresora, self._impresora = self._impresora, None
+        if impresora is not None:
+            try:
+                impresora.close()
+            except Exception as e:
+                log_usb.warning(f"Error cerrando la conexión USB de '{self.nombre}': {e}", extra={"dispositivo": self.nombre})
+
+    def _diagnosticar(self, log):
+        if self._impresora is None:
+            return diagnosticar_usb(self.vendor_id, self.product_id, log, self.filtros_usb(refrescar=True))
+        log.append(f"Conexión persistente abierta: VENDOR_ID=0x{self.vendor_id:04x}, PRODUCT_ID=0x{self.product_id:04x}")
+        try:
+            verificar_dispositivo_usb(self._impresora.device, log, configurar=False)
+            return True
         except usb.core.USBError as e:
-            log.append(f"No se pudo desvincular el kernel driver (esto es normal en Windows): {e}")
+            log.append(f"El handle USB ya no es válido ({e}). Se reconectará en el próximo trabajo.")
+            self._descartar()
+            return diagnosticar_usb(self.vendor_id, self.product_id, log, self.filtros_usb(refrescar=True))
 
-        dev.set_configuration()
-        log.append("Configuración establecida con éxito.")
+    def _sondear(self):
+        if self._impresora is None: return
+        log = []
+        try:
+            verificar_dispositivo_usb(self._impresora.device, log, configurar=False)
+        except usb.core.USBError as e:
+            METRICA_USB_ERRORES.incrementar(self.nombre)
+            log_usb.warning(f"Sondeo USB: handle de '{self.nombre}' inválido ({e}). Se descarta hasta el próximo trabajo.", extra={"dispositivo": self.nombre})
+            self._descartar()
+
+    def _ejecutar_con_reconexion(self, operacion):
+        for intento in range(1, USB_INTENTOS_RECONEXION + 1):
+            impresora = self._abrir()
+            try:
+                return operacion(impresora)
+            except usb.core.USBError as e:
+                METRICA_USB_ERRORES.incrementar(self.nombre)
+                self._descartar()
+                invalidar_enumeracion_usb()
+                if intento == USB_INTENTOS_RECONEXION: raise
+                log_usb.warning(f"USBError en '{self.nombre}' (intento {intento}): {e}. Reconectando...", extra={"dispositivo": self.nombre, "intento": intento})
+
+    def _bucle_escritor(self):
+        while True:
+            try:
+                operacion, futuro, abrir = self._cola.get(timeout=USB_INTERVALO_SONDEO_SEG)
+            except queue.Empty:
+                self._sondear()
+                continue
+            if not futuro.set_running_or_notify_cancel(): continue
+            try:
+                futuro.set_result(self._ejecutar_con_reconexion(operacion) if abrir else operacion(None))
+            except Exception as e:
+                futuro.set_exception(e)
 
-        return jsonify({"status": "ok", "log": log}), 200
+def construir_tickeras():
+    if not DISPOSITIVOS_TICKET:
+        return {"tickera": ConexionUsbGestionada("tickera", VENDOR_ID, PRODUCT_ID)}
+    return {nombre: ConexionUsbGestionada(nombre, c["vendor_id"], c["product_id"], serial=c.get("serial"), bus=c.get("bus"), direccion=c.get("direccion"))
+            for nombre, c in DISPOSITIVOS_TICKET.items()}
 
+tickeras = construir_tickeras()
+tickera = next(iter(tickeras.values()))  # Tickera por defecto
+
+def obtener_tickera(nombre=None):
+    if nombre is None: return tickera
+    if nombre not in tickeras:
+        raise ValueError(f"Tickera '{nombre}' no registrada. Disponibles: {', '.join(tickeras)}.")
+    return tickeras[nombre]
+
+@app.route('/diagnostico')
+def diagnostico_usb():
+    log = ["--- INICIANDO DIAGNÓSTICO USB (TICKERA NO FISCAL) ---"]
+    nombre = request.args.get('tickera')
+    ok = True
+    try:
+        seleccion = [obtener_tickera(nombre)] if nombre else list(tickeras.values())
+        for conexion in seleccion:
+            if len(tickeras) > 1: log.append(f"--- Tickera '{conexion.nombre}' ---")
+            ok = conexion.diagnosticar(log) and ok
+    except ValueError as e:
+        return jsonify({"status": "error", "log": log + [str(e)]}), 400
     except Exception as e:
         log.append(f"Error inesperado: {e}")
         return jsonify({"status": "error", "log": log}), 500
+    return jsonify({"status": "ok" if ok else "error", "log": log}), 200 if ok else 500
+
+@app.route('/tickeras', methods=['GET'])
+def listar_tickeras():
+    """Tickeras registradas y dispositivos USB conectados (de la enumeración en caché, o nueva con ?refrescar=1)."""
+    try:
+        conectados = enumerar_dispositivos_usb(refrescar=request.args.get('refrescar') in ('1', 'true'))
+    except (usb.core.USBError, usb.core.NoBackendError) as e:
+        return jsonify({"error": f"No se pudo enumerar el bus USB: {e}"}), 500
+    registradas = {
+        nombre: {"vendor_id": f"0x{c.vendor_id:04x}", "product_id": f"0x{c.product_id:04x}", "serial": c.serial,
+                 "bus": c.bus, "direccion": c.direccion, "conectada": c.conectada, "en_cola": c.pendientes}
+        for nombre, c in tickeras.items()
+    }
+    for d in conectados:
+        d["vendor_id"], d["product_id"] = f"0x{d['vendor_id']:04x}", f"0x{d['product_id']:04x}"
+    return jsonify({"tickeras": registradas, "conectados": conectados, "rutas_comanda": RUTAS_COMANDA,
+                    "cache_bloques": cache_bloques.resumen()}), 200
+
+# --- RENDERIZADO DE TICKETS ---
+# Los tickets se componen primero en memoria (escpos Dummy) y luego se envían a la tickera
+# en una sola escritura USB. Así un fallo a mitad de camino no deja un ticket a medias.
+
+class VistaPreviaTexto:
+    """Impresora falsa que solo acumula el texto, para la vista previa de /render-preview."""
+
+    def __init__(self):
+        self.partes = []
+
+    def set(self, **kwargs):
+        pass
+
+    def text(self, texto):
+        self.partes.append(texto)
+
+    def cut(self, *args, **kwargs):
+        self.partes.append("-" * ANCHO_TICKET + " [CORTE]\n")
+
+    @property
+    def texto(self):
+        return "".join(self.partes)
+
+class CacheBloquesEscpos:
+    """Bloques ESC/POS ya codificados (logo, encabezado, QR, pie), indexados por una tupla con los datos que los
+    generan y la página de códigos en que los encuentra el ticket. LRU con tope de memoria en bytes."""
+
+    def __init__(self, maximo_bytes):
+        self.maximo_bytes = maximo_bytes
+        self.bytes = 0
+        self._bloques = OrderedDict()  # {(clave, página inicial): (bytes ESC/POS, página de códigos al terminar el bloque)}
+        self._lock = Lock()
+
+    def obtener(self, clave, componer, codificacion):
+        """Devuelve (bytes, página de códigos final) del bloque 'clave' (su primer elemento es el tipo de bloque);
+        si no está lo compone con 'componer(p, clave)'."""
+        indice = (clave, codificacion)
+        with self._lock:
+            bloque = self._bloques.get(indice)
+            if bloque is not None: self._bloques.move_to_end(indice)
+        if bloque is not None:
+            METRICA_CACHE_BLOQUES.incrementar(clave[0], "acierto")
+            return bloque
+        METRICA_CACHE_BLOQUES.incrementar(clave[0], "fallo")
+        buffer = Dummy(profile=PERFIL_TICKERA)
+        fijar_pagina_de_codigos(buffer, codificacion)  # Mismo estado que el ticket: el bloque no repite el cambio de página
+        componer(buffer, clave)
+        bloque = (buffer.output, pagina_de_codigos(buffer))
+        self._guardar(indice, bloque)
+        return bloque
+
+    def _guardar(self, indice, bloque):
+        if len(bloque[0]) > self.maximo_bytes: return
+        with self._lock:
+            anterior = self._bloques.pop(indice, None)
+            if anterior is not None: self.bytes -= len(anterior[0])
+            self._bloques[indice] = bloque
+            self.bytes += len(bloque[0])
+            while self.bytes > self.maximo_bytes:
+                (clave, _), descartado = self._bloques.popitem(last=False)
+                self.bytes -= len(descartado[0])
+                METRICA_CACHE_BLOQUES.incrementar(clave[0], "descarte")
+
+    def resumen(self):
+        with self._lock:
+            return {"bloques": len(self._bloques), "bytes": self.bytes, "maximo_bytes": self.maximo_bytes}
+
+cache_bloques = CacheBloquesEscpos(CACHE_BLOQUES_MAXIMO_BYTES)
+huellas_archivos = {}  # {ruta: ((mtime_ns, tamaño), sha256)}
+huellas_archivos_lock = Lock()
+
+def escribir_bloque(p, clave, componer):
+    """Escribe en 'p' una sección fija del ticket. 'clave' es una tupla (tipo, datos que la determinan...) y
+    'componer(p, clave)' la genera. La vista previa en texto se compone siempre."""
+    if not CACHE_BLOQUES_ACTIVA or not isinstance(p, Dummy):
+        componer(p, clave)
+        return
+    contenido, codificacion = cache_bloques.obtener(clave, componer, pagina_de_codigos(p))
+    escribir_bytes(p, contenido)
+    fijar_pagina_de_codigos(p, codificacion)  # La tickera quedó en la página de códigos con que terminó el bloque
+
+def huella_archivo(ruta):
+    """sha256 del contenido del archivo; solo se vuelve a leer si cambian su fecha de modificación o su tamaño."""
+    estado = os.stat(ruta)
+    firma = (estado.st_mtime_ns, estado.st_size)
+    with huellas_archivos_lock:
+        conocida = huellas_archivos.get(ruta)
+    if conocida and conocida[0] == firma: return conocida[1]
+    with open(ruta, 'rb') as f:
+        huella = hashlib.sha256(f.read()).hexdigest()
+    with huellas_archivos_lock:
+        huellas_archivos[ruta] = (firma, huella)
+    return huella
+
+def escribir_imagen(p, imagen, etiqueta):
+    """Imagen en blanco y negro como raster ESC/POS (GS v 0); en la vista previa solo queda la etiqueta."""
+    if isinstance(p, VistaPreviaTexto):
+        p.text(f"[{etiqueta}]\n")
+        return
+    p.image(imagen, impl="bitImageRaster")
+
+def componer_logo(p, clave):
+    _, ruta, _, ancho = clave
+    imagen = Image.open(ruta).convert('L')
+    if imagen.width > ancho:
+        imagen = imagen.resize((ancho, max(1, round(imagen.height * ancho / imagen.width))), Image.LANCZOS)
+    p.set(align='center')
+    escribir_imagen(p, imagen.convert('1', dither=Image.FLOYDSTEINBERG), "LOGO")  # Difuminado Floyd-Steinberg
+    p.text("\n")
+
+def componer_qr(p, clave):
+    _, contenido, tamano = clave
+    codigo = qrcode.QRCode(box_size=tamano, border=1)
+    codigo.add_data(contenido)
+    codigo.make(fit=True)
+    p.set(align='center')
+    escribir_imagen(p, codigo.make_image().get_image().convert('1'), f"QR: {contenido}")
+    p.text("\n")
+
+def componer_encabezado_recibo(p, clave):
+    _, nombre, rif, titulo, ancho = clave
+    p.set(align='center', font='a', height=2, width=1); p.text(f"{nombre}\n")
+    p.set(align='center', font='a'); p.text(f"RIF: {rif}\n")
+    p.set(align='center', font='b', height=2, width=2); p.text(titulo)
+    p.set(align='left', font='a', height=1, width=1); p.text("-" * ancho + "\n")
+
+def componer_pie_recibo(p, clave):
+    p.set(align='center', font='a'); p.text(f"{clave[1]}\n\n")
+
+def escribir_logo(p):
+    """Logo de LOGO_TICKET; si la imagen no se puede leer el recibo sale sin logo."""
+    if not LOGO_TICKET: return
+    try:
+        huella = huella_archivo(LOGO_TICKET)
+    except OSError as e:
+        log_usb.warning(f"No se pudo leer el logo '{LOGO_TICKET}': {e}")
+        return
+    escribir_bloque(p, ("logo", LOGO_TICKET, huella, LOGO_ANCHO_PUNTOS), componer_logo)
+
+def precalentar_cache_bloques():
+    """Codifica al arrancar el logo y los encabezados y pies de COMERCIOS_PRECALENTAR (y su 'qr'), para que los
+    primeros recibos ya encuentren sus bloques en la caché."""
+    t_inicio = time.perf_counter()
+    try:
+        for comercio in COMERCIOS_PRECALENTAR or [{}]:
+            for tipo_recibo in ('venta', 'pago_cuota'):
+                componer_factura_no_fiscal(Dummy(profile=PERFIL_TICKERA), {"comercio": comercio, "tipo_recibo": tipo_recibo})
+    except Exception:
+        log_usb.exception("Error precalentando la caché de bloques ESC/POS")
+    resumen = cache_bloques.resumen()
+    log_usb.info(f"Caché de bloques ESC/POS precalentada: {resumen['bloques']} bloques, {resumen['bytes']} bytes",
+                 extra={"etapa": "cache_bloques", "duracion_ms": round((time.perf_counter() - t_inicio) * 1000, 1)})
+
+def formatear_monto(valor):
+    return f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def componer_factura_no_fiscal(p, ticket_data):
+    """Escribe la nota de entrega / recibo de pago sobre la impresora 'p'. Devuelve el tipo de recibo."""
+    comercio_info = ticket_data.get('comercio', {})
+    pedido_info = ticket_data.get('pedido', {})
+    tipo_recibo = ticket_data.get('tipo_recibo', 'venta')
+    moneda_principal_simbolo = 'Bs' if ticket_data.get('moneda_principal') == 'Bs' else '$'
+
+    escribir_logo(p)
+    escribir_bloque(p, ("encabezado", comercio_info.get('nombre', 'Mi Negocio'), comercio_info.get('rif', 'J-00000000-0'),
+                        "NOTA DE ENTREGA\n" if tipo_recibo != 'pago_cuota' else "RECIBO DE PAGO\n", ANCHO_TICKET), componer_encabezado_recibo)
+    p.text(f"Fecha: {pedido_info.get('fecha')}\n")
+    atendido_por = pedido_info.get('cajero') or pedido_info.get('mesero')
+    if atendido_por: p.text(f"Atendido por: {atendido_por}\n")
+    if pedido_info.get('cliente_nombre'): p.text(f"Cliente: {pedido_info.get('cliente_nombre')}\n")
+    if pedido_info.get('cliente_cedula'): p.text(f"CI/RIF: {pedido_info.get('cliente_cedula')}\n")
+    p.text("-" * ANCHO_TICKET + "\n"); p.text(format_line("Cant. Descripcion", "Total", ANCHO_TICKET) + "\n"); p.text("-" * ANCHO_TICKET + "\n")
+    for item in ticket_data.get('items', []):
+        desc_linea = f"{item['cantidad']} {item['descripcion']}"
+        total_formateado = formatear_monto(item.get('total_item', 0))
+        total_linea = f"{moneda_principal_simbolo} {total_formateado}"
+        p.text(format_line(desc_linea, total_linea, ANCHO_TICKET) + "\n")
+    p.text("-" * ANCHO_TICKET + "\n")
+    totales = ticket_data.get('totales', {})
+    p.set(align='right', font='b')
+    subtotal_formateado = formatear_monto(totales.get('subtotal', 0))
+    p.text(format_line("SUBTOTAL:", f"{moneda_principal_simbolo} {subtotal_formateado}", ANCHO_TICKET) + "\n")
+    total_principal_formateado = formatear_monto(totales.get('total_a_pagar', 0))
+    p.set(font='b', height=2, width=2); p.text(format_line(f"TOTAL {moneda_principal_simbolo}:", total_principal_formateado, ANCHO_TICKET) + "\n")
+    p.set(font='a', height=1, width=1); p.text("\n")
+    qr = ticket_data.get('qr') or comercio_info.get('qr')
+    if qr: escribir_bloque(p, ("qr", str(qr), QR_TAMANO_MODULO), componer_qr)
+    escribir_bloque(p, ("pie", comercio_info.get('mensaje_pie', 'Gracias por su preferencia!')), componer_pie_recibo)
+    p.cut()
+    return tipo_recibo
+
+def renderizar(componer, datos, dispositivo="tickera"):
+    """Compone un ticket en memoria sin tocar la tickera. Devuelve (bytes ESC/POS, resultado de 'componer', ms)."""
+    t_inicio = time.perf_counter()
+    buffer = Dummy(profile=PERFIL_TICKERA)
+    resultado = componer(buffer, datos)
+    duracion = time.perf_counter() - t_inicio
+    METRICA_USB_RENDER.observar(duracion, dispositivo)
+    return buffer.output, resultado, round(duracion * 1000, 3)
+
+def enviar_a_tickera(conexion, contenido):
+    """Envía un ticket ya renderizado en una sola escritura. Devuelve los ms que tomó en el dispositivo."""
+    t_inicio = time.perf_counter()
+    try:
+        conexion.ejecutar(lambda p: escribir_bytes(p, contenido))
     finally:
-        if dev is not None:
-            usb.util.dispose_resources(dev)
+        duracion = time.perf_counter() - t_inicio
+        METRICA_USB_ENVIO.observar(duracion, conexion.nombre)
+    return round(duracion * 1000, 3)
+
+def enviar_a_tickeras(envios, encolados=None):
+    """Envía cada ticket a su tickera; como cada una tiene su hilo escritor, se imprimen en paralelo.
+    'encolados' son trabajos ya en curso ({nombre: Future}, p. ej. comandas agrupadas) que se esperan igual.
+    Devuelve {nombre: ms en el dispositivo, o la excepción si falló}."""
+    t_inicio = time.perf_counter()
+    fin = {}
+    futuros = dict(encolados or {})
+    for nombre, contenido in envios.items():
+        futuros[nombre] = obtener_tickera(nombre).encolar(lambda p, c=contenido: escribir_bytes(p, c))
+    for nombre, futuro in futuros.items():
+        futuro.add_done_callback(lambda f, n=nombre: fin.setdefault(n, time.perf_counter()))
+    resultados = {}
+    for nombre, futuro in futuros.items():
+        try:
+            futuro.result(timeout=max(0, USB_TIMEOUT_TRABAJO_SEG - (time.perf_counter() - t_inicio)))
+            resultados[nombre] = round((fin[nombre] - t_inicio) * 1000, 3)
+        except FuturoTimeoutError:
+            futuro.cancel()
+            resultados[nombre] = TimeoutError(f"La tickera '{nombre}' no completó el trabajo en {USB_TIMEOUT_TRABAJO_SEG}s.")
+        except Exception as e:
+            resultados[nombre] = e
+        METRICA_USB_ENVIO.observar(fin.get(nombre, time.perf_counter()) - t_inicio, nombre)
+    return resultados
 
 @app.route('/imprimir-factura', methods=['POST'])
 def imprimir_factura_no_fiscal():
-    p = None
     try:
         ticket_data = request.get_json()
         if not ticket_data: return jsonify({"error": "No se recibieron datos"}), 400
-        p = Usb(VENDOR_ID, PRODUCT_ID, timeout=0, in_ep=0x81, out_ep=0x01)
-
-        comercio_info = ticket_data.get('comercio', {})
-        pedido_info = ticket_data.get('pedido', {})
-        tipo_recibo = ticket_data.get('tipo_recibo', 'venta')
-        moneda_principal_simbolo = 'Bs' if ticket_data.get('moneda_principal') == 'Bs' else '$'
-
-        p.set(align='center', font='a', height=2, width=1); p.text(f"{comercio_info.get('nombre', 'Mi Negocio')}\n")
-        p.set(align='center', font='a'); p.text(f"RIF: {comercio_info.get('rif', 'J-00000000-0')}\n")
-        p.set(align='center', font='b', height=2, width=2); p.text("NOTA DE ENTREGA\n" if tipo_recibo != 'pago_cuota' else "RECIBO DE PAGO\n")
-        p.set(align='left', font='a', height=1, width=1); p.text("-" * ANCHO_TICKET + "\n")
-        p.text(f"Fecha: {pedido_info.get('fecha')}\n")
-        atendido_por = pedido_info.get('cajero') or pedido_info.get('mesero')
-        if atendido_por: p.text(f"Atendido por: {atendido_por}\n")
-        if pedido_info.get('cliente_nombre'): p.text(f"Cliente: {pedido_info.get('cliente_nombre')}\n")
-        if pedido_info.get('cliente_cedula'): p.text(f"CI/RIF: {pedido_info.get('cliente_cedula')}\n")
-        p.text("-" * ANCHO_TICKET + "\n"); p.text(format_line("Cant. Descripcion", "Total", ANCHO_TICKET) + "\n"); p.text("-" * ANCHO_TICKET + "\n")
-        for item in ticket_data.get('items', []):
-            desc_linea = f"{item['cantidad']} {item['descripcion']}"
-            total_formateado = f"{item.get('total_item', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-            total_linea = f"{moneda_principal_simbolo} {total_formateado}"
-            p.text(format_line(desc_linea, total_linea, ANCHO_TICKET) + "\n")
-        p.text("-" * ANCHO_TICKET + "\n")
-        totales = ticket_data.get('totales', {})
-        p.set(align='right', font='b')
-        subtotal_formateado = f"{totales.get('subtotal', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        p.text(format_line("SUBTOTAL:", f"{moneda_principal_simbolo} {subtotal_formateado}", ANCHO_TICKET) + "\n")
-        total_principal_formateado = f"{totales.get('total_a_pagar', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        p.set(font='b', height=2, width=2); p.text(format_line(f"TOTAL {moneda_principal_simbolo}:", total_principal_formateado, ANCHO_TICKET) + "\n")
-        p.set(font='a', height=1, width=1); p.text("\n"); p.set(align='center', font='a'); p.text("Gracias por su preferencia!\n\n"); p.cut()
-        return jsonify({"message": f"Recibo ({tipo_recibo}) impreso"}), 200
+        conexion = obtener_tickera(ticket_data.get('tickera') or TICKERA_RECIBOS)
+        contenido, tipo_recibo, render_ms = renderizar(componer_factura_no_fiscal, ticket_data, conexion.nombre)
+        envio_ms = enviar_a_tickera(conexion, contenido)
+        return jsonify({"message": f"Recibo ({tipo_recibo}) impreso", "render_ms": render_ms, "envio_ms": envio_ms}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        traceback.print_exc()
+        log_usb.exception("Error imprimiendo factura no fiscal")
         return jsonify({"error": f"Error en impresora de boletas: {str(e)}"}), 500
-    finally:
-        if p: p.close()
 
 def format_line(left_text, right_text, width):
     left_text = str(left_text); right_text = str(right_text)
     spacing = width - len(left_text) - len(right_text)
     return f"{left_text}{' ' * max(0, spacing)}{right_text}"
 
+def componer_comanda(p, data, cortar=True):
+    """Escribe la comanda de cocina sobre la impresora 'p'. Sin 'cortar' deja una línea divisoria
+    (comandas seguidas de la misma mesa dentro de un lote)."""
+    pedido_info = data.get('pedido', {})
+    items = data.get('items', [])
+
+    p.set(align='center', font='a', bold=True, height=2, width=2)
+    p.text(f"PEDIDO #{pedido_info.get('id', 'N/A')}\n")
+    p.set(align='left', font='a', bold=True, height=2, width=1)
+    mesa = pedido_info.get('mesa')
+    if mesa and mesa != 'Por asignar':
+         p.text(f"MESA: {str(mesa).upper()}\n")
+    else:
+         p.text(f"PARA: {str(pedido_info.get('tipo_servicio', 'Llevar')).upper()}\n")
+    p.set(align='left', font='a', height=1, width=1)
+    mesero = pedido_info.get('mesero', 'N/A')
+    p.text(f"MESERO: {str(mesero).upper()}\n")
+    cliente_nombre = pedido_info.get('cliente_nombre')
+    if cliente_nombre and str(cliente_nombre).strip():
+        p.text(f"CLIENTE: {str(cliente_nombre).upper()}\n")
+    p.text("-" * ANCHO_TICKET + "\n")
+
+    for item in items:
+        p.set(align='left', font='a', bold=True, height=2, width=1)
+        p.text(f"{item.get('cantidad', 1)}x {str(item.get('descripcion', 'PRODUCTO')).upper()}\n")
+        p.set(align='left', font='b', bold=False, height=1, width=1)
+        opciones = item.get('opciones_seleccionadas', [])
+        if opciones:
+            for opcion in opciones:
+                cantidad_op = opcion.get('cantidad', 1)
+                nombre_op = str(opcion.get('nombre', '?')).upper()
+                texto_op = f"{cantidad_op}x {nombre_op}" if cantidad_op > 1 else f"› {nombre_op}"
+                p.text(f"  {texto_op}\n")
+        adicionales = item.get('adicionales', [])
+        if adicionales:
+            for adicional in adicionales:
+                cantidad_ad = adicional.get('cantidad', 1)
+                nombre_ad = str(adicional.get('nombre', '?')).upper()
+                texto_ad = f"+{cantidad_ad}x {nombre_ad}" if cantidad_ad > 1 else f"+ {nombre_ad}"
+                p.text(f"  {texto_ad}\n")
+        removidos = item.get('removidos', [])
+        if removidos:
+            nombres_removidos = [str(r.get('nombre', '?')).upper() for r in removidos]
+            texto_rem = "- " + ", ".join(nombres_removidos)
+            if len(texto_rem) > ANCHO_TICKET - 2:
+                p.text(f"  - SIN: {', '.join(nombres_removidos)}\n")
+            else:
+                p.text(f"  {texto_rem}\n")
+        observacion = item.get('observacion')
+        if observacion and str(observacion).strip():
+            p.text(f"  >> {str(observacion).strip().upper()}\n")
+
+    p.set(align='left', font='a', height=1, width=1)
+    p.text("-" * ANCHO_TICKET + "\n")
+    p.set(align='center', font='b')
+    p.text(datetime.now().strftime("%d/%m/%Y %I:%M %p") + "\n\n\n")
+    if cortar:
+        p.cut()
+    else:
+        p.text("=" * ANCHO_TICKET + "\n\n")
+
+def repartir_comanda(data):
+    """Agrupa los ítems por tickera según su 'estacion' o 'categoria' (RUTAS_COMANDA). Devuelve {tickera: datos de su comanda}."""
+    por_defecto = obtener_tickera(data.get('tickera') or TICKERA_COMANDAS).nombre
+    grupos = {}
+    for item in data.get('items', []):
+        destino = RUTAS_COMANDA.get(item.get('estacion')) or RUTAS_COMANDA.get(item.get('categoria')) or por_defecto
+        grupos.setdefault(obtener_tickera(destino).nombre, []).append(item)
+    if not grupos: grupos[por_defecto] = []
+    # Cada estación recibe el encabezado completo del pedido con solo sus ítems
+    return {nombre: dict(data, items=items) for nombre, items in grupos.items()}
+
+class AgrupadorComandas:
+    """Junta las comandas que llegan a una tickera dentro de una ventana y las imprime en un solo trabajo USB.
+
+    Cada comanda se renderiza por separado (si una falla solo falla su solicitud) y los bytes se
+    concatenan. Cada llamador recibe su propio Future con {"render_ms", "lote"} o la excepción del envío.
+    """
+
+    def __init__(self, conexion, ventana_ms, agrupar="pedido"):
+        if agrupar not in ("pedido", "mesa"):
+            raise ValueError(f"agrupar_comandas de '{conexion.nombre}' debe ser 'pedido' o 'mesa', no '{agrupar}'.")
+        self.conexion = conexion
+        self.ventana_ms = ventana_ms
+        self.agrupar = agrupar
+        self._pendientes = []
+        self._lock = Lock()
+
+    def agregar(self, datos):
+        futuro = Future()
+        with self._lock:
+            self._pendientes.append((datos, futuro))
+            if len(self._pendientes) == 1:  # La primera comanda abre la ventana
+                temporizador = Timer(self.ventana_ms / 1000, self._despachar)
+                temporizador.daemon = True
+                temporizador.start()
+        return futuro
+
+    def _agrupar(self, lote):
+        """Devuelve los grupos de [(datos, futuro)] que terminan en un corte. Con 'pedido' cada comanda es un grupo;
+        con 'mesa' las comandas de una mesa quedan juntas (en el orden en que llegó la primera)."""
+        if self.agrupar == "pedido":
+            return [[par] for par in lote]
+        mesas = OrderedDict()
+        for indice, (datos, futuro) in enumerate(lote):
+            mesa = datos.get('pedido', {}).get('mesa')
+            clave = str(mesa).upper() if mesa and mesa != 'Por asignar' else ("sin_mesa", indice)
+            mesas.setdefault(clave, []).append((datos, futuro))
+        return list(mesas.values())
+
+    def _renderizar_grupo(self, grupo):
+        """Renderiza las comandas de un grupo que siguen vigentes. Devuelve [(bytes, futuro, render_ms)] en orden;
+        el corte lo lleva la última que se renderizó bien, aunque la última del grupo falle o se haya cancelado."""
+        vigentes = [(datos, futuro) for datos, futuro in grupo if futuro.set_running_or_notify_cancel()]  # Sin los llamadores que se rindieron
+        renderizadas, cortar = [], True
+        for datos, futuro in reversed(vigentes):
+            try:
+                contenido, _, render_ms = renderizar(lambda p, d, c=cortar: componer_comanda(p, d, c), datos, self.conexion.nombre)
+            except Exception as e:
+                futuro.set_exception(e)
+                continue
+            renderizadas.append((contenido, futuro, render_ms))
+            cortar = False
+        return renderizadas[::-1]
+
+    def _despachar(self):
+        with self._lock:
+            lote, self._pendientes = self._pendientes, []
+        partes, incluidos = [], []
+        for grupo in self._agrupar(lote):
+            for contenido, futuro, render_ms in self._renderizar_grupo(grupo):
+                partes.append(contenido)
+                incluidos.append((futuro, render_ms))
+        if not incluidos: return
+        if len(incluidos) > 1:
+            METRICA_USB_LOTES.incrementar(self.conexion.nombre)
+            METRICA_USB_COMANDAS_AGRUPADAS.incrementar(self.conexion.nombre, cantidad=len(incluidos))
+            log_usb.info(f"Imprimiendo {len(incluidos)} comandas agrupadas en '{self.conexion.nombre}'.", extra={"dispositivo": self.conexion.nombre})
+        contenido = b"".join(partes)
+        envio = self.conexion.encolar(lambda p: escribir_bytes(p, contenido))
+
+        def resolver(envio):
+            error = envio.exception()
+            for futuro, render_ms in incluidos:
+                if error is not None: futuro.set_exception(error)
+                else: futuro.set_result({"render_ms": render_ms, "lote": len(incluidos)})
+        envio.add_done_callback(resolver)
+
+def construir_agrupadores():
+    agrupadores = {}
+    for nombre, conexion in tickeras.items():
+        config = DISPOSITIVOS_TICKET.get(nombre, {})
+        ventana_ms = config.get("ventana_comandas_ms", VENTANA_COMANDAS_MS)
+        if ventana_ms > 0:
+            agrupadores[nombre] = AgrupadorComandas(conexion, ventana_ms, config.get("agrupar_comandas", AGRUPAR_COMANDAS))
+    return agrupadores
+
+agrupadores_comanda = construir_agrupadores()
+
 @app.route('/imprimir-comanda', methods=['POST'])
 def imprimir_comanda():
-    p = None
     try:
         data = request.get_json()
         if not data: return jsonify({"error": "No se recibieron datos para la comanda"}), 400
+        envios, agrupadas, dispositivos = {}, {}, {}
+        for nombre, datos_tickera in repartir_comanda(data).items():
+            dispositivos[nombre] = {"items": len(datos_tickera['items'])}
+            if nombre in agrupadores_comanda:
+                agrupadas[nombre] = agrupadores_comanda[nombre].agregar(datos_tickera)  # Se renderiza al cerrar la ventana
+            else:
+                envios[nombre], _, dispositivos[nombre]["render_ms"] = renderizar(componer_comanda, datos_tickera, nombre)
+        errores = []
+        for nombre, resultado in enviar_a_tickeras(envios, agrupadas).items():
+            if isinstance(resultado, Exception):
+                dispositivos[nombre]["error"] = str(resultado)
+                errores.append(f"{nombre}: {resultado}")
+            else:
+                dispositivos[nombre]["envio_ms"] = resultado
+                if nombre in agrupadas: dispositivos[nombre].update(agrupadas[nombre].result())
+        if errores:
+            log_usb.error(f"Error imprimiendo comanda en {len(errores)} tickera(s): {'; '.join(errores)}")
+            return jsonify({"error": f"Error en impresora de comandas: {'; '.join(errores)}", "dispositivos": dispositivos}), 500
+        return jsonify({
+            "message": "Comanda impresa completa en mayúsculas",
+            "render_ms": round(sum(d["render_ms"] for d in dispositivos.values()), 3),
+            "envio_ms": max(d["envio_ms"] for d in dispositivos.values()),
+            "dispositivos": dispositivos,
+        }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log_usb.exception("Error imprimiendo comanda")
+        return jsonify({"error": f"Error en impresora de comandas: {str(e)}"}), 500
 
-        p = Usb(VENDOR_ID, PRODUCT_ID, timeout=0, in_ep=0x81, out_ep=0x01)
-
-        pedido_info = data.get('pedido', {})
-        items = data.get('items', [])
+COMPOSITORES_TICKET = {"factura": componer_factura_no_fiscal, "comanda": componer_comanda}
 
-        p.set(align='center', font='a', bold=True, height=2, width=2)
-        p.text(f"PEDIDO #{pedido_info.get('id', 'N/A')}\n")
-        p.set(align='left', font='a', bold=True, height=2, width=1)
-        mesa = pedido_info.get('mesa')
-        if mesa and mesa != 'Por asignar':
-             p.text(f"MESA: {str(mesa).upper()}\n")
-        else:
-             p.text(f"PARA: {str(pedido_info.get('tipo_servicio', 'Llevar')).upper()}\n")
-        p.set(align='left', font='a', height=1, width=1)
-        mesero = pedido_info.get('mesero', 'N/A')
-        p.text(f"MESERO: {str(mesero).upper()}\n")
-        cliente_nombre = pedido_info.get('cliente_nombre')
-        if cliente_nombre and str(cliente_nombre).strip():
-            p.text(f"CLIENTE: {str(cliente_nombre).upper()}\n")
-        p.text("-" * ANCHO_TICKET + "\n")
-
-        for item in items:
-            p.set(align='left', font='a', bold=True, height=2, width=1)
-            p.text(f"{item.get('cantidad', 1)}x {str(item.get('descripcion', 'PRODUCTO')).upper()}\n")
-            p.set(align='left', font='b', bold=False, height=1, width=1)
-            opciones = item.get('opciones_seleccionadas', [])
-            if opciones:
-                for opcion in opciones:
-                    cantidad_op = opcion.get('cantidad', 1)
-                    nombre_op = str(opcion.get('nombre', '?')).upper()
-                    texto_op = f"{cantidad_op}x {nombre_op}" if cantidad_op > 1 else f"› {nombre_op}"
-                    p.text(f"  {texto_op}\n")
-            adicionales = item.get('adicionales', [])
-            if adicionales:
-                for adicional in adicionales:
-                    cantidad_ad = adicional.get('cantidad', 1)
-                    nombre_ad = str(adicional.get('nombre', '?')).upper()
-                    texto_ad = f"+{cantidad_ad}x {nombre_ad}" if cantidad_ad > 1 else f"+ {nombre_ad}"
-                    p.text(f"  {texto_ad}\n")
-            removidos = item.get('removidos', [])
-            if removidos:
-                nombres_removidos = [str(r.get('nombre', '?')).upper() for r in removidos]
-                texto_rem = "- " + ", ".join(nombres_removidos)
-                if len(texto_rem) > ANCHO_TICKET - 2:
-                    p.text(f"  - SIN: {', '.join(nombres_removidos)}\n")
-                else:
-                    p.text(f"  {texto_rem}\n")
-            observacion = item.get('observacion')
-            if observacion and str(observacion).strip():
-                p.text(f"  >> {str(observacion).strip().upper()}\n")
-
-        p.set(align='left', font='a', height=1, width=1)
-        p.text("-" * ANCHO_TICKET + "\n")
-        p.set(align='center', font='b')
-        p.text(datetime.now().strftime("%d/%m/%Y %I:%M %p") + "\n\n\n")
-        p.cut()
-        return jsonify({"message": "Comanda impresa completa en mayúsculas"}), 200
+@app.route('/render-preview', methods=['POST'])
+def render_preview():
+    """Renderiza un ticket sin imprimirlo. ?tipo=factura|comanda y ?formato=bytes|texto."""
+    datos = request.get_json()
+    if not datos: return jsonify({"error": "No se recibieron datos"}), 400
+    tipo = request.args.get('tipo', 'factura')
+    formato = request.args.get('formato', 'bytes')
+    componer = COMPOSITORES_TICKET.get(tipo)
+    if componer is None: return jsonify({"error": f"Tipo de ticket no válido. Use {' o '.join(COMPOSITORES_TICKET)}."}), 400
+    try:
+        contenido, _, render_ms = renderizar(componer, datos)
+        if formato == 'texto':
+            vista = VistaPreviaTexto()
+            componer(vista, datos)
+            return jsonify({"texto": vista.texto, "bytes": len(contenido), "render_ms": render_ms}), 200
+        return Response(contenido, mimetype='application/octet-stream', headers={"X-Render-Ms": str(render_ms), "X-Render-Bytes": str(len(contenido))})
     except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": f"Error en impresora de comandas: {str(e)}"}), 500
-    finally:
-        if p: p.close()
+        log_usb.exception("Error renderizando vista previa de ticket")
+        return jsonify({"error": f"Error renderizando ticket: {str(e)}"}), 500
 
 
 # ----------------------------------------------------------------
 # --- LÓGICA PARA IMPRESORA FISCAL (MULTI-PLATAFORMA) ---
 # ----------------------------------------------------------------
 
+def obtener_driver_fiscal(terminal_uuid):
+    config = BACKENDS_FISCALES.get(terminal_uuid)
+    if not config or config.get("backend") != "serial": return None
+    with locks_dict_lock:
+        if terminal_uuid not in drivers_fiscales:
+            drivers_fiscales[terminal_uuid] = DriverTfhka(
+                config["puerto"], baudios=config.get("baudios", 9600), paridad=config.get("paridad", "E"),
+                timeout=config.get("timeout", 3.0), reintentos_nak=config.get("reintentos_nak", 3))
+        return drivers_fiscales[terminal_uuid]
+
+def ejecutar_con_driver(driver, comando_base, argumento, fiscal_dir, lineas_esperadas=None):
+    """Ejecuta el comando con el driver serial. Devuelve el mismo formato que el backend por ejecutable."""
+    log_fiscal.info(f"Ejecutando en [{fiscal_dir}] vía driver serial ({driver.puerto}): {comando_base} {argumento}", extra={"etapa": "ejecucion"})
+    t_intento = time.perf_counter()
+    try:
+        if comando_base == "SendFileCmd":
+            with open(argumento, encoding="latin-1") as f:
+                resultado = driver.enviar_comandos([linea for linea in f.read().splitlines() if linea])
+        elif comando_base == "ReadFpStatus":
+            resultado = driver.leer_estado()
+        else:
+            resultado = driver.enviar_comando(argumento)
+    finally:
+        METRICA_INTENTO.observar(time.perf_counter() - t_intento, os.path.basename(fiscal_dir), comando_base, "serial")
+    if comando_base == "SendFileCmd" and lineas_esperadas and resultado["comandos_enviados"] < lineas_esperadas:
+        raise EnvioParcialError(f"Fallo en SendFileCmd para {fiscal_dir}. Se esperaban {lineas_esperadas}, se enviaron {resultado['comandos_enviados']}.",
+                                resultado["comandos_enviados"])
+    log_fiscal.info(f"Driver serial: {resultado['mensaje']}", extra={"etapa": "ejecucion"})
+    resultado["backend"] = "serial"
+    return resultado
+
+# --- CORTOCIRCUITO POR TERMINAL ---
+
+class ImpresoraNoDisponibleError(Exception):
+    """La solicitud se rechaza sin tocar la impresora. Se responde 'codigo' con 'Retry-After'."""
+    codigo = 503
+
+    def __init__(self, mensaje, reintentar_en_seg, **detalle):
+        super().__init__(mensaje)
+        self.reintentar_en_seg = max(1, math.ceil(reintentar_en_seg))
+        self.detalle = detalle
+
+class CircuitoAbiertoError(ImpresoraNoDisponibleError):
+    """La impresora del terminal viene fallando."""
+
+    def __init__(self, terminal_uuid, reintentar_en_seg, ultimo_error, sondeando=False):
+        motivo = "otra solicitud está comprobando si volvió a responder" if sondeando else "circuito abierto"
+        super().__init__(f"La impresora fiscal de UUID [{terminal_uuid}] está fuera de servicio ({motivo}). "
+                         f"Último error: {ultimo_error}. Reintente en {math.ceil(reintentar_en_seg)}s.", reintentar_en_seg)
+
+class ImpresoraSaturadaError(ImpresoraNoDisponibleError):
+    """Demasiadas solicitudes esperando el lock (429) o el lock no se liberó a tiempo (503)."""
+
+    def __init__(self, mensaje, codigo, reintentar_en_seg, en_espera, espera_lock_ms):
+        super().__init__(mensaje, reintentar_en_seg, en_espera=en_espera, espera_lock_ms=espera_lock_ms)
+        self.codigo = codigo
+
+class TimeoutComandoFiscal(Exception):
+    pass
+
+class SinConexionFiscalError(Exception):
+    """No se llegó a hablar con la impresora: el ejecutable no se pudo lanzar, terminó con error sin respuesta
+    de la impresora o informó un error de comunicación. A diferencia de un rechazo de datos, cuenta para el circuito."""
+
+class EnvioParcialError(Exception):
+    """La impresora aceptó solo parte del archivo (o nada). Con algún comando aceptado no se reintenta:
+    reenviar el archivo repetiría lo que la impresora ya procesó."""
+
+    def __init__(self, mensaje, comandos_enviados):
+        super().__init__(mensaje)
+        self.comandos_enviados = comandos_enviados
+
+def respuesta_no_disponible(e):
+    return {"error": str(e), "reintentar_en_seg": e.reintentar_en_seg, **e.detalle}, e.codigo, {"Retry-After": str(e.reintentar_en_seg)}
+
+def es_fallo_de_conexion(e):
+    """Si el fallo indica que la impresora no está al alcance. Un rechazo de los datos (Error: N de la impresora,
+    envío parcial, respuesta no reconocida, NAK) significa que sí respondió y no cuenta para el circuito."""
+    causa = e.__cause__
+    if isinstance(causa, ErrorDriverTfhka): return causa.error_code in CIRCUITO_ERRORES_IMPRESORA
+    return isinstance(e, (TimeoutComandoFiscal, SinConexionFiscalError))
+
+def es_fallo_inmediato(e):
+    """Timeouts y falta de respuesta de la impresora abren el circuito sin esperar más fallos."""
+    causa = e.__cause__
+    return isinstance(e, TimeoutComandoFiscal) or (isinstance(causa, ErrorDriverTfhka) and causa.error_code in CIRCUITO_ERRORES_IMPRESORA)
+
+def error_de_estado(estado):
+    if estado["error_code"] in CIRCUITO_ERRORES_IMPRESORA:
+        return f"La impresora reporta error {estado['error_code']}: {estado['error_descripcion']}"
+    return None
+
+def admitir_en_circuito(terminal_uuid):
+    """Control antes de hacer fila por el lock. Lanza CircuitoAbiertoError si el circuito está abierto y, pasada
+    la espera, deja pasar solo a la primera solicitud (la que sondeará la impresora): las demás reciben 503
+    mientras el sondeo no se resuelva. Si no se resuelve en CIRCUITO_ESPERA_SEG, la siguiente lo intenta."""
+    if not CIRCUITO_ACTIVO: return
+    with circuitos_lock:
+        circuito = circuitos_fiscales.get(terminal_uuid)
+        if circuito is None or circuito["estado"] == "cerrado": return
+        restante = circuito["reabre"] - time.monotonic()
+        if restante > 0:
+            METRICA_CIRCUITO_RECHAZOS.incrementar(terminal_uuid)
+            if circuito["estado"] == "medio_abierto":
+                raise CircuitoAbiertoError(terminal_uuid, 1, circuito["ultimo_error"], sondeando=True)
+            raise CircuitoAbiertoError(terminal_uuid, restante, circuito["ultimo_error"])
+        circuito.update(estado="medio_abierto", reabre=time.monotonic() + CIRCUITO_ESPERA_SEG)
+
+def comprobar_circuito(terminal_uuid):
+    """Control con el lock de la impresora tomado. Lanza CircuitoAbiertoError si el circuito está abierto.
+    Devuelve True si ya pasó la espera y hay que sondear la impresora antes de usarla (medio abierto)."""
+    if not CIRCUITO_ACTIVO: return False
+    with circuitos_lock:
+        circuito = circuitos_fiscales.get(terminal_uuid)
+        if circuito is None or circuito["estado"] == "cerrado": return False
+        restante = circuito["reabre"] - time.monotonic()
+        if circuito["estado"] == "abierto" and restante > 0:
+            METRICA_CIRCUITO_RECHAZOS.incrementar(terminal_uuid)
+            raise CircuitoAbiertoError(terminal_uuid, restante, circuito["ultimo_error"])
+        if circuito["estado"] == "abierto":
+            circuito.update(estado="medio_abierto", reabre=time.monotonic() + CIRCUITO_ESPERA_SEG)
+        return True
+
+def registrar_resultado_circuito(terminal_uuid, error=None, inmediato=False):
+    if not CIRCUITO_ACTIVO: return
+    with circuitos_lock:
+        circuito = circuitos_fiscales.setdefault(terminal_uuid, {"estado": "cerrado", "fallos": 0, "reabre": None, "ultimo_error": None})
+        if error is None:
+            if circuito["estado"] != "cerrado":
+                log_fiscal.info(f"Circuito CERRADO para UUID [{terminal_uuid}]: la impresora respondió.", extra={"terminal": terminal_uuid})
+            circuito.update(estado="cerrado", fallos=0, reabre=None, ultimo_error=None)
+            return
+        circuito["fallos"] += 1
+        circuito["ultimo_error"] = str(error)
+        if inmediato or circuito["estado"] != "cerrado" or circuito["fallos"] >= CIRCUITO_FALLOS_PARA_ABRIR:
+            circuito.update(estado="abierto", reabre=time.monotonic() + CIRCUITO_ESPERA_SEG)
+            log_fiscal.warning(f"Circuito ABIERTO para UUID [{terminal_uuid}] durante {CIRCUITO_ESPERA_SEG}s tras {circuito['fallos']} fallo(s): {error}",
+                               extra={"terminal": terminal_uuid})
+
+def registrar_fallo_circuito(terminal_uuid, error):
+    if es_fallo_de_conexion(error):
+        registrar_resultado_circuito(terminal_uuid, error, inmediato=es_fallo_inmediato(error))
+    else:
+        registrar_resultado_circuito(terminal_uuid)  # La impresora respondió (rechazó los datos): no está fuera de servicio
+
+def vista_circuito(terminal_uuid):
+    with circuitos_lock:
+        circuito = circuitos_fiscales.get(terminal_uuid)
+        if circuito is None or circuito["estado"] == "cerrado": return None
+        return {"estado": circuito["estado"], "fallos": circuito["fallos"], "ultimo_error": circuito["ultimo_error"],
+                "reintentar_en_seg": max(0, math.ceil(circuito["reabre"] - time.monotonic()))}
+
+def sondear_circuito(terminal_uuid, fiscal_dir):
+    """Circuito medio abierto: un solo ReadFpStatus decide si se cierra o vuelve a abrirse."""
+    ruta_completa_estado = os.path.join(fiscal_dir, f"estado_{uuid.uuid4().hex}.txt")
+    try:
+        resultado = ejecutar_comando_fiscal_sin_circuito("ReadFpStatus", ruta_completa_estado, fiscal_dir, intentos_maximos=1)
+        error = error_de_estado(interpretar_estado_fiscal(resultado, ruta_completa_estado))
+    except Exception as e:
+        error = e
+    finally:
+        if os.path.exists(ruta_completa_estado): os.remove(ruta_completa_estado)
+    registrar_resultado_circuito(terminal_uuid, error, inmediato=True)
+    comprobar_circuito(terminal_uuid)  # Lanza CircuitoAbiertoError si el sondeo falló
+
 def ejecutar_comando_fiscal(comando_base, argumento, fiscal_dir, lineas_esperadas=None, retry_delay=0.3):
+    terminal_uuid = os.path.basename(fiscal_dir)
+    if comprobar_circuito(terminal_uuid):
+        sondear_circuito(terminal_uuid, fiscal_dir)
+    try:
+        resultado = ejecutar_comando_fiscal_sin_circuito(comando_base, argumento, fiscal_dir, lineas_esperadas, retry_delay)
+    except Exception as e:
+        registrar_fallo_circuito(terminal_uuid, e)
+        raise
+    registrar_resultado_circuito(terminal_uuid)
+    return resultado
+
+def ejecutar_comando_fiscal_sin_circuito(comando_base, argumento, fiscal_dir, lineas_esperadas=None, retry_delay=0.3, intentos_maximos=None):
+    terminal_uuid = os.path.basename(fiscal_dir)
+    driver = obtener_driver_fiscal(terminal_uuid)
+    if driver is not None:
+        try:
+            return ejecutar_con_driver(driver, comando_base, argumento, fiscal_dir, lineas_esperadas)
+        except ErrorDriverTfhka as e:
+            # Solo es seguro usar el ejecutable si el driver no llegó a hablar con la impresora
+            if e.conectado or not BACKENDS_FISCALES[terminal_uuid].get("respaldo_ejecutable", True):
+                raise Exception(f"Fallo del driver serial en {fiscal_dir} (comandos aceptados: {e.enviados}, error {e.error_code}): {e}") from e
+            log_fiscal.warning(f"{e}. Usando el ejecutable '{EXECUTABLE_FISCAL}' como respaldo.", extra={"etapa": "ejecucion"})
+    return ejecutar_con_ejecutable(comando_base, argumento, fiscal_dir, lineas_esperadas, retry_delay, intentos_maximos)
+
+def espera_reintento(intento, retry_delay):
+    """Backoff exponencial con jitter: entre la mitad y el total de retry_delay * 2^(intento-1), con tope."""
+    tope = min(REINTENTO_ESPERA_MAXIMA_SEG, retry_delay * 2 ** (intento - 1))
+    return tope / 2 + random.uniform(0, tope / 2)
+
+def armar_comando_ejecutable(comando_base, argumento, fiscal_dir):
     # La ruta al ejecutable usa la variable de configuración global
     tfin_path = os.path.join(fiscal_dir, EXECUTABLE_FISCAL)
     
@@ -233,109 +1410,127 @@ def ejecutar_comando_fiscal(comando_base, argumento, fiscal_dir, lineas_esperada
         # Para Linux, el formato es [ejecutable, comando, argumento]
         comando_completo = [tfin_path, comando_base, argumento]
     # --- FIN DEL CAMBIO ---
+    return tfin_path, comando_completo
 
-    print(f"Ejecutando en [{fiscal_dir}]: {' '.join(comando_completo)}")
-    
-    intentos_maximos = 3 
-    last_exception = None
+def interpretar_salida_ejecutable(comando_base, fiscal_dir, lineas_esperadas, intento, returncode, salida_stdout, salida_stderr):
+    """Valida la salida de un intento del ejecutable. Devuelve el resultado o lanza una excepción (que provoca un reintento)."""
+    terminal_uuid = os.path.basename(fiscal_dir)
+    salida_stdout = salida_stdout.strip()
+    salida_stderr = salida_stderr.strip()
+    log_fiscal.info(f"Intento {intento} - código de salida {returncode}", extra={"etapa": "ejecucion", "intento": intento, "salida": salida_stdout})
+    if salida_stderr: log_fiscal.warning(f"Intento {intento} - salida STDERR", extra={"etapa": "ejecucion", "intento": intento, "salida": salida_stderr})
 
-    for intento in range(1, intentos_maximos + 1):
-        try:
-            resultado_proceso = subprocess.run(
-                comando_completo, capture_output=True, text=True, cwd=fiscal_dir,
-                encoding="latin-1", timeout=45
-            )
-            salida_stdout = resultado_proceso.stdout.strip()
-            salida_stderr = resultado_proceso.stderr.strip()
-            print(f" > Intento {intento} - Salida STDOUT: '{salida_stdout}'")
-            if salida_stderr: print(f" > Intento {intento} - Salida STDERR: '{salida_stderr}'")
-
-            # --- NUEVA LÓGICA DE VALIDACIÓN (MULTI-PLATAFORMA) ---
-            # Se agrega "exitasomente" a la lista de palabras de éxito
-            if resultado_proceso.returncode == 0 or "exitosa" in salida_stdout or "correctamente" in salida_stdout or "exitasomente" in salida_stdout:
+    # --- NUEVA LÓGICA DE VALIDACIÓN (MULTI-PLATAFORMA) ---
+    # Se agrega "exitasomente" a la lista de palabras de éxito
+    if returncode == 0 or "exitosa" in salida_stdout or "correctamente" in salida_stdout or "exitasomente" in salida_stdout:
+        
+        if comando_base == "SendFileCmd":
+            
+            # --- Intento 1: Buscar formato Linux (Enviados X comandos) ---
+            match_enviados = re.search(r"Enviados (\d+) comandos", salida_stdout)
+            if match_enviados:
+                 log_fiscal.debug(f"Detectado formato de respuesta Linux (Enviados {match_enviados.group(1)} comandos).")
+
+            # --- Intento 2: Buscar formato Windows (Retorno: X, Error: 0) ---
+            if not match_enviados:
+                match_win_retorno = re.search(r"Retorno:\s*(\d+)", salida_stdout)
+                match_win_error = re.search(r"Error:\s*(\d+)", salida_stdout)
+                
+                # Si es formato Windows, verificar que sea exitoso
+                if match_win_retorno and match_win_error and "exitasomente" in salida_stdout:
+                    if int(match_win_error.group(1)) == 0:
+                        # ¡Éxito! Asignamos el valor de Retorno al "match"
+                        match_enviados = match_win_retorno 
+                        log_fiscal.debug(f"Detectado formato de respuesta Windows (Retorno: {match_enviados.group(1)}, Error: 0).")
+                    else:
+                        # Es formato Windows, PERO CON ERROR
+                        error_code = int(match_win_error.group(1))
+                        tipo_error = SinConexionFiscalError if error_code in CIRCUITO_ERRORES_IMPRESORA else Exception
+                        raise tipo_error(f"Fallo en SendFileCmd para {fiscal_dir}. El ejecutable reportó Error: {error_code}. Respuesta: {salida_stdout}")
+                # else: (Si no es ni formato Linux ni Windows, se manejará más abajo)
+            
+            # --- LÓGICA UNIFICADA (usa 'match_enviados' de Linux o Windows) ---
+            if match_enviados:
+                comandos_enviados = int(match_enviados.group(1))
                 
-                if comando_base == "SendFileCmd":
-                    
-                    # --- Intento 1: Buscar formato Linux (Enviados X comandos) ---
-                    match_enviados = re.search(r"Enviados (\d+) comandos", salida_stdout)
-                    if match_enviados:
-                         print(f" > Detectado formato de respuesta Linux (Enviados {match_enviados.group(1)} comandos).")
-
-                    # --- Intento 2: Buscar formato Windows (Retorno: X, Error: 0) ---
-                    if not match_enviados:
-                        match_win_retorno = re.search(r"Retorno:\s*(\d+)", salida_stdout)
-                        match_win_error = re.search(r"Error:\s*(\d+)", salida_stdout)
-                        
-                        # Si es formato Windows, verificar que sea exitoso
-                        if match_win_retorno and match_win_error and "exitasomente" in salida_stdout:
-                            if int(match_win_error.group(1)) == 0:
-                                # ¡Éxito! Asignamos el valor de Retorno al "match"
-                                match_enviados = match_win_retorno 
-                                print(f" > Detectado formato de respuesta Windows (Retorno: {match_enviados.group(1)}, Error: 0).")
-                            else:
-                                # Es formato Windows, PERO CON ERROR
-                                error_code = int(match_win_error.group(1))
-                                last_exception = Exception(f"Fallo en SendFileCmd para {fiscal_dir}. El ejecutable reportó Error: {error_code}. Respuesta: {salida_stdout}")
-                                raise last_exception
-                        # else: (Si no es ni formato Linux ni Windows, se manejará más abajo)
-                    
-                    # --- LÓGICA UNIFICADA (usa 'match_enviados' de Linux o Windows) ---
-                    if match_enviados:
-                        comandos_enviados = int(match_enviados.group(1))
-                        
-                        if comandos_enviados == 0 and lineas_esperadas is not None and lineas_esperadas > 0:
-                            last_exception = Exception(f"Fallo en SendFileCmd tras intento {intento}. Respuesta: {salida_stdout}")
-                            if intento < intentos_maximos:
-                                print(f"ADVERTENCIA: El ejecutable reportó 0 comandos enviados en intento {intento}. Reintentando...")
-                                time.sleep(retry_delay) 
-                                continue
-                            else:
-                                raise last_exception 
-                        
-                        elif lineas_esperadas is not None and comandos_enviados >= lineas_esperadas:
-                            return {"exito": True, "mensaje": salida_stdout} 
-                        
-                        elif lineas_esperadas is None or lineas_esperadas == 0:
-                             return {"exito": True, "mensaje": salida_stdout}
-                        
-                        else:
-                            last_exception = Exception(f"Fallo en SendFileCmd para {fiscal_dir}. Se esperaban {lineas_esperadas}, se enviaron {comandos_enviados}. Respuesta: {salida_stdout}")
-                            raise last_exception
-                    
-                    else: 
-                        # --- FALLBACK SI NINGÚN FORMATO COINCIDIÓ ---
-                        # (Esto es lo que causaba el error original)
-                        if not ("exitosa" in salida_stdout or "correctamente" in salida_stdout or "exitasomente" in salida_stdout):
-                            last_exception = Exception(f"Respuesta inesperada de ejecutable para SendFileCmd (formato no reconocido): {salida_stdout}")
-                            raise last_exception
-                        else: # Éxito genérico (sin conteo de comandos)
-                            return {"exito": True, "mensaje": salida_stdout}
+                if comandos_enviados == 0 and lineas_esperadas is not None and lineas_esperadas > 0:
+                    METRICA_CERO_COMANDOS.incrementar(terminal_uuid)
+                    raise EnvioParcialError(f"Fallo en SendFileCmd tras intento {intento}: el ejecutable reportó 0 comandos enviados. Respuesta: {salida_stdout}", 0)
                 
-                else: # Para SendCmd, ReadFpStatus... Éxito
-                    return {"exito": True, "mensaje": salida_stdout}
+                elif lineas_esperadas is not None and comandos_enviados >= lineas_esperadas:
+                    return {"exito": True, "mensaje": salida_stdout, "comandos_enviados": comandos_enviados, "backend": "ejecutable"}
+                
+                elif lineas_esperadas is None or lineas_esperadas == 0:
+                     return {"exito": True, "mensaje": salida_stdout, "comandos_enviados": comandos_enviados, "backend": "ejecutable"}
+                
+                else:
+                    raise EnvioParcialError(f"Fallo en SendFileCmd para {fiscal_dir}. Se esperaban {lineas_esperadas}, se enviaron {comandos_enviados}. Respuesta: {salida_stdout}",
+                                            comandos_enviados)
             
-            else: # Error explícito (return code != 0 y sin palabras de éxito)
-                last_exception = Exception(f"El ejecutable falló en {fiscal_dir}. STDOUT: '{salida_stdout}' | STDERR: '{salida_stderr}'")
-                raise last_exception
+            else: 
+                # --- FALLBACK SI NINGÚN FORMATO COINCIDIÓ ---
+                # (Esto es lo que causaba el error original)
+                if not ("exitosa" in salida_stdout or "correctamente" in salida_stdout or "exitasomente" in salida_stdout):
+                    raise Exception(f"Respuesta inesperada de ejecutable para SendFileCmd (formato no reconocido): {salida_stdout}")
+                else: # Éxito genérico (sin conteo de comandos)
+                    return {"exito": True, "mensaje": salida_stdout, "backend": "ejecutable"}
+        
+        else: # Para SendCmd, ReadFpStatus... Éxito
+            return {"exito": True, "mensaje": salida_stdout, "backend": "ejecutable"}
+    
+    else: # Error explícito (return code != 0 y sin palabras de éxito): el ejecutable no obtuvo respuesta de la impresora
+        raise SinConexionFiscalError(f"El ejecutable falló en {fiscal_dir}. STDOUT: '{salida_stdout}' | STDERR: '{salida_stderr}'")
+
+def ejecutar_con_ejecutable(comando_base, argumento, fiscal_dir, lineas_esperadas=None, retry_delay=0.3, intentos_maximos=None):
+    tfin_path, comando_completo = armar_comando_ejecutable(comando_base, argumento, fiscal_dir)
+    log_fiscal.info(f"Ejecutando en [{fiscal_dir}]: {' '.join(comando_completo)}", extra={"etapa": "ejecucion"})
+    terminal_uuid = os.path.basename(fiscal_dir)
+    
+    intentos_maximos = intentos_maximos or INTENTOS_MAXIMOS_COMANDO_FISCAL
+    limite = time.monotonic() + PLAZO_COMANDO_FISCAL_SEG
+
+    for intento in range(1, intentos_maximos + 1):
+        try:
+            t_intento = time.perf_counter()
+            try:
+                resultado_proceso = subprocess.run(
+                    comando_completo, capture_output=True, text=True, cwd=fiscal_dir,
+                    encoding="latin-1", timeout=min(TIMEOUT_EJECUTABLE_FISCAL_SEG, max(1, limite - time.monotonic()))
+                )
+            finally:
+                METRICA_INTENTO.observar(time.perf_counter() - t_intento, terminal_uuid, comando_base, "ejecutable")
+            return interpretar_salida_ejecutable(comando_base, fiscal_dir, lineas_esperadas, intento,
+                                                 resultado_proceso.returncode, resultado_proceso.stdout, resultado_proceso.stderr)
 
         # --- Manejo de excepciones dentro del bucle (sin cambios) ---
         except subprocess.TimeoutExpired as e:
-            raise Exception(f"Timeout: La impresora en {fiscal_dir} no respondió.") from e
+            METRICA_TIMEOUTS.incrementar(terminal_uuid)
+            raise TimeoutComandoFiscal(f"Timeout: La impresora en {fiscal_dir} no respondió.") from e
         except FileNotFoundError as e:
-            raise Exception(f"EJECUTABLE NO ENCONTRADO en {tfin_path}. Verifica la configuración.") from e
+            raise SinConexionFiscalError(f"EJECUTABLE NO ENCONTRADO en {tfin_path}. Verifica la configuración.") from e
+        except OSError as e:
+            raise SinConexionFiscalError(f"No se pudo lanzar el ejecutable {tfin_path}: {e}") from e
         except Exception as e:
-            last_exception = e
-            if intento < intentos_maximos:
-                print(f"Error en intento {intento}: {e}. Reintentando...")
-                time.sleep(retry_delay)
+            if isinstance(e, EnvioParcialError) and e.comandos_enviados > 0:
+                log_fiscal.error(f"Envío parcial en el intento {intento}; no se reintenta.", extra={"etapa": "ejecucion", "intento": intento})
+                raise
+            espera = espera_reintento(intento, retry_delay)
+            if intento < intentos_maximos and time.monotonic() + espera < limite:
+                log_fiscal.warning(f"Error en intento {intento}: {e}. Reintentando en {espera:.2f}s...", extra={"etapa": "ejecucion", "intento": intento})
+                METRICA_REINTENTOS.incrementar(terminal_uuid)
+                time.sleep(espera)
             else:
-                print(f"Error final tras {intentos_maximos} intentos.")
-                raise last_exception from e
+                log_fiscal.error(f"Error final tras {intento} intentos.", extra={"etapa": "ejecucion", "intento": intento})
+                raise
             
     raise Exception(f"Se alcanzó el final de la función ejecutar_comando_fiscal inesperadamente para {fiscal_dir}.")
 
 def get_and_validate_fiscal_dir(terminal_uuid):
     if not terminal_uuid: raise ValueError("El 'terminalUUID' es obligatorio.")
+    fiscal_dir = registro_terminales.get(terminal_uuid)
+    if fiscal_dir is not None: return fiscal_dir  # Ya validado por el registro
+    if terminal_uuid in terminales_con_problemas: raise FileNotFoundError(terminales_con_problemas[terminal_uuid])
+    # Terminal fuera del registro (o registro inactivo): se valida en disco
     # Usamos abspath para normalizar la ruta (ej. C:\zante en Windows)
     fiscal_dir = os.path.abspath(os.path.join(BASE_FISCAL_PATH, terminal_uuid))
     # Validamos que la ruta generada siga estando dentro de la ruta base permitida
@@ -345,179 +1540,1093 @@ def get_and_validate_fiscal_dir(terminal_uuid):
         raise FileNotFoundError(f"El directorio para el UUID '{terminal_uuid}' no existe en '{fiscal_dir}'.")
     return fiscal_dir
 
-@app.route('/imprimir-factura-fiscal', methods=['POST'])
-def imprimir_factura_fiscal():
+def obtener_lock_impresora(terminal_uuid):
+    impresora_lock = printer_locks.get(terminal_uuid)  # Los terminales del registro ya tienen su lock
+    if impresora_lock is not None: return impresora_lock
+    with locks_dict_lock:
+        if terminal_uuid not in printer_locks:
+            printer_locks[terminal_uuid] = Lock()
+        return printer_locks[terminal_uuid]
+
+def estimar_reintento_lock(terminal_uuid, en_espera):
+    """Segundos hasta que la fila actual probablemente se haya vaciado, según lo que suele durar cada trabajo."""
+    return duracion_media_lock.get(terminal_uuid, 1.0) * (en_espera + 1)
+
+def admitir_espera_lock(terminal_uuid, limitar=True):
+    """Anota una solicitud más esperando el lock, o lanza ImpresoraSaturadaError (429) si la fila está llena."""
+    with esperas_lock_lock:
+        en_espera = esperas_lock.get(terminal_uuid, 0)
+        if limitar and LOCK_MAXIMO_EN_ESPERA and en_espera >= LOCK_MAXIMO_EN_ESPERA:
+            METRICA_LOCK_RECHAZOS.incrementar(terminal_uuid, "fila_llena")
+            raise ImpresoraSaturadaError(f"La impresora fiscal de UUID [{terminal_uuid}] tiene {en_espera} solicitudes en espera. Intente más tarde.",
+                                         429, estimar_reintento_lock(terminal_uuid, en_espera), en_espera, 0)
+        esperas_lock[terminal_uuid] = en_espera + 1
+
+def liberar_espera_lock(terminal_uuid):
+    with esperas_lock_lock:
+        esperas_lock[terminal_uuid] -= 1
+
+def registrar_retencion_lock(terminal_uuid, segundos):
+    with esperas_lock_lock:
+        media = duracion_media_lock.get(terminal_uuid)
+        duracion_media_lock[terminal_uuid] = segundos if media is None else 0.8 * media + 0.2 * segundos
+
+def rechazo_por_espera(terminal_uuid, espera_seg):
+    METRICA_LOCK_RECHAZOS.incrementar(terminal_uuid, "espera_maxima")
+    en_espera = esperas_lock.get(terminal_uuid, 0)
+    return ImpresoraSaturadaError(f"La impresora fiscal de UUID [{terminal_uuid}] no se liberó en {LOCK_ESPERA_MAXIMA_SEG}s "
+                                  f"({en_espera} solicitudes en espera). Intente más tarde.",
+                                  503, estimar_reintento_lock(terminal_uuid, en_espera), en_espera, round(espera_seg * 1000, 1))
+
+@contextmanager
+def bloqueo_impresora(terminal_uuid, limitar=True):
+    """Toma el lock de la impresora midiendo la espera y cuenta el trabajo como en curso mientras lo tiene.
+    Con 'limitar' aplica LOCK_MAXIMO_EN_ESPERA y LOCK_ESPERA_MAXIMA_SEG. Entrega {"espera_lock_ms": ...}."""
+    admitir_en_circuito(terminal_uuid)  # Con el circuito abierto (o sondeándose) no tiene sentido hacer fila por el lock
+    impresora_lock = obtener_lock_impresora(terminal_uuid)
+    t_inicio = time.perf_counter()
+    admitir_espera_lock(terminal_uuid, limitar)
+    try:
+        adquirido = impresora_lock.acquire(timeout=LOCK_ESPERA_MAXIMA_SEG if limitar and LOCK_ESPERA_MAXIMA_SEG else -1)
+    except BaseException:
+        liberar_espera_lock(terminal_uuid)
+        raise
+    liberar_espera_lock(terminal_uuid)
+    espera = time.perf_counter() - t_inicio
+    if not adquirido: raise rechazo_por_espera(terminal_uuid, espera)
+    t_tomado = time.perf_counter()
+    try:
+        METRICA_ESPERA_LOCK.observar(espera, terminal_uuid)
+        METRICA_EN_CURSO.incrementar(terminal_uuid)
+        try:
+            yield {"espera_lock_ms": round(espera * 1000, 1)}
+        finally:
+            METRICA_EN_CURSO.incrementar(terminal_uuid, cantidad=-1)
+            registrar_retencion_lock(terminal_uuid, time.perf_counter() - t_tomado)
+    finally:
+        impresora_lock.release()
+
+codificador_facturas = CodificadorFiscal()
+
+def generar_comandos_factura(data):
+    """Comandos TFHKA de la factura (ver codificador_fiscal.py). Lanza ValueError si algún dato no es válido."""
+    comandos = codificador_facturas.codificar(data, cierre_igtf=IGTF_MODE_ACTIVE)
+    if IGTF_MODE_ACTIVE:
+        log_fiscal.debug("Modo IGTF activo. Añadiendo comando de cierre '199'.")
+    return comandos
+
+def sincronizar_directorio(directorio):
+    # En POSIX el rename solo es durable tras hacer fsync del directorio. Windows no lo permite ni lo necesita.
+    if SISTEMA_OPERATIVO == "Windows": return
+    fd = os.open(directorio, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def escribir_archivo_comandos(fiscal_dir, trabajo_id, comandos_str):
+    """Escribe el archivo de comandos del trabajo de forma atómica y lo verifica por hash. Devuelve la ruta final."""
+    terminal_uuid = os.path.basename(fiscal_dir)
+    datos = comandos_str.replace("\n", os.linesep).encode("latin-1")
+    hash_esperado = hashlib.sha256(datos).hexdigest()
+    ruta_final = os.path.join(fiscal_dir, f"factura_{trabajo_id}.txt")
+    ruta_temporal = f"{ruta_final}.tmp"
+
+    try:
+        # Solo se sincroniza este archivo y su directorio, no todo el sistema ('sync').
+        t_inicio = time.perf_counter()
+        with open(ruta_temporal, "wb") as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta_temporal, ruta_final)
+        sincronizar_directorio(fiscal_dir)
+        METRICA_ESCRITURA.observar(time.perf_counter() - t_inicio, terminal_uuid)
+
+        t_inicio = time.perf_counter()
+        with open(ruta_final, "rb") as f:
+            hash_en_disco = hashlib.sha256(f.read()).hexdigest()
+        METRICA_VALIDACION.observar(time.perf_counter() - t_inicio, terminal_uuid)
+    except Exception as write_err:
+        log_fiscal.error(f"Error escribiendo o sincronizando el archivo de comandos: {write_err}", extra={"etapa": "escritura"})
+        if os.path.exists(ruta_temporal): os.remove(ruta_temporal)
+        raise
+
+    if hash_en_disco != hash_esperado:
+        log_fiscal.error(f"El hash del archivo en disco ({hash_en_disco[:12]}) no coincide con el esperado ({hash_esperado[:12]}).", extra={"etapa": "validacion"})
+        raise Exception("Fallo de validación de I/O: El archivo de comandos en disco no coincide con lo escrito.")
+    log_fiscal.info(f"Archivo '{os.path.basename(ruta_final)}' escrito y verificado (sha256 {hash_esperado[:12]}, {len(datos)} bytes).", extra={"etapa": "validacion"})
+    return ruta_final
+
+def retirar_archivo_comandos(fiscal_dir, ruta_archivo):
+    """Borra el archivo de comandos del trabajo o, si CONSERVAR_ARCHIVOS_FISCALES, lo mueve a 'auditoria'."""
+    try:
+        if CONSERVAR_ARCHIVOS_FISCALES:
+            carpeta_auditoria = os.path.join(fiscal_dir, "auditoria")
+            os.makedirs(carpeta_auditoria, exist_ok=True)
+            os.replace(ruta_archivo, os.path.join(carpeta_auditoria, os.path.basename(ruta_archivo)))
+        else:
+            os.remove(ruta_archivo)
+    except OSError as e:
+        log_fiscal.warning(f"No se pudo retirar el archivo de comandos '{ruta_archivo}': {e}")
+
+# --- DIARIO DE TRABAJOS FISCALES (WRITE-AHEAD) ---
+
+def _ruta_diario_fiscal():
+    return os.path.join(BASE_FISCAL_PATH, ARCHIVO_DIARIO_FISCAL)
+
+class DiarioFiscal:
+    """Diario de solo anexado con un hilo escritor. anotar() devuelve un Future que se resuelve cuando la línea
+    está en disco; quien no necesita esperar (todo salvo 'enviando') simplemente lo ignora. Cada
+    DIARIO_COMPACTAR_CERRADOS trabajos cerrados, el mismo hilo reescribe el archivo sin ellos."""
+
+    def __init__(self):
+        self._pendientes = []
+        self._condicion = Condition()
+        self._escritura_lock = Lock()
+        self._archivo = None
+        self._separar = False
+        self._hilo = None
+        self._cerrados = 0  # Trabajos cerrados escritos desde la última compactación
+
+    def anotar(self, trabajo_id, evento, **campos):
+        futuro = Future()
+        if not DIARIO_FISCAL_ACTIVO:
+            futuro.set_result(None)
+            return futuro
+        linea = json.dumps({"t": _marca_tiempo(), "trabajo": trabajo_id, "evento": evento, **campos}, ensure_ascii=False)
+        cierra = evento == "resuelto" or (evento == "resultado" and not campos.get("incierto"))
+        with self._condicion:
+            self._pendientes.append((linea, futuro, cierra))
+            if self._hilo is None:
+                self._hilo = Thread(target=self._bucle_escritor, name="diario-fiscal", daemon=True)
+                self._hilo.start()
+            self._condicion.notify()
+        return futuro
+
+    def reemplazar(self, lineas):
+        """Reescribe el diario completo de forma atómica (compactación al arrancar)."""
+        with self._escritura_lock:
+            self._reescribir(lineas)
+
+    def _reescribir(self, lineas):
+        ruta = _ruta_diario_fiscal()
+        self._descartar_archivo()
+        with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+            f.write("".join(linea + "\n" for linea in lineas))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{ruta}.tmp", ruta)
+        sincronizar_directorio(os.path.dirname(ruta))
+        self._separar = False  # Una línea cortada por un fallo anterior no sobrevive a la relectura
+
+    def _compactar(self):
+        """Reescribe el diario dejando solo los trabajos en curso o sin resolver. Corre en el hilo escritor:
+        nadie más anexa mientras se relee, y con el lock de escritura tampoco se cruza con reemplazar()."""
+        self._cerrados = 0
+        try:
+            with self._escritura_lock:
+                trabajos = leer_diario_fiscal()
+                self._reescribir([linea for trabajo in trabajos.values() if not trabajo_cerrado(trabajo["eventos"])
+                                  for linea in trabajo["lineas"]])
+        except OSError as e:
+            log_fiscal.error(f"No se pudo compactar el diario fiscal '{_ruta_diario_fiscal()}': {e}", extra={"etapa": "diario"})
+            return
+        METRICA_DIARIO_COMPACTACIONES.incrementar()
+
+    def _descartar_archivo(self):
+        archivo, self._archivo = self._archivo, None
+        if archivo is not None:
+            try:
+                archivo.close()
+            except OSError:
+                pass
+
+    def _escribir(self, lineas):
+        with self._escritura_lock:
+            if self._archivo is None:
+                ruta = _ruta_diario_fiscal()
+                nuevo = not os.path.exists(ruta)
+                self._archivo = open(ruta, "a", encoding="utf-8")
+                if nuevo: sincronizar_directorio(os.path.dirname(ruta))
+            # Tras un fallo pudo quedar una línea a medias: se empieza en una línea nueva para no pegarse a ella
+            texto = ("\n" if self._separar else "") + "".join(linea + "\n" for linea in lineas)
+            self._archivo.write(texto)
+            self._archivo.flush()
+            os.fsync(self._archivo.fileno())
+            self._separar = False
+
+    def _bucle_escritor(self):
+        while True:
+            with self._condicion:
+                while not self._pendientes: self._condicion.wait()
+                grupo, self._pendientes = self._pendientes, []
+            t_inicio = time.perf_counter()
+            try:
+                self._escribir([linea for linea, _, _ in grupo])
+            except Exception as e:
+                log_fiscal.error(f"No se pudo escribir el diario fiscal '{_ruta_diario_fiscal()}': {e}", extra={"etapa": "diario"})
+                self._descartar_archivo()
+                self._separar = True
+                for _, futuro, _ in grupo: futuro.set_exception(e)
+                continue
+            METRICA_DIARIO_FSYNC.observar(time.perf_counter() - t_inicio)
+            METRICA_DIARIO_GRUPOS.incrementar()
+            METRICA_DIARIO_ANOTACIONES.incrementar(cantidad=len(grupo))
+            self._cerrados += sum(cierra for _, _, cierra in grupo)
+            if DIARIO_COMPACTAR_CERRADOS and self._cerrados >= DIARIO_COMPACTAR_CERRADOS: self._compactar()
+            for _, futuro, _ in grupo: futuro.set_result(None)
+
+diario_fiscal = DiarioFiscal()
+
+def resultado_incierto(error):
+    """Si un fallo después de empezar a enviar deja la duda de qué imprimió la impresora."""
+    if isinstance(error, ImpresoraNoDisponibleError): return False
+    aceptados = comandos_aceptados(error)
+    return aceptados is None or aceptados > 0
+
+class TrabajoEnDiario:
+    """Ciclo de vida de un trabajo fiscal en el diario. Anota 'recibido' al crearse y, al salir del 'with',
+    el resultado (si no se anotó antes con resultado()). Llamar a enviando() justo antes de lanzar el comando."""
+
+    def __init__(self, trabajo_id, terminal_uuid, tipo, **detalle):
+        self.trabajo_id, self.terminal_uuid, self.tipo, self.detalle = trabajo_id, terminal_uuid, tipo, detalle
+        self.recibido = _marca_tiempo()
+        self.enviado = False
+        self.terminado = False
+        diario_fiscal.anotar(trabajo_id, "recibido", terminal=terminal_uuid, tipo=tipo, **detalle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo_excepcion, excepcion, traza):
+        # Un KeyboardInterrupt o SystemExit no anota nada: lo decide la recuperación al arrancar
+        if excepcion is None or isinstance(excepcion, Exception): self.resultado(excepcion)
+        return False
+
+    def archivo(self, ruta_archivo):
+        diario_fiscal.anotar(self.trabajo_id, "archivo", archivo=os.path.basename(ruta_archivo))
+
+    def anotar_enviando(self):
+        """Devuelve el Future de 'enviando'; tras resolverlo, marcar 'enviado' y recién entonces lanzar el comando."""
+        return diario_fiscal.anotar(self.trabajo_id, "enviando")
+
+    def enviando(self):
+        self.anotar_enviando().result()
+        self.enviado = True
+
+    def resultado(self, error=None):
+        if self.terminado: return
+        self.terminado = True
+        if error is None:
+            diario_fiscal.anotar(self.trabajo_id, "resultado", exito=True)
+            return
+        incierto = self.enviado and resultado_incierto(error)
+        aceptados = comandos_aceptados(error)
+        diario_fiscal.anotar(self.trabajo_id, "resultado", exito=False, error=str(error), incierto=incierto,
+                             **({"comandos_enviados": aceptados} if aceptados is not None else {}))
+        if incierto:
+            error.trabajo_incierto = self.trabajo_id  # Quien responda al cliente sabe que no debe reintentarse a ciegas
+            registrar_sin_resolver(self.trabajo_id, self.terminal_uuid, self.tipo, f"Falló después de empezar a enviarse: {error}",
+                                   self.recibido, self.detalle)
+
+def registrar_sin_resolver(trabajo_id, terminal_uuid, tipo, motivo, recibido=None, detalle=None, revision=None, estado_impresora=None):
+    with diario_lock:
+        trabajos_sin_resolver[trabajo_id] = {"trabajo_id": trabajo_id, "terminalUUID": terminal_uuid, "tipo": tipo, "recibido": recibido,
+                                             "detalle": detalle or {}, "motivo": motivo, "revision": revision, "estado_impresora": estado_impresora}
+    log_fiscal.warning(f"Trabajo [{trabajo_id}] sin resolver: {motivo}", extra={"terminal": terminal_uuid, "trabajo": trabajo_id, "etapa": "diario"})
+
+def resolver_trabajo(trabajo_id, resolucion, **campos):
+    """Anota en el diario cómo se resolvió un trabajo y lo quita de la lista. Devuelve su detalle o None si no estaba."""
+    with diario_lock:
+        if trabajo_id not in trabajos_sin_resolver: return None
+    diario_fiscal.anotar(trabajo_id, "resuelto", resolucion=resolucion, **campos).result()
+    with diario_lock:
+        pendiente = trabajos_sin_resolver.pop(trabajo_id, None)
+    if pendiente is not None:
+        log_fiscal.info(f"Trabajo [{trabajo_id}] resuelto como '{resolucion}'.", extra={"terminal": pendiente["terminalUUID"], "trabajo": trabajo_id, "etapa": "diario"})
+    return pendiente
+
+def trabajo_cerrado(eventos):
+    """Un trabajo resuelto a mano o con un resultado conocido ya no hace falta en el diario."""
+    resultado = eventos.get("resultado")
+    return "resuelto" in eventos or (resultado is not None and not resultado.get("incierto"))
+
+def leer_diario_fiscal():
+    """Agrupa las líneas del diario por trabajo, en orden. Ignora las líneas vacías o cortadas por una caída."""
+    trabajos = {}
+    with open(_ruta_diario_fiscal(), encoding="utf-8") as f:
+        for numero, linea in enumerate(f, 1):
+            linea = linea.strip()
+            if not linea: continue
+            try:
+                registro = json.loads(linea)
+                trabajo = trabajos.setdefault(registro["trabajo"], {"lineas": [], "eventos": {}})
+                trabajo["eventos"][registro["evento"]] = registro
+            except (ValueError, KeyError, TypeError):
+                log_fiscal.warning(f"Línea {numero} del diario fiscal ilegible; se ignora.", extra={"etapa": "diario"})
+                continue
+            trabajo["lineas"].append(linea)
+    return trabajos
+
+def recuperar_diario_fiscal():
+    """Relee el diario de la ejecución anterior y lo compacta dejando solo los trabajos sin resolver.
+    Devuelve los que quedaron enviándose sin resultado, para consultar el estado de su impresora."""
+    try:
+        trabajos = leer_diario_fiscal()
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        log_fiscal.error(f"No se pudo leer el diario fiscal '{_ruta_diario_fiscal()}': {e}", extra={"etapa": "diario"})
+        return []
+    por_revisar, conservar = [], []
+    for trabajo_id, trabajo in trabajos.items():
+        eventos = trabajo["eventos"]
+        recibido = eventos.get("recibido") or eventos.get("encolado") or {}
+        resultado = eventos.get("resultado")
+        if trabajo_cerrado(eventos): continue
+        if resultado is None and "enviando" not in eventos:
+            if "encolado" not in eventos:
+                log_fiscal.info(f"Trabajo [{trabajo_id}] interrumpido antes de enviarse a la impresora; se descarta.",
+                                extra={"terminal": recibido.get("terminal"), "trabajo": trabajo_id, "etapa": "diario"})
+                continue
+            # El cliente recibió 202: hay que avisarle que la factura no se imprimió
+            motivo = "Aceptada en la cola fiscal, pero el servidor se detuvo antes de enviarla: no se imprimió."
+        elif resultado is None:
+            motivo = "El servidor se detuvo mientras se enviaba a la impresora."
+            # Ya revisado en un arranque anterior: no se vuelve a decidir por el estado, que pudo cambiar a mano
+            if "revisado" not in eventos: por_revisar.append(trabajo_id)
+        else:
+            motivo = f"Falló después de empezar a enviarse: {resultado.get('error')}"
+        conservar.extend(trabajo["lineas"])
+        detalle = {k: v for k, v in recibido.items() if k not in ("t", "trabajo", "evento", "terminal", "tipo")}
+        revisado = eventos.get("revisado", {})
+        registrar_sin_resolver(trabajo_id, recibido.get("terminal"), recibido.get("tipo"), motivo, recibido.get("t"), detalle,
+                               revisado.get("revision"), revisado.get("estado_impresora"))
+    try:
+        diario_fiscal.reemplazar(conservar)
+    except OSError as e:
+        log_fiscal.error(f"No se pudo compactar el diario fiscal '{_ruta_diario_fiscal()}': {e}", extra={"etapa": "diario"})
+    log_fiscal.info(f"Diario fiscal recuperado: {len(trabajos)} trabajos, {len(trabajos_sin_resolver)} sin resolver, "
+                    f"{len(por_revisar)} por revisar con ReadFpStatus.", extra={"etapa": "diario"})
+    return por_revisar
+
+def reconciliar_trabajo(trabajo_id):
+    """Decide con el estado de la impresora un trabajo que quedó enviándose cuando el servidor se detuvo.
+    En espera (4) y sin error no quedó documento abierto; cualquier otro estado queda para revisión manual."""
+    with diario_lock:
+        pendiente = trabajos_sin_resolver.get(trabajo_id)
+    if pendiente is None: return
+    terminal_uuid = pendiente["terminalUUID"]
+    try:
+        fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
+        with contexto_log(terminal=terminal_uuid, trabajo=trabajo_id), bloqueo_impresora(terminal_uuid, limitar=False):
+            estado = leer_estado_fiscal(terminal_uuid, fiscal_dir)
+    except Exception as e:
+        revision, estado = f"No se pudo leer el estado de la impresora: {e}", None
+    else:
+        if estado["status_code"] == 4 and estado["error_code"] == 0:
+            try:
+                resolver_trabajo(trabajo_id, "cerrado", por="estado_impresora", estado_impresora=estado)
+                return
+            except Exception as e:
+                log_fiscal.error(f"No se pudo anotar la resolución del trabajo [{trabajo_id}]: {e}", extra={"terminal": terminal_uuid, "etapa": "diario"})
+        revision = f"{estado['status_descripcion']} {estado['error_descripcion']} Revisar la impresora a mano."
+    diario_fiscal.anotar(trabajo_id, "revisado", revision=revision, estado_impresora=estado)
+    with diario_lock:
+        if trabajo_id in trabajos_sin_resolver: trabajos_sin_resolver[trabajo_id].update(revision=revision, estado_impresora=estado)
+    log_fiscal.warning(f"Trabajo [{trabajo_id}] sigue sin resolver: {revision}", extra={"terminal": terminal_uuid, "trabajo": trabajo_id, "etapa": "diario"})
+
+def _reconciliar_trabajos(trabajo_ids):
+    for trabajo_id in trabajo_ids:
+        reconciliar_trabajo(trabajo_id)
+
+def iniciar_diario_fiscal():
+    por_revisar = recuperar_diario_fiscal()
+    # Las consultas a las impresoras pueden tardar: el servidor empieza a atender mientras tanto
+    if por_revisar: Thread(target=_reconciliar_trabajos, args=(por_revisar,), name="diario-recuperacion", daemon=True).start()
+
+@app.route('/trabajos-sin-resolver', methods=['GET'])
+def listar_trabajos_sin_resolver():
+    terminal_uuid = request.args.get('terminalUUID')
+    with diario_lock:
+        trabajos = [dict(t) for t in trabajos_sin_resolver.values() if not terminal_uuid or t['terminalUUID'] == terminal_uuid]
+    return jsonify({"trabajos": trabajos}), 200
+
+@app.route('/trabajos-sin-resolver/<trabajo_id>', methods=['POST'])
+def resolver_trabajo_manual(trabajo_id):
+    """Cierra un trabajo tras revisar la impresora a mano: {"resolucion": "impreso" | "no_impreso", "nota": "..."}."""
     data = request.get_json()
     if not data: return jsonify({"error": "No se recibieron datos"}), 400
+    resolucion = data.get("resolucion")
+    if resolucion not in RESOLUCIONES_MANUALES:
+        return jsonify({"error": f"'resolucion' debe ser una de {list(RESOLUCIONES_MANUALES)}."}), 400
+    try:
+        pendiente = resolver_trabajo(trabajo_id, resolucion, por="manual", nota=data.get("nota"))
+    except Exception as e:
+        return jsonify({"error": f"No se pudo anotar la resolución en el diario fiscal: {e}"}), 500
+    if pendiente is None: return jsonify({"error": f"Trabajo '{trabajo_id}' no está sin resolver."}), 404
+    return jsonify({"message": f"Trabajo '{trabajo_id}' resuelto como '{resolucion}'.", "trabajo": pendiente}), 200
 
-    fiscal_dir = None
-    ruta_archivo_completa = None
-    impresora_lock = None
-    
+def procesar_factura_fiscal(terminal_uuid, fiscal_dir, comandos, trabajo_id=None):
+    """Escribe el archivo de comandos y lo envía a la impresora. Debe llamarse con el lock de la impresora tomado."""
+    trabajo_id = trabajo_id or uuid.uuid4().hex
+    with TrabajoEnDiario(trabajo_id, terminal_uuid, "factura", comandos=len(comandos)) as diario:
+        ruta_archivo_completa = escribir_archivo_comandos(fiscal_dir, trabajo_id, "\n".join(comandos))
+        diario.archivo(ruta_archivo_completa)
+        try:
+            diario.enviando()
+            return ejecutar_comando_fiscal("SendFileCmd", ruta_archivo_completa, fiscal_dir, lineas_esperadas=len(comandos))
+        finally:
+            retirar_archivo_comandos(fiscal_dir, ruta_archivo_completa)
+
+# --- REGISTRO DE TERMINALES ---
+
+def _ejecutable_de(fiscal_dir):
+    ruta = os.path.join(fiscal_dir, EXECUTABLE_FISCAL)
+    if SISTEMA_OPERATIVO == "Windows" and not os.path.isfile(ruta): ruta += ".exe"
+    return ruta
+
+def _carpetas_terminales(base):
+    with os.scandir(base) as entradas:
+        return sorted((e for e in entradas if not e.name.startswith('.') and e.is_dir()), key=lambda e: e.name)
+
+def _firma_ejecutable(fiscal_dir):
+    try:
+        estado = os.stat(_ejecutable_de(fiscal_dir))
+    except OSError:
+        return None
+    return estado.st_mtime_ns, estado.st_size, estado.st_mode
+
+def firma_carpetas():
+    """Carpetas de BASE_FISCAL_PATH y fecha, tamaño y permisos del ejecutable de cada una. No se usa la fecha de
+    las carpetas: cambia con cada archivo de factura o de estado y forzaría un escaneo completo en cada revisión."""
+    base = os.path.abspath(BASE_FISCAL_PATH)
+    return tuple((e.name, _firma_ejecutable(e.path)) for e in _carpetas_terminales(base))
+
+def escanear_terminales():
+    """Revisa las carpetas de BASE_FISCAL_PATH. Devuelve ({uuid: carpeta} válidos, {uuid: problema})."""
+    base = os.path.abspath(BASE_FISCAL_PATH)
+    validos, problemas = {}, {}
+    for entrada in _carpetas_terminales(base):
+        ejecutable = _ejecutable_de(entrada.path)
+        serial = BACKENDS_FISCALES.get(entrada.name, {}).get("backend") == "serial"
+        if os.path.isfile(ejecutable):
+            if SISTEMA_OPERATIVO != "Windows" and not os.access(ejecutable, os.X_OK):
+                problemas[entrada.name] = f"El ejecutable '{ejecutable}' no tiene permiso de ejecución (chmod +x)."
+                continue
+        elif not serial:
+            problemas[entrada.name] = f"EJECUTABLE NO ENCONTRADO en {ejecutable}. Verifica la configuración."
+            continue
+        validos[entrada.name] = entrada.path
+    for terminal_uuid in BACKENDS_FISCALES:
+        if terminal_uuid not in validos and terminal_uuid not in problemas:
+            problemas[terminal_uuid] = f"El directorio para el UUID '{terminal_uuid}' no existe en '{os.path.join(base, terminal_uuid)}'."
+    return validos, problemas
+
+def actualizar_registro_terminales(motivo):
+    """Vuelve a escanear las carpetas y reemplaza el índice. Prepara lock, driver y cola de cada terminal nuevo."""
+    global registro_terminales, terminales_con_problemas
+    with registro_lock:
+        try:
+            firma = firma_carpetas()  # Antes de escanear: un cambio durante el escaneo provoca otra recarga
+            validos, problemas = escanear_terminales()
+        except OSError as e:
+            log_fiscal.error(f"No se pudo escanear '{BASE_FISCAL_PATH}' ({motivo}): {e}")
+            return False
+        for terminal_uuid in validos.keys() - registro_terminales.keys():
+            obtener_lock_impresora(terminal_uuid)
+            obtener_driver_fiscal(terminal_uuid)
+            if COLA_FISCAL_ACTIVA: obtener_cola_fiscal(terminal_uuid)
+        for terminal_uuid, problema in problemas.items():
+            if terminales_con_problemas.get(terminal_uuid) != problema:
+                log_fiscal.warning(f"Terminal [{terminal_uuid}] mal configurado: {problema}", extra={"terminal": terminal_uuid})
+        agregados, retirados = validos.keys() - registro_terminales.keys(), registro_terminales.keys() - validos.keys()
+        # Se reemplazan los diccionarios completos: las solicitudes leen el índice sin tomar registro_lock
+        registro_terminales, terminales_con_problemas = validos, problemas
+        registro_info.update(actualizado=_marca_tiempo(), firma=firma)
+    if agregados or retirados or motivo != "cambio":
+        log_fiscal.info(f"Registro de terminales ({motivo}): {len(validos)} listos, {len(problemas)} con problemas"
+                        + (f", nuevos: {sorted(agregados)}" if agregados and motivo == "cambio" else "")
+                        + (f", retirados: {sorted(retirados)}" if retirados else "") + ".")
+    return True
+
+def _bucle_registro_terminales():
+    while True:
+        recarga_pedida = evento_recarga_registro.wait(INTERVALO_REVISION_REGISTRO_SEG)
+        evento_recarga_registro.clear()
+        if recarga_pedida:
+            actualizar_registro_terminales("señal")
+            continue
+        try:
+            if firma_carpetas() != registro_info["firma"]: actualizar_registro_terminales("cambio")
+        except OSError as e:
+            log_fiscal.warning(f"No se pudo revisar '{BASE_FISCAL_PATH}': {e}")
+
+def iniciar_registro_terminales():
+    actualizar_registro_terminales("arranque")
+    Thread(target=_bucle_registro_terminales, name="registro-terminales", daemon=True).start()
+    # La señal solo puede instalarse desde el hilo principal; el handler solo despierta al hilo del registro
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: evento_recarga_registro.set())
+
+@app.route('/terminales', methods=['GET'])
+def listar_terminales():
+    """Terminales del registro y los que tienen problemas de configuración (?recargar=1 vuelve a escanear)."""
+    validos, problemas = registro_terminales, terminales_con_problemas
+    try:
+        if registro_info["actualizado"] is None:  # Registro inactivo: solo se muestra lo que hay en disco
+            validos, problemas = escanear_terminales()
+        elif request.args.get('recargar') in ('1', 'true'):
+            if not actualizar_registro_terminales("solicitud"): raise OSError("ver el log del servidor")
+            validos, problemas = registro_terminales, terminales_con_problemas
+    except OSError as e:
+        return jsonify({"error": f"No se pudo escanear '{BASE_FISCAL_PATH}': {e}"}), 500
+    terminales = {
+        terminal_uuid: {"fiscal_dir": fiscal_dir, "backend": "serial" if obtener_driver_fiscal(terminal_uuid) else "ejecutable",
+                        "en_cola": colas_fiscales[terminal_uuid].qsize() if terminal_uuid in colas_fiscales else 0}
+        for terminal_uuid, fiscal_dir in validos.items()
+    }
+    return jsonify({"terminales": terminales, "problemas": problemas, "actualizado": registro_info["actualizado"]}), 200
+
+# --- COLA FISCAL: UN HILO DE TRABAJO POR TERMINAL ---
+
+def _marca_tiempo():
+    return datetime.now().isoformat(timespec='milliseconds')
+
+def _vista_trabajo(trabajo):
+    return {k: v for k, v in trabajo.items() if not k.startswith('_')}
+
+def _trabajador_cola_fiscal(terminal_uuid, cola):
+    while True:
+        trabajo = cola.get()
+        try:
+            with trabajos_lock:
+                trabajo['estado'] = 'en_proceso'
+                trabajo['iniciado'] = _marca_tiempo()
+                trabajo['espera_ms'] = round((time.monotonic() - trabajo['_t_creado']) * 1000, 1)
+            t_inicio = time.monotonic()
+            procesando = False
+            try:
+                with contexto_log(terminal=terminal_uuid, trabajo=trabajo['id']), bloqueo_impresora(terminal_uuid, limitar=False):
+                    log_fiscal.info("[LOCK ADQUIRIDO] Procesando factura encolada", extra={"etapa": "lock"})
+                    procesando = True  # Desde aquí TrabajoEnDiario anota el resultado
+                    respuesta = procesar_factura_fiscal(terminal_uuid, trabajo['_fiscal_dir'], trabajo['_comandos'], trabajo['id'])
+                    log_fiscal.info("[LOCK LIBERADO] Factura encolada procesada", extra={"etapa": "lock"})
+                estado, resultado = 'completado', {"respuesta_impresora": respuesta.get('mensaje')}
+            except Exception as e:
+                log_fiscal.exception(f"Trabajo fallido: {e}", extra={"terminal": terminal_uuid, "trabajo": trabajo['id']})
+                estado, resultado = 'fallido', {"error": str(e)}
+                # Falló antes de tocar la impresora (p. ej. circuito abierto): se cierra el 'encolado' en el diario
+                if not procesando: diario_fiscal.anotar(trabajo['id'], "resultado", exito=False, error=str(e), incierto=False)
+            with trabajos_lock:
+                trabajo.update(resultado)
+                trabajo['estado'] = estado
+                trabajo['finalizado'] = _marca_tiempo()
+                trabajo['duracion_ms'] = round((time.monotonic() - t_inicio) * 1000, 1)
+                trabajo.pop('_comandos', None)
+                trabajos_fiscales_terminados.append(trabajo['id'])
+                while len(trabajos_fiscales_terminados) > TRABAJOS_FISCALES_RETENIDOS:
+                    trabajos_fiscales.pop(trabajos_fiscales_terminados.popleft(), None)
+        finally:
+            cola.task_done()
+
+def obtener_cola_fiscal(terminal_uuid):
+    with locks_dict_lock:
+        if terminal_uuid not in colas_fiscales:
+            cola = queue.Queue(maxsize=COLA_FISCAL_TAMANO_MAXIMO)
+            Thread(target=_trabajador_cola_fiscal, args=(terminal_uuid, cola), name=f"cola-fiscal-{terminal_uuid}", daemon=True).start()
+            colas_fiscales[terminal_uuid] = cola
+        return colas_fiscales[terminal_uuid]
+
+def encolar_factura_fiscal(terminal_uuid, fiscal_dir, comandos):
+    """Registra un trabajo y lo pone en la cola del terminal. Lanza queue.Full si la cola está llena."""
+    trabajo = {
+        "id": uuid.uuid4().hex, "terminalUUID": terminal_uuid, "estado": "en_cola", "creado": _marca_tiempo(),
+        "iniciado": None, "finalizado": None, "espera_ms": None, "duracion_ms": None,
+        "_t_creado": time.monotonic(), "_fiscal_dir": fiscal_dir, "_comandos": comandos,
+    }
+    with trabajos_lock:
+        trabajos_fiscales[trabajo['id']] = trabajo
+    try:
+        obtener_cola_fiscal(terminal_uuid).put_nowait(trabajo)
+    except queue.Full:
+        with trabajos_lock:
+            trabajos_fiscales.pop(trabajo['id'], None)
+        raise
+    diario_fiscal.anotar(trabajo['id'], "encolado", terminal=terminal_uuid, tipo="factura")
+    return trabajo
+
+# --- IDEMPOTENCIA: UNA FACTURA POR 'Idempotency-Key' ---
+
+def _ruta_archivo_idempotencia():
+    return os.path.join(BASE_FISCAL_PATH, ARCHIVO_IDEMPOTENCIA)
+
+def _cargar_idempotencia():
+    """Carga las claves guardadas por una ejecución anterior. Debe llamarse con idempotencia_lock tomado."""
+    global idempotencia_cargada
+    idempotencia_cargada = True
+    try:
+        with open(_ruta_archivo_idempotencia(), encoding="utf-8") as f:
+            entradas = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log_fiscal.warning(f"No se pudo leer '{_ruta_archivo_idempotencia()}': {e}. Se empieza sin claves de idempotencia.")
+        return
+    ahora = time.time()
+    for clave, entrada in sorted(entradas.items(), key=lambda par: par[1]["t"]):
+        if ahora - entrada["t"] >= IDEMPOTENCIA_TTL_SEG: continue
+        # Una factura en proceso cuando el servidor se detuvo pudo imprimirse o no
+        if entrada["estado"] == "en_proceso": entrada["estado"] = "interrumpido"
+        entrada["_evento"] = Event()
+        entrada["_evento"].set()
+        almacen_idempotencia[clave] = entrada
+
+def _purgar_idempotencia(ahora):
+    # Las claves se insertan en orden cronológico: las más antiguas están al principio
+    while almacen_idempotencia:
+        entrada = next(iter(almacen_idempotencia.values()))
+        if ahora - entrada["t"] < IDEMPOTENCIA_TTL_SEG and len(almacen_idempotencia) <= IDEMPOTENCIA_MAXIMO_CLAVES: break
+        almacen_idempotencia.popitem(last=False)
+
+def guardar_idempotencia():
+    """Persiste las claves de forma atómica (archivo temporal, fsync y rename)."""
+    ruta = _ruta_archivo_idempotencia()
+    with idempotencia_archivo_lock:
+        with idempotencia_lock:
+            instantanea = {clave: {k: v for k, v in entrada.items() if not k.startswith('_')} for clave, entrada in almacen_idempotencia.items()}
+        try:
+            with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+                json.dump(instantanea, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{ruta}.tmp", ruta)
+            sincronizar_directorio(os.path.dirname(ruta))
+        except OSError as e:
+            log_fiscal.warning(f"No se pudo guardar '{ruta}': {e}")
+
+def reservar_idempotencia(clave, huella, terminal_uuid):
+    """Devuelve (entrada, propia). Si 'propia', el llamador procesa la factura y luego llama a completar_idempotencia."""
+    with idempotencia_lock:
+        if not idempotencia_cargada: _cargar_idempotencia()
+        _purgar_idempotencia(time.time())
+        entrada = almacen_idempotencia.get(clave)
+        if entrada is not None: return entrada, False
+        entrada = almacen_idempotencia[clave] = {
+            "huella": huella, "terminalUUID": terminal_uuid, "estado": "en_proceso", "t": time.time(),
+            "codigo": None, "respuesta": None, "_evento": Event(),
+        }
+    # Se persiste antes de imprimir: si el servidor cae a mitad de la factura, el reintento no la repite
+    guardar_idempotencia()
+    return entrada, True
+
+def completar_idempotencia(clave, entrada, respuesta, codigo):
+    with idempotencia_lock:
+        entrada["respuesta"], entrada["codigo"] = respuesta, codigo
+        if codigo < 300:
+            entrada["estado"] = "completado"
+        elif respuesta.get("resultado_incierto"):
+            # La impresora pudo aceptar parte de la factura: un reintento con la misma clave podría duplicarla
+            entrada["estado"] = "interrumpido"
+        else:
+            # Si nada llegó a la impresora, un reintento con la misma clave vuelve a intentarla
+            entrada["estado"] = "fallido"
+            if almacen_idempotencia.get(clave) is entrada: del almacen_idempotencia[clave]
+    entrada["_evento"].set()
+    guardar_idempotencia()
+
+def responder_duplicado(entrada, huella, espera=None):
+    """Respuesta para una solicitud cuya clave ya existe. Devuelve (cuerpo, código, cabeceras)."""
+    if entrada["huella"] != huella:
+        METRICA_IDEMPOTENCIA.incrementar("conflicto")
+        return {"error": "La cabecera Idempotency-Key ya se usó con una factura distinta."}, 422, {}
+    if not entrada["_evento"].wait(IDEMPOTENCIA_ESPERA_SEG if espera is None else espera):
+        METRICA_IDEMPOTENCIA.incrementar("en_proceso")
+        return {"error": "La factura con esta Idempotency-Key sigue en proceso. Intente más tarde."}, 409, {"Retry-After": "5"}
+    if entrada["estado"] == "interrumpido":
+        METRICA_IDEMPOTENCIA.incrementar("interrumpido")
+        if entrada["respuesta"] is not None:
+            trabajo_id = entrada["respuesta"].get("trabajo_id")
+            return {"error": f"Esta factura falló después de empezar a enviarse a la impresora (trabajo [{trabajo_id}]). Verifique en la impresora "
+                             "si se emitió y resuélvalo en /trabajos-sin-resolver antes de reenviarla con otra Idempotency-Key.",
+                    "trabajo_id": trabajo_id}, 409, {}
+        return {"error": "El servidor se reinició mientras se imprimía esta factura. Verifique en la impresora si se emitió antes de reenviarla con otra Idempotency-Key."}, 409, {}
+    METRICA_IDEMPOTENCIA.incrementar("repetido")
+    return entrada["respuesta"], entrada["codigo"], {"Idempotent-Replayed": "true"}
+
+def detalle_incierto(error):
+    """Campos extra de la respuesta si la factura falló después de que la impresora pudo aceptar comandos."""
+    trabajo_id = getattr(error, "trabajo_incierto", None)
+    return {"trabajo_id": trabajo_id, "resultado_incierto": True} if trabajo_id else {}
+
+def huella_factura(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def procesar_solicitud_factura_fiscal(data, en_cola):
+    """Imprime (o encola) la factura de una solicitud. Devuelve (cuerpo, código HTTP, cabeceras)."""
     try:
         terminal_uuid = data.get("terminalUUID")
         fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
+        comandos = generar_comandos_factura(data)  # Se valida antes de encolar o de esperar por la impresora
 
-        with locks_dict_lock:
-            if terminal_uuid not in printer_locks:
-                printer_locks[terminal_uuid] = Lock()
-        impresora_lock = printer_locks[terminal_uuid]
-        
-        with impresora_lock:
-            print(f"\n--- [LOCK ADQUIRIDO] INICIANDO FACTURA PARA UUID [{terminal_uuid}] ---")
-
-            nombre_archivo_comandos = "factura_actual.txt"
-            ruta_archivo_completa = os.path.join(fiscal_dir, nombre_archivo_comandos)
-
-            comandos = []
-            # La lógica de generación de comandos no cambia
-            cliente = data.get('cliente', {}); comandos.append(f'iS*{cliente.get("razon_social", "Consumidor Final")}'); comandos.append(f'iR*{cliente.get("rif", "V000000000")}')
-            for item in data.get('items', []):
-                descripcion = item.get('descripcion', 'Producto')[:40]; cantidad = float(item.get('cantidad', 0)); precio_con_iva = float(item.get('precio_unitario_con_iva', 0)); tasa_iva = float(item.get('tasa_iva', 0))
-                if precio_con_iva <= 0.0: precio_con_iva = 0.01; tasa_iva = 0.0
-                precio_base = precio_con_iva / (1 + (tasa_iva / 100)) if tasa_iva > 0 else precio_con_iva
-                cmd_tasa_map = {16.0: '!', 8.0: '"', 31.0: '#', 0.0: ' '}; cmd_tasa = cmd_tasa_map.get(tasa_iva, ' ')
-                precio_fmt = f"{precio_base:.2f}".replace('.', '').zfill(10); cantidad_fmt = f"{cantidad:.3f}".replace('.', '').zfill(8); comandos.append(f'{cmd_tasa}{precio_fmt}{cantidad_fmt}{descripcion}')
-            comandos.append('3')
-            pagos = data.get('pagos', []);
-            if not pagos: comandos.append('101')
-            elif len(pagos) == 1: comandos.append(f"1{int(pagos[0].get('slot_fiscal', 1)):02d}")
-            else:
-                for i, pago in enumerate(pagos):
-                    slot = int(pago.get('slot_fiscal', 1)); monto = float(pago.get('monto', 0)); monto_fmt = f"{monto:.2f}".replace('.', '').zfill(12)
-                    if i < len(pagos) - 1: comandos.append(f"2{slot:02d}{monto_fmt}")
-                    else: comandos.append(f"1{slot:02d}")
-            if IGTF_MODE_ACTIVE:
-                comandos.append('199')
-                print(" > Modo IGTF activo. Añadiendo comando de cierre '199'.")
-
-            comandos_str = "\n".join(comandos)
-            
+        if en_cola:
             try:
-                with open(ruta_archivo_completa, "w", encoding="latin-1") as f:
-                    f.write(comandos_str)
-                    f.flush()
-                    os.fsync(f.fileno())
-                
-                # CAMBIO: La llamada a 'sync' es específica de Linux y se omite.
-                # os.fsync() es la llamada correcta para forzar la escritura de un
-                # archivo específico al disco en sistemas compatibles (incluyendo Windows).
-                if SISTEMA_OPERATIVO != "Windows":
-                    print(f"Archivo '{nombre_archivo_comandos}' escrito. Forzando sync de I/O del sistema (solo Linux)...")
-                    subprocess.run(["sync"], check=True)
-                    print("Sync de I/O completado.")
-                else:
-                    print(f"Archivo '{nombre_archivo_comandos}' escrito y sincronizado para Windows.")
+                trabajo = encolar_factura_fiscal(terminal_uuid, fiscal_dir, comandos)
+            except queue.Full:
+                return {"error": f"La cola fiscal de UUID [{terminal_uuid}] está llena ({COLA_FISCAL_TAMANO_MAXIMO} trabajos). Intente más tarde."}, 503, {}
+            log_fiscal.info(f"Factura encolada para UUID [{terminal_uuid}] como trabajo [{trabajo['id']}].", extra={"terminal": terminal_uuid, "trabajo": trabajo['id'], "etapa": "cola"})
+            return {"message": f"Factura para UUID [{terminal_uuid}] encolada.", "trabajo_id": trabajo['id'], "estado": "en_cola"}, 202, {}  # El hilo de la cola ya puede estar cambiando el estado del trabajo
 
-                # Bucle de Validación (se mantiene como doble chequeo)
-                max_espera_seg = 3.0
-                tiempo_inicio = time.time()
-                contenido_en_disco = ""
-                
-                while time.time() - tiempo_inicio < max_espera_seg:
-                    try:
-                        # CAMBIO: os.O_SYNC no está disponible en Windows. 
-                        # Confiamos en el f.flush() y os.fsync() hechos previamente.
-                        # El flag os.O_RDONLY es universal.
-                        fd = os.open(ruta_archivo_completa, os.O_RDONLY)
-                        try:
-                            size = os.fstat(fd).st_size
-                            contenido_en_disco_bytes = os.read(fd, size)
-                            contenido_en_disco = contenido_en_disco_bytes.decode("latin-1")
-                        finally:
-                            os.close(fd)
-
-                    except Exception as read_err:
-                        print(f"Advertencia: Error temporal leyendo archivo para validación: {read_err}")
-                        time.sleep(0.05) 
-                        continue
-                    
-                    if contenido_en_disco == comandos_str:
-                        print(f"Validación exitosa en {time.time() - tiempo_inicio:.4f}s. El contenido en disco coincide.")
-                        break
-                    
-                    print(f"Validación en progreso... (Actual: {len(contenido_en_disco)} bytes, Esperado: {len(comandos_str)} bytes)")
-                    time.sleep(0.05)
-                
-                if contenido_en_disco != comandos_str:
-                    print(f"Error Crítico: Timeout de {max_espera_seg}s. El archivo en disco NUNCA coincidió.")
-                    print(f"--- CONTENIDO ESPERADO ({len(comandos_str)} bytes) --- \n{comandos_str}")
-                    print(f"--- CONTENIDO EN DISCO ({len(contenido_en_disco)} bytes) --- \n{contenido_en_disco}")
-                    raise Exception(f"Fallo de validación de I/O: El archivo en disco no se actualizó a tiempo.")
+        trabajo_id = uuid.uuid4().hex
+        with contexto_log(terminal=terminal_uuid, trabajo=trabajo_id), bloqueo_impresora(terminal_uuid) as bloqueo:
+            log_fiscal.info("[LOCK ADQUIRIDO] Iniciando factura", extra={"etapa": "lock"})
+            respuesta = procesar_factura_fiscal(terminal_uuid, fiscal_dir, comandos, trabajo_id)
+            log_fiscal.info("[LOCK LIBERADO] Factura procesada", extra={"etapa": "lock"})
+            return {"message": f"Factura para UUID [{terminal_uuid}] enviada.", "respuesta_impresora": respuesta.get('mensaje'), **bloqueo}, 200, {}
+
+    except ImpresoraNoDisponibleError as e:
+        return respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e:
+        return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_fiscal.exception(f"Error procesando factura: {e}", extra={"terminal": data.get('terminalUUID')})
+        return {"error": f"Error crítico procesando para UUID [{data.get('terminalUUID')}]: {str(e)}", **detalle_incierto(e)}, 500, {}
+
+@app.route('/imprimir-factura-fiscal', methods=['POST'])
+def imprimir_factura_fiscal():
+    data = request.get_json()
+    if not data: return jsonify({"error": "No se recibieron datos"}), 400
+    en_cola = COLA_FISCAL_ACTIVA or request.args.get('modo') == 'cola'
 
-            except Exception as write_err:
-                print(f"ERROR escribiendo, sincronizando o validando el archivo: {write_err}")
-                raise write_err
+    clave = request.headers.get('Idempotency-Key')
+    if not clave:
+        respuesta, codigo, cabeceras = procesar_solicitud_factura_fiscal(data, en_cola)
+        return jsonify(respuesta), codigo, cabeceras
 
-            respuesta = ejecutar_comando_fiscal("SendFileCmd", ruta_archivo_completa, fiscal_dir, lineas_esperadas=len(comandos))
+    huella = huella_factura(data)
+    entrada, propia = reservar_idempotencia(clave, huella, data.get("terminalUUID"))
+    if not propia:
+        log_fiscal.info(f"Idempotency-Key '{clave}' repetida; no se vuelve a imprimir.", extra={"terminal": data.get("terminalUUID")})
+        respuesta, codigo, cabeceras = responder_duplicado(entrada, huella)
+        return jsonify(respuesta), codigo, cabeceras
 
-            print(f"--- [LOCK LIBERADO] FACTURA PROCESADA PARA UUID [{terminal_uuid}] ---")
-            return jsonify({"message": f"Factura para UUID [{terminal_uuid}] enviada.", "respuesta_impresora": respuesta.get('mensaje')}), 200
+    respuesta, codigo, cabeceras = {"error": "La solicitud se interrumpió."}, 500, {}
+    try:
+        respuesta, codigo, cabeceras = procesar_solicitud_factura_fiscal(data, en_cola)
+    finally:
+        completar_idempotencia(clave, entrada, respuesta, codigo)
+    return jsonify(respuesta), codigo, cabeceras
+
+# --- LOTE DE FACTURAS FISCALES ---
+
+def comandos_aceptados(error):
+    """Cuántos comandos del archivo aceptó la impresora antes del fallo, si se sabe."""
+    if isinstance(error, EnvioParcialError): return error.comandos_enviados
+    if isinstance(error.__cause__, ErrorDriverTfhka): return error.__cause__.enviados
+    return None
+
+def resultados_por_factura(bloques, comandos_enviados, error=None):
+    """Reparte el conteo de comandos aceptados entre las facturas del lote, en orden.
+    'impresa' si todos sus comandos entraron, 'incompleta' si el fallo ocurrió dentro de ella
+    (queda un documento abierto en la impresora), 'no_enviada' después del fallo y 'desconocido'
+    si el fallo no informa cuántos comandos entraron."""
+    resultados, inicio = [], 0
+    for indice, cantidad in enumerate(bloques):
+        fin = inicio + cantidad
+        if comandos_enviados is None: estado = "desconocido"
+        elif fin <= comandos_enviados: estado = "impresa"
+        elif inicio < comandos_enviados: estado = "incompleta"
+        else: estado = "no_enviada"
+        resultado = {"indice": indice, "estado": estado, "comandos": cantidad}
+        if error is not None and estado != "impresa": resultado["error"] = str(error)
+        resultados.append(resultado)
+        inicio = fin
+    return resultados
+
+@app.route('/imprimir-facturas-fiscales/lote', methods=['POST'])
+def imprimir_facturas_fiscales_lote():
+    """Imprime varias facturas de un terminal con un solo archivo de comandos y un solo SendFileCmd."""
+    data = request.get_json()
+    if not data: return jsonify({"error": "No se recibieron datos"}), 400
+    try:
+        terminal_uuid = data.get("terminalUUID")
+        fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
+        facturas = data.get("facturas")
+        if not isinstance(facturas, list) or not facturas or not all(isinstance(f, dict) for f in facturas):
+            raise ValueError("'facturas' debe ser una lista no vacía de facturas.")
+        if len(facturas) > LOTE_FISCAL_MAXIMO_FACTURAS:
+            raise ValueError(f"El lote tiene {len(facturas)} facturas; el máximo es {LOTE_FISCAL_MAXIMO_FACTURAS}.")
+        for indice, factura in enumerate(facturas):
+            if factura.get("terminalUUID", terminal_uuid) != terminal_uuid:
+                raise ValueError(f"La factura {indice} es de otro terminal ({factura['terminalUUID']}).")
+        comandos_por_factura = []
+        for indice, factura in enumerate(facturas):
+            try:
+                comandos_por_factura.append(generar_comandos_factura(factura))
+            except ValueError as e:
+                raise ValueError(f"Factura {indice}: {e}") from e
+        bloques = [len(c) for c in comandos_por_factura]
 
+        trabajo_id = uuid.uuid4().hex
+        with contexto_log(terminal=terminal_uuid, trabajo=trabajo_id), bloqueo_impresora(terminal_uuid) as bloqueo, \
+                TrabajoEnDiario(trabajo_id, terminal_uuid, "lote", facturas=len(facturas), comandos=sum(bloques)) as diario:
+            log_fiscal.info(f"[LOCK ADQUIRIDO] Iniciando lote de {len(facturas)} facturas ({sum(bloques)} comandos)", extra={"etapa": "lock"})
+            ruta_archivo_completa = escribir_archivo_comandos(fiscal_dir, trabajo_id, "\n".join("\n".join(c) for c in comandos_por_factura))
+            diario.archivo(ruta_archivo_completa)
+            try:
+                diario.enviando()
+                respuesta = ejecutar_comando_fiscal("SendFileCmd", ruta_archivo_completa, fiscal_dir, lineas_esperadas=sum(bloques))
+            except ImpresoraNoDisponibleError:
+                raise
+            except Exception as e:
+                diario.resultado(e)
+                resultados = resultados_por_factura(bloques, comandos_aceptados(e) if diario.enviado else 0, e)
+                log_fiscal.error(f"Lote fallido: {e}", extra={"etapa": "ejecucion"})
+                return jsonify({"error": f"Error procesando lote para UUID [{terminal_uuid}]: {e}", "trabajo_id": trabajo_id,
+                                "resultados": resultados, **bloqueo}), 500
+            finally:
+                retirar_archivo_comandos(fiscal_dir, ruta_archivo_completa)
+            log_fiscal.info("[LOCK LIBERADO] Lote procesado", extra={"etapa": "lock"})
+        return jsonify({"message": f"Lote de {len(facturas)} facturas enviado a UUID [{terminal_uuid}].", "trabajo_id": trabajo_id,
+                        "respuesta_impresora": respuesta.get('mensaje'), "resultados": resultados_por_factura(bloques, sum(bloques)), **bloqueo}), 200
+    except ImpresoraNoDisponibleError as e:
+        cuerpo, codigo, cabeceras = respuesta_no_disponible(e)
+        return jsonify(cuerpo), codigo, cabeceras
     except (ValueError, FileNotFoundError) as e:
-        if impresora_lock and impresora_lock.locked(): impresora_lock.release()
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        if impresora_lock and impresora_lock.locked(): impresora_lock.release()
-        traceback.print_exc()
-        return jsonify({"error": f"Error crítico procesando para UUID [{data.get('terminalUUID')}]: {str(e)}"}), 500
+        log_fiscal.exception(f"Error procesando lote: {e}", extra={"terminal": data.get('terminalUUID')})
+        return jsonify({"error": f"Error crítico procesando lote para UUID [{data.get('terminalUUID')}]: {str(e)}"}), 500
+
+@app.route('/trabajos/<trabajo_id>', methods=['GET'])
+def consultar_trabajo(trabajo_id):
+    with trabajos_lock:
+        trabajo = trabajos_fiscales.get(trabajo_id)
+        if trabajo is None: return jsonify({"error": f"Trabajo '{trabajo_id}' no encontrado."}), 404
+        return jsonify(_vista_trabajo(trabajo)), 200
+
+@app.route('/trabajos', methods=['GET'])
+def listar_trabajos():
+    terminal_uuid = request.args.get('terminalUUID')
+    with trabajos_lock:
+        trabajos = [_vista_trabajo(t) for t in trabajos_fiscales.values() if not terminal_uuid or t['terminalUUID'] == terminal_uuid]
+        cola = colas_fiscales.get(terminal_uuid) if terminal_uuid else None
+    trabajos.sort(key=lambda t: t['creado'], reverse=True)
+    respuesta = {"trabajos": trabajos}
+    if terminal_uuid: respuesta["en_cola"] = cola.qsize() if cola else 0
+    return jsonify(respuesta), 200
+
+def procesar_reporte_fiscal(terminal_uuid, tipo_reporte):
+    """Imprime un reporte X o Z respetando el lock de la impresora. Devuelve (cuerpo, código HTTP, cabeceras)."""
+    try:
+        fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
+        if tipo_reporte not in ['X', 'Z']: return {"error": "Tipo de reporte no válido. Use 'X' o 'Z'."}, 400, {}
+        trabajo_id = uuid.uuid4().hex
+        with contexto_log(terminal=terminal_uuid, trabajo=trabajo_id), bloqueo_impresora(terminal_uuid) as bloqueo, \
+                TrabajoEnDiario(trabajo_id, terminal_uuid, "reporte", reporte=tipo_reporte) as diario:
+            log_fiscal.info(f"[LOCK ADQUIRIDO] Reporte {tipo_reporte}", extra={"etapa": "lock"})
+            comando_impresora = 'I0X' if tipo_reporte == 'X' else 'I0Z'
+            diario.enviando()
+            respuesta = ejecutar_comando_fiscal("SendCmd", comando_impresora, fiscal_dir)
+            log_fiscal.info(f"[LOCK LIBERADO] Reporte {tipo_reporte} procesado", extra={"etapa": "lock"})
+            return {"message": f"Reporte '{tipo_reporte}' enviado a UUID [{terminal_uuid}].", "respuesta_impresora": respuesta.get('mensaje'), **bloqueo}, 200, {}
+    except ImpresoraNoDisponibleError as e:
+        return respuesta_no_disponible(e)
+    except (ValueError, FileNotFoundError) as e: return {"error": str(e)}, 400, {}
+    except Exception as e:
+        log_fiscal.exception(f"Error imprimiendo reporte: {e}", extra={"terminal": terminal_uuid})
+        return {"error": f"Error crítico imprimiendo reporte para UUID [{terminal_uuid}]: {str(e)}"}, 500, {}
 
 @app.route('/imprimir-reporte-fiscal', methods=['POST'])
 def imprimir_reporte_fiscal():
     data = request.get_json()
     if not data: return jsonify({"error": "No se recibieron datos"}), 400
+    cuerpo, codigo, cabeceras = procesar_reporte_fiscal(data.get("terminalUUID"), data.get('tipo', '').upper())
+    return jsonify(cuerpo), codigo, cabeceras
+
+@app.route('/reportes-fiscales', methods=['POST'])
+def imprimir_reportes_fiscales():
+    """Reporte X o Z de varios terminales en paralelo. Responde NDJSON: una línea por terminal a medida
+    que terminan y una última línea con el resumen."""
+    data = request.get_json()
+    if not data: return jsonify({"error": "No se recibieron datos"}), 400
+    tipo_reporte = data.get('tipo', '').upper()
+    if tipo_reporte not in ['X', 'Z']: return jsonify({"error": "Tipo de reporte no válido. Use 'X' o 'Z'."}), 400
+    terminales = data.get('terminales')
+    if terminales == 'todos':
+        terminales = descubrir_terminales()
+    elif not isinstance(terminales, list) or not terminales or not all(isinstance(t, str) for t in terminales):
+        return jsonify({"error": "'terminales' debe ser una lista de terminalUUID o \"todos\"."}), 400
+    terminales = list(dict.fromkeys(terminales))  # Un terminal repetido imprimiría dos reportes
+
+    def reporte_con_duracion(terminal_uuid):
+        t_inicio = time.perf_counter()
+        cuerpo, codigo, _ = procesar_reporte_fiscal(terminal_uuid, tipo_reporte)
+        return dict(cuerpo, terminalUUID=terminal_uuid, codigo=codigo, duracion_ms=round((time.perf_counter() - t_inicio) * 1000, 1))
+
+    def generar():
+        t_inicio = time.perf_counter()
+        exitosos = 0
+        ejecutor = ThreadPoolExecutor(max_workers=min(REPORTES_HILOS_MAXIMOS, len(terminales)) or 1, thread_name_prefix="reporte-fiscal")
+        try:
+            for futuro in as_completed([ejecutor.submit(reporte_con_duracion, t) for t in terminales]):
+                resultado = futuro.result()
+                exitosos += resultado["codigo"] == 200
+                yield json.dumps(resultado, ensure_ascii=False) + "\n"
+            yield json.dumps({"resumen": {"tipo": tipo_reporte, "terminales": len(terminales), "exitosos": exitosos,
+                                          "fallidos": len(terminales) - exitosos,
+                                          "duracion_ms": round((time.perf_counter() - t_inicio) * 1000, 1)}}, ensure_ascii=False) + "\n"
+        finally:
+            # Si el cliente se desconecta no se inician más reportes; los que están en curso terminan
+            ejecutor.shutdown(wait=False, cancel_futures=True)
+
+    log_fiscal.info(f"Reporte {tipo_reporte} solicitado para {len(terminales)} terminales.")
+    return Response(generar(), mimetype='application/x-ndjson')
+
+def interpretar_estado_fiscal(resultado, ruta_completa_estado):
+    """Decodifica la respuesta de ReadFpStatus (del driver o del archivo que escribe el ejecutable)."""
+    if "status_code" in resultado: # El driver serial devuelve el estado ya decodificado
+        status_code, error_code = resultado["status_code"], resultado["error_code"]
+    else:
+        with open(ruta_completa_estado, 'r') as f:
+            linea_estado = f.read().strip()
+
+        partes = linea_estado.replace(":", " ").split()
+        status_code = int(partes[partes.index("Status") + 1])
+        error_code = int(partes[partes.index("Error") + 1])
+
+    return {
+        "status_code": status_code,
+        "status_descripcion": STATUS_CODES.get(status_code, "?"),
+        "error_code": error_code,
+        "error_descripcion": ERROR_CODES.get(error_code, "?")
+    }
+
+def leer_estado_fiscal(terminal_uuid, fiscal_dir):
+    """Consulta ReadFpStatus y devuelve el estado decodificado. Debe llamarse con el lock de la impresora tomado."""
+    ruta_completa_estado = os.path.join(fiscal_dir, f"estado_{uuid.uuid4().hex}.txt")
+    try:
+        resultado = ejecutar_comando_fiscal("ReadFpStatus", ruta_completa_estado, fiscal_dir)
+        estado = interpretar_estado_fiscal(resultado, ruta_completa_estado)
+        error = error_de_estado(estado)
+        if error: registrar_resultado_circuito(terminal_uuid, error, inmediato=True)
+        return estado
+    finally:
+        if os.path.exists(ruta_completa_estado):
+            os.remove(ruta_completa_estado)
+
+# --- CACHÉ DE ESTADO FISCAL Y SONDEO EN SEGUNDO PLANO ---
+
+def guardar_estado_en_cache(terminal_uuid, estado=None, error=None):
+    with cache_estado_lock:
+        anterior = cache_estado_fiscal.get(terminal_uuid, {})
+        cache_estado_fiscal[terminal_uuid] = {
+            # Si la lectura falla se conserva el último estado bueno, pero ya no se sirve como vigente
+            "estado": estado if estado is not None else anterior.get("estado"),
+            "t_estado": time.monotonic() if estado is not None else anterior.get("t_estado"),
+            "t_lectura": time.monotonic(),
+            "error": error,
+        }
+
+def _vista_estado_cache(entrada):
+    vista = dict(entrada["estado"] or {})
+    vista["age_ms"] = round((time.monotonic() - entrada["t_estado"]) * 1000) if entrada["t_estado"] is not None else None
+    if entrada["error"]: vista["ultimo_error"] = entrada["error"]
+    return vista
+
+def estado_en_cache_vigente(terminal_uuid):
+    """Estado en caché si la última lectura fue buena y tiene menos de TTL_CACHE_ESTADO_SEG; si no, None."""
+    with cache_estado_lock:
+        entrada = cache_estado_fiscal.get(terminal_uuid)
+        if entrada and entrada["estado"] and not entrada["error"] and time.monotonic() - entrada["t_estado"] <= TTL_CACHE_ESTADO_SEG:
+            return _vista_estado_cache(entrada)
+    return None
+
+def descubrir_terminales():
+    """Terminales con carpeta y ejecutable bajo BASE_FISCAL_PATH, más los que ya recibieron solicitudes."""
+    terminales = set(printer_locks)
+    if registro_info["actualizado"] is not None: return sorted(terminales | registro_terminales.keys())
+    try:
+        for nombre in os.listdir(BASE_FISCAL_PATH):
+            if os.path.isfile(os.path.join(BASE_FISCAL_PATH, nombre, EXECUTABLE_FISCAL)):
+                terminales.add(nombre)
+    except OSError as e:
+        log_estado.warning(f"No se pudo listar '{BASE_FISCAL_PATH}': {e}")
+    return sorted(terminales)
+
+def impresora_ocupada(terminal_uuid):
+    cola = colas_fiscales.get(terminal_uuid)
+    return cola is not None and cola.unfinished_tasks > 0
+
+def sondear_estado_terminal(terminal_uuid):
+    """Lee el estado solo si la impresora está libre; nunca espera por el lock. Devuelve True si leyó."""
+    if impresora_ocupada(terminal_uuid): return False
+    impresora_lock = obtener_lock_impresora(terminal_uuid)
+    if not impresora_lock.acquire(blocking=False): return False
     try:
-        terminal_uuid = data.get("terminalUUID"); tipo_reporte = data.get('tipo', '').upper()
         fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
-        if tipo_reporte not in ['X', 'Z']: return jsonify({"error": "Tipo de reporte no válido. Use 'X' o 'Z'."}), 400
-        with locks_dict_lock:
-            if terminal_uuid not in printer_locks: printer_locks[terminal_uuid] = Lock()
-        impresora_lock = printer_locks[terminal_uuid]
-        with impresora_lock:
-            print(f"\n--- [LOCK ADQUIRIDO] REPORTE [{tipo_reporte}] PARA UUID [{terminal_uuid}] ---")
-            comando_impresora = 'I0X' if tipo_reporte == 'X' else 'I0Z'
-            respuesta = ejecutar_comando_fiscal("SendCmd", comando_impresora, fiscal_dir)
-            print(f"--- [LOCK LIBERADO] REPORTE PROCESADO PARA UUID [{terminal_uuid}] ---")
-            return jsonify({"message": f"Reporte '{tipo_reporte}' enviado a UUID [{terminal_uuid}].", "respuesta_impresora": respuesta.get('mensaje')}), 200
-    except (ValueError, FileNotFoundError) as e: return jsonify({"error": str(e)}), 400
+        guardar_estado_en_cache(terminal_uuid, estado=leer_estado_fiscal(terminal_uuid, fiscal_dir))
     except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": f"Error crítico imprimiendo reporte para UUID [{data.get('terminalUUID')}]: {str(e)}"}), 500
+        log_estado.warning(f"Sondeo de estado: fallo leyendo UUID [{terminal_uuid}]: {e}", extra={"terminal": terminal_uuid})
+        guardar_estado_en_cache(terminal_uuid, error=str(e))
+    finally:
+        impresora_lock.release()
+    return True
+
+def _bucle_sondeo_estado():
+    while True:
+        for terminal_uuid in descubrir_terminales():
+            with cache_estado_lock:
+                entrada = cache_estado_fiscal.get(terminal_uuid)
+            # Una lectura reciente (p. ej. un '?fresh=1') cuenta como sondeo
+            if entrada and time.monotonic() - entrada["t_lectura"] < INTERVALO_SONDEO_ESTADO_SEG: continue
+            sondear_estado_terminal(terminal_uuid)
+        time.sleep(INTERVALO_SONDEO_ESTADO_SEG)
+
+def iniciar_sondeo_estado():
+    Thread(target=_bucle_sondeo_estado, name="sondeo-estado-fiscal", daemon=True).start()
+    log_estado.info(f"Sondeo de estado fiscal activo cada {INTERVALO_SONDEO_ESTADO_SEG}s (caché válida {TTL_CACHE_ESTADO_SEG}s).")
 
 @app.route('/estado-impresora-fiscal/<terminal_uuid>', methods=['GET'])
 def estado_impresora_fiscal(terminal_uuid):
-    ruta_completa_estado = None
     try:
         fiscal_dir = get_and_validate_fiscal_dir(terminal_uuid)
-        
-        archivo_estado = f"estado_{uuid.uuid4().hex}.txt"
-        ruta_completa_estado = os.path.join(fiscal_dir, archivo_estado)
-        
-        ejecutar_comando_fiscal("ReadFpStatus", ruta_completa_estado, fiscal_dir)
-        
-        with open(ruta_completa_estado, 'r') as f: 
-            linea_estado = f.read().strip()
-            
-        partes = linea_estado.replace(":", " ").split()
-        status_code = int(partes[partes.index("Status") + 1])
-        error_code = int(partes[partes.index("Error") + 1])
-        
-        respuesta = {
-            "status_code": status_code, 
-            "status_descripcion": STATUS_CODES.get(status_code, "?"), 
-            "error_code": error_code, 
-            "error_descripcion": ERROR_CODES.get(error_code, "?")
-        }
-        return jsonify(respuesta), 200
-        
-    except (ValueError, FileNotFoundError) as e: 
+
+        if request.args.get('fresh') not in ('1', 'true'):
+            estado = estado_en_cache_vigente(terminal_uuid)
+            if estado is not None: return jsonify(estado), 200
+
+        with bloqueo_impresora(terminal_uuid) as bloqueo:
+            try:
+                estado = leer_estado_fiscal(terminal_uuid, fiscal_dir)
+            except Exception as e:
+                guardar_estado_en_cache(terminal_uuid, error=str(e))
+                raise
+            guardar_estado_en_cache(terminal_uuid, estado=estado)
+        return jsonify(dict(estado, age_ms=0, **bloqueo)), 200
+
+    except ImpresoraNoDisponibleError as e:
+        cuerpo, codigo, cabeceras = respuesta_no_disponible(e)
+        return jsonify(cuerpo), codigo, cabeceras
+    except (ValueError, FileNotFoundError) as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        traceback.print_exc()
+        log_estado.exception(f"Error obteniendo estado: {e}", extra={"terminal": terminal_uuid})
         return jsonify({"error": f"Error obteniendo estado de UUID [{terminal_uuid}]: {str(e)}"}), 500
-    finally:
-        if ruta_completa_estado and os.path.exists(ruta_completa_estado): 
-            os.remove(ruta_completa_estado)
+
+@app.route('/estado-impresoras', methods=['GET'])
+def estado_impresoras():
+    """Estado en caché de todas las impresoras conocidas. No consulta a ninguna impresora."""
+    with cache_estado_lock:
+        entradas = dict(cache_estado_fiscal)
+    impresoras = {}
+    for terminal_uuid in sorted(set(descubrir_terminales()) | set(entradas)):
+        entrada = entradas.get(terminal_uuid)
+        impresoras[terminal_uuid] = _vista_estado_cache(entrada) if entrada else {"age_ms": None, "ultimo_error": "Sin lecturas todavía."}
+        circuito = vista_circuito(terminal_uuid)
+        if circuito: impresoras[terminal_uuid]["circuito"] = circuito
+    return jsonify({"impresoras": impresoras}), 200
 
 @app.route('/test-fiscal/<terminal_uuid>', methods=['POST'])
 def test_fiscal(terminal_uuid):
@@ -529,12 +2638,49 @@ def test_fiscal(terminal_uuid):
             "message": f"Comando de prueba enviado exitosamente a UUID [{terminal_uuid}].",
             "respuesta_impresora": respuesta.get('mensaje')
         }), 200
+    except ImpresoraNoDisponibleError as e:
+        cuerpo, codigo, cabeceras = respuesta_no_disponible(e)
+        return jsonify(cuerpo), codigo, cabeceras
     except (ValueError, FileNotFoundError) as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        traceback.print_exc()
+        log_fiscal.exception(f"Error en la prueba fiscal: {e}", extra={"terminal": terminal_uuid})
         return jsonify({"error": f"Error en la prueba fiscal para UUID [{terminal_uuid}]: {str(e)}"}), 500
 
+# ----------------------------------------------------------------
+# --- MEDICIÓN DE SOLICITUDES Y ENDPOINT /metrics ---
+# ----------------------------------------------------------------
+
+@app.before_request
+def _inicio_medicion_solicitud():
+    g.t_inicio_solicitud = time.perf_counter()
+
+@app.after_request
+def _fin_medicion_solicitud(response):
+    t_inicio = g.get('t_inicio_solicitud')
+    if t_inicio is not None and request.endpoint not in (None, 'metricas'):
+        terminal = (request.view_args or {}).get('terminal_uuid')
+        if terminal is None and request.is_json:
+            terminal = (request.get_json(silent=True) or {}).get('terminalUUID')
+        # Solo terminales conocidos, para que UUIDs inválidos no creen series nuevas
+        terminal = terminal if terminal in printer_locks else ""
+        METRICA_SOLICITUD.observar(time.perf_counter() - t_inicio, request.endpoint, terminal, response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metricas():
+    return Response(exportar_metricas(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def iniciar_servicios_segundo_plano():
+    if REGISTRO_TERMINALES_ACTIVO: iniciar_registro_terminales()
+    if DIARIO_FISCAL_ACTIVO: iniciar_diario_fiscal()
+    if SONDEO_ESTADO_ACTIVO: iniciar_sondeo_estado()
+    if CACHE_BLOQUES_ACTIVA: precalentar_cache_bloques()
+
 if __name__ == '__main__':
-    print(f"Iniciando servidor de impresión ADAPTADO (FISCAL Y NO FISCAL) en http://0.0.0.0:5000")
+    log.info("Iniciando servidor de impresión ADAPTADO (FISCAL Y NO FISCAL) en http://0.0.0.0:5000")
+    # Con debug=True el reloader de Werkzeug ejecuta este bloque también en el proceso vigilante;
+    # los hilos de fondo solo deben arrancar en el proceso hijo que atiende las solicitudes.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        iniciar_servicios_segundo_plano()
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
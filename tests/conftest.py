@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import stat
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import servidor_impresion_adaptado as servidor
+
+logging.getLogger("servidor").setLevel(logging.CRITICAL)
+
+# Ejecutable fiscal de prueba: SendFileCmd informa TFHKA_ENVIADOS comandos (por defecto todos los del archivo)
+EJECUTABLE_FALSO = """#!{python}
+import os, sys
+comando, argumento = sys.argv[1], sys.argv[2]
+if comando == "SendFileCmd":
+    lineas = len(open(argumento, encoding="latin-1").read().splitlines())
+    print("Enviados %s comandos" % os.environ.get("TFHKA_ENVIADOS", lineas))
+elif comando == "ReadFpStatus":
+    open(argumento, "w").write("Status: 4 Error: 0\\n")
+    print("Lectura de estado exitosa")
+else:
+    print("Comando ejecutado correctamente")
+"""
+
+
+@pytest.fixture
+def base_fiscal(tmp_path, monkeypatch):
+    """BASE_FISCAL_PATH temporal con el terminal 'caja1' y estado global limpio."""
+    carpeta = tmp_path / "caja1"
+    carpeta.mkdir()
+    ejecutable = carpeta / servidor.EXECUTABLE_FISCAL
+    ejecutable.write_text(EJECUTABLE_FALSO.format(python=sys.executable))
+    ejecutable.chmod(ejecutable.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(servidor, "BASE_FISCAL_PATH", str(tmp_path))
+    monkeypatch.setattr(servidor, "almacen_idempotencia", type(servidor.almacen_idempotencia)())
+    monkeypatch.setattr(servidor, "idempotencia_cargada", False)
+    monkeypatch.setattr(servidor, "circuitos_fiscales", {})
+    servidor.diario_fiscal._descartar_archivo()
+    servidor.trabajos_sin_resolver.clear()
+    yield tmp_path
+    servidor.diario_fiscal._descartar_archivo()
+    servidor.trabajos_sin_resolver.clear()
+
+
+@pytest.fixture
+def cliente():
+    return servidor.app.test_client()
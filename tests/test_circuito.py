@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import servidor_impresion_adaptado as servidor
+from test_idempotencia import FACTURA
+
+
+def test_medio_abierto_admite_un_solo_sondeo(base_fiscal, monkeypatch):
+    servidor.circuitos_fiscales["caja1"] = {"estado": "abierto", "fallos": 3, "reabre": time.monotonic() - 1,
+                                           "ultimo_error": "No hay respuesta."}
+    sondeando, continuar = threading.Event(), threading.Event()
+    original = servidor.sondear_circuito
+
+    def sondeo_lento(*args):
+        sondeando.set()
+        continuar.wait(5)
+        return original(*args)
+
+    monkeypatch.setattr(servidor, "sondear_circuito", sondeo_lento)
+    respuestas = []
+    hilo = threading.Thread(target=lambda: respuestas.append(servidor.app.test_client().post("/imprimir-factura-fiscal", json=FACTURA)))
+    hilo.start()
+    try:
+        assert sondeando.wait(5)
+        rechazada = servidor.app.test_client().post("/imprimir-factura-fiscal", json=FACTURA)
+        assert rechazada.status_code == 503
+        assert rechazada.headers["Retry-After"] == "1"
+        assert servidor.circuitos_fiscales["caja1"]["estado"] == "medio_abierto"
+    finally:
+        continuar.set()
+        hilo.join(10)
+
+    assert respuestas[0].status_code == 200
+    assert servidor.circuitos_fiscales["caja1"]["estado"] == "cerrado"
+    assert servidor.app.test_client().post("/imprimir-factura-fiscal", json=FACTURA).status_code == 200
+
+
+def test_rechazos_de_datos_no_abren_el_circuito(base_fiscal, cliente, monkeypatch):
+    monkeypatch.setenv("TFHKA_ENVIADOS", "2")  # La impresora acepta solo parte de cada factura
+    for _ in range(servidor.CIRCUITO_FALLOS_PARA_ABRIR + 1):
+        assert cliente.post("/imprimir-factura-fiscal", json=FACTURA).status_code == 500
+    assert servidor.vista_circuito("caja1") is None
+
+    monkeypatch.delenv("TFHKA_ENVIADOS")
+    assert cliente.post("/imprimir-factura-fiscal", json=FACTURA).status_code == 200
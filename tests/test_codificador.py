@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from codificador_fiscal import CodificadorFiscal
+
+ITEM = {"descripcion": "Arepa", "cantidad": 1, "precio_unitario_con_iva": 11.6, "tasa_iva": 16}
+
+
+def comando_item(**campos):
+    return CodificadorFiscal().codificar({"items": [dict(ITEM, **campos)]})[2]
+
+
+def test_cliente_nulo_usa_los_valores_por_defecto_y_un_numero_se_imprime_tal_cual():
+    codificador = CodificadorFiscal()
+    nulo = codificador.codificar({"cliente": {"razon_social": None, "rif": None}, "items": [ITEM]})
+    ausente = codificador.codificar({"cliente": {}, "items": [ITEM]})
+    assert nulo[:2] == ausente[:2] == ["iS*Consumidor Final", "iR*V000000000"]
+    assert codificador.codificar({"cliente": {"rif": 12345678}, "items": [ITEM]})[1] == "iR*12345678"
+
+
+def test_texto_que_no_es_texto_se_rechaza():
+    with pytest.raises(ValueError, match="cliente.razon_social debe ser texto"):
+        CodificadorFiscal().codificar({"cliente": {"razon_social": {"nombre": "X"}}, "items": [ITEM]})
+
+
+@pytest.mark.parametrize("campos, esperado", [
+    ({}, "!000000100000001000Arepa"),                                             # 11.60 con IVA 16% = 10.00
+    ({"precio_unitario_con_iva": 1, "tasa_iva": 16}, "!000000008600001000Arepa"),  # 0.862... baja a 0.86
+    ({"precio_unitario_con_iva": 2.675, "tasa_iva": 0}, " 000000026800001000Arepa"),   # Mitad hacia arriba, sin el error del float
+    ({"precio_unitario_con_iva": "0.005", "tasa_iva": 0}, " 000000000100001000Arepa"),
+    ({"precio_unitario_con_iva": 0}, " 000000000100001000Arepa"),                  # Precio cero: 0.01 exento
+    ({"cantidad": "1.0005"}, "!000000100000001001Arepa"),
+    ({"cantidad": "1.0004"}, "!000000100000001000Arepa"),
+    ({"precio_unitario_con_iva": "99999999.99", "tasa_iva": 0}, " 999999999900001000Arepa"),
+    ({"cantidad": "99999.999"}, "!000000100099999999Arepa"),
+])
+def test_montos_en_los_campos_de_la_impresora(campos, esperado):
+    assert comando_item(**campos) == esperado
+
+
+@pytest.mark.parametrize("campos, mensaje", [
+    ({"precio_unitario_con_iva": "99999999.995", "tasa_iva": 0}, "no cabe en los 10 dígitos"),  # Redondea a 10^10 céntimos
+    ({"cantidad": "99999.9995"}, "no cabe en los 8 dígitos"),
+    ({"cantidad": "0.0004"}, "cantidad debe ser mayor que 0"),
+    ({"cantidad": -1}, "cantidad no puede ser negativo"),
+])
+def test_montos_fuera_de_los_limites_se_rechazan(campos, mensaje):
+    with pytest.raises(ValueError, match=mensaje):
+        comando_item(**campos)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+
+from escpos.printer import Dummy
+
+import servidor_impresion_adaptado as servidor
+
+CORTE = Dummy()
+CORTE.cut()
+CORTE = CORTE.output
+
+
+class TickeraFalsa:
+    nombre = "cocina"
+
+    def __init__(self):
+        self.impreso = b""
+
+    def encolar(self, trabajo):
+        impresora = Dummy()
+        trabajo(impresora)
+        self.impreso += impresora.output
+        futuro = Future()
+        futuro.set_result(None)
+        return futuro
+
+
+def comanda(pedido, mesa, descripcion="POLLO"):
+    return {"pedido": {"id": pedido, "mesa": mesa}, "items": [{"cantidad": 1, "descripcion": descripcion}]}
+
+
+def despachar(agrupador, comandas, cancelar=()):
+    futuros = [agrupador.agregar(datos) for datos in comandas]
+    for indice in cancelar:
+        futuros[indice].cancel()
+    agrupador._despachar()
+    return futuros
+
+
+def test_mesa_corta_aunque_falle_la_ultima_comanda():
+    tickera = TickeraFalsa()
+    agrupador = servidor.AgrupadorComandas(tickera, 60000, "mesa")
+    # La última comanda de la mesa 5 no se puede renderizar (ítem inválido)
+    futuros = despachar(agrupador, [comanda(1, "5"), comanda(2, "5"), dict(comanda(3, "5"), items=[None]), comanda(4, "7")])
+    assert futuros[2].exception() is not None
+    assert [f.result()["lote"] for f in (futuros[0], futuros[1], futuros[3])] == [3, 3, 3]
+    impreso = tickera.impreso
+    assert impreso.count(CORTE) == 2
+    assert impreso.index(b"PEDIDO #2") < impreso.index(CORTE) < impreso.index(b"PEDIDO #4")  # La mesa 5 termina cortada
+    assert impreso.endswith(CORTE)
+
+
+def test_mesa_corta_aunque_se_cancele_la_ultima_comanda():
+    tickera = TickeraFalsa()
+    agrupador = servidor.AgrupadorComandas(tickera, 60000, "mesa")
+    futuros = despachar(agrupador, [comanda(1, "5"), comanda(2, "5"), comanda(3, "5")], cancelar=[2])
+    assert futuros[2].cancelled()
+    assert b"PEDIDO #3" not in tickera.impreso
+    assert tickera.impreso.count(CORTE) == 1 and tickera.impreso.endswith(CORTE)
+    assert b"=" * servidor.ANCHO_TICKET in tickera.impreso  # Divisoria entre las dos que sí salieron
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import servidor_impresion_adaptado as servidor
+from test_idempotencia import FACTURA
+
+
+def trabajos_en_diario():
+    with open(servidor._ruta_diario_fiscal(), encoding="utf-8") as f:
+        return [json.loads(linea)["trabajo"] for linea in f]
+
+
+def test_compacta_en_ejecucion_sin_perder_los_abiertos(base_fiscal, monkeypatch):
+    monkeypatch.setattr(servidor, "DIARIO_COMPACTAR_CERRADOS", 3)
+    diario = servidor.diario_fiscal
+    diario._cerrados = 0
+    diario.anotar("en_curso", "recibido", terminal="caja1", tipo="factura")
+    diario.anotar("en_curso", "enviando").result()
+    diario.anotar("incierto", "resultado", exito=False, incierto=True).result()
+    for i in range(2):
+        diario.anotar(f"cerrado{i}", "recibido", terminal="caja1", tipo="factura")
+        diario.anotar(f"cerrado{i}", "resultado", exito=True).result()
+    assert "cerrado1" in trabajos_en_diario()
+
+    diario.anotar("resuelto", "resuelto", resolucion="impreso")  # Tercer cerrado: se compacta antes de confirmarlo
+    diario.anotar("nuevo", "recibido", terminal="caja1", tipo="factura").result()  # Mismo grupo o el siguiente
+    assert trabajos_en_diario() == ["en_curso", "en_curso", "incierto", "nuevo"]
+
+
+def test_trabajo_encolado_que_falla_antes_de_enviarse_queda_cerrado(base_fiscal, cliente):
+    servidor.circuitos_fiscales["caja1"] = {"estado": "abierto", "fallos": 3, "reabre": time.monotonic() + 60,
+                                           "ultimo_error": "No hay respuesta."}
+    respuesta = cliente.post("/imprimir-factura-fiscal?modo=cola", json=FACTURA)
+    assert respuesta.status_code == 202 and respuesta.json["estado"] == "en_cola"
+    servidor.colas_fiscales["caja1"].join()
+    assert servidor.trabajos_fiscales[respuesta.json["trabajo_id"]]["estado"] == "fallido"
+
+    servidor.diario_fiscal.anotar("sincronizar", "recibido").result()  # El 'resultado' ya está en disco
+    assert servidor.recuperar_diario_fiscal() == []
+    assert servidor.trabajos_sin_resolver == {}
+    assert trabajos_en_diario() == []
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import servidor_impresion_adaptado as servidor
+from driver_tfhka import (ERROR_COMANDO_RECHAZADO, ERROR_COMUNICACION, ERROR_SIN_RESPUESTA, ETX,
+                          STX, DriverTfhka, ErrorDriverTfhka, calcular_lrc, decodificar_trama_estado)
+from emulador_tfhka import EmuladorTfhka
+
+
+def trama(sts1, sts2):
+    cuerpo = bytes([sts1, sts2, ETX])
+    return bytes([STX]) + cuerpo + bytes([calcular_lrc(cuerpo)])
+
+
+@pytest.mark.parametrize("sts1, sts2, esperado", [
+    (0x44, 0x40, (4, 0)),     # Modo fiscal, en espera, sin error
+    (0x45, 0x41, (5, 1)),     # Documento fiscal abierto y fin del papel
+    (0x48, 0x40, (7, 0)),     # Memoria fiscal casi llena (bits 2-3 = 10), no 0x48 - 0x40 = 8
+    (0x4E, 0x42, (12, 2)),    # Memoria fiscal llena con documento no fiscal, error mecánico
+    (0x44, 0x50, (4, 80)),    # Comando inválido: el código es el byte sin los bits de papel
+    (0x44, 0x6C, (4, 108)),   # Memoria fiscal llena
+    (0x44, 0x51, (4, 1)),     # El papel tiene prioridad sobre el error de comando
+    (0x47, 0x40, (0, 0)),     # Documento 11: estado desconocido
+])
+def test_decodifica_campos_de_bits(sts1, sts2, esperado):
+    assert decodificar_trama_estado(trama(sts1, sts2)) == esperado
+
+
+def test_la_impresora_no_reporta_errores_de_comunicacion():
+    errores = {decodificar_trama_estado(trama(0x44, 0x40 | bits))[1] for bits in range(0x40)}
+    assert max(errores) < ERROR_COMUNICACION and ERROR_SIN_RESPUESTA not in errores
+
+
+def test_nak_no_abre_el_circuito_de_inmediato():
+    emulador = EmuladorTfhka(status=4, error=0, probabilidad_nak=1.0)
+    driver = DriverTfhka(emulador.iniciar(), timeout=1.0)
+    try:
+        assert driver.leer_estado()["status_code"] == 4
+        with pytest.raises(ErrorDriverTfhka) as info:
+            driver.enviar_comandos(["PJ", "8"])
+    finally:
+        driver.cerrar()
+        emulador.detener()
+    assert info.value.error_code == ERROR_COMANDO_RECHAZADO
+    try:
+        raise Exception("Fallo del driver serial") from info.value
+    except Exception as e:
+        assert not servidor.es_fallo_inmediato(e)
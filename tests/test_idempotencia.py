@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import servidor_impresion_adaptado as servidor
+
+FACTURA = {
+    "terminalUUID": "caja1",
+    "items": [{"descripcion": f"Producto {i}", "cantidad": 1, "precio_unitario_con_iva": 11.6, "tasa_iva": 16} for i in range(4)],
+    "pagos": [{"slot_fiscal": 1, "monto": 46.4}],
+}
+
+
+def enviar(cliente, clave="venta-1"):
+    return cliente.post("/imprimir-factura-fiscal", json=FACTURA, headers={"Idempotency-Key": clave})
+
+
+def test_envio_parcial_no_libera_la_clave(base_fiscal, cliente, monkeypatch):
+    monkeypatch.setenv("TFHKA_ENVIADOS", "3")
+    envios = []
+    original = servidor.ejecutar_comando_fiscal
+    monkeypatch.setattr(servidor, "ejecutar_comando_fiscal", lambda *a, **k: envios.append(a[0]) or original(*a, **k))
+
+    respuesta = enviar(cliente)
+    assert respuesta.status_code == 500
+    assert respuesta.json["resultado_incierto"] is True
+    trabajo_id = respuesta.json["trabajo_id"]
+
+    monkeypatch.delenv("TFHKA_ENVIADOS")
+    reintento = enviar(cliente)
+    assert reintento.status_code == 409
+    assert reintento.json["trabajo_id"] == trabajo_id
+    assert envios == ["SendFileCmd"]  # El reintento no volvió a enviar la factura
+    assert trabajo_id in servidor.trabajos_sin_resolver
+
+
+def test_fallo_sin_envio_libera_la_clave(base_fiscal, cliente, monkeypatch):
+    monkeypatch.setenv("TFHKA_ENVIADOS", "0")
+    monkeypatch.setattr(servidor, "INTENTOS_MAXIMOS_COMANDO_FISCAL", 1)
+    respuesta = enviar(cliente)
+    assert respuesta.status_code == 500
+    assert "resultado_incierto" not in respuesta.json
+
+    monkeypatch.delenv("TFHKA_ENVIADOS")
+    reintento = enviar(cliente)
+    assert reintento.status_code == 200
+    assert "Idempotent-Replayed" not in reintento.headers
+    assert enviar(cliente).headers["Idempotent-Replayed"] == "true"